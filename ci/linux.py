@@ -40,7 +40,9 @@ def main():
     buildOptions.addOption("gnuToolchain", "Build with gcc and libstdc++")
     buildOptions.addOption("llvmToolchain", "Build with clang and libc++")
     buildOptions.addOption("runIntegrationTests", "Run the integration tests")
+    buildOptions.addOption("runTests", "Run the tests")
     buildOptions.addOption("packageArtifacts", "Package the Artifacts")
+    buildOptions.addOption("runBenchmarks", "Run the benchmarks")
 
     buildOptions.setDefaultWorkflow("Empty workflow", [])
 
@@ -54,6 +56,7 @@ def main():
         'generateProject',
         'buildTargetLibrary',
         'runIntegrationTests',
+        'runTests',
         'packageArtifacts'
     ])
 
@@ -63,6 +66,7 @@ def main():
         'generateProject',
         'buildTargetLibrary',
         'runIntegrationTests',
+        'runTests',
         'packageArtifacts'
     ])
 
@@ -97,6 +101,10 @@ def main():
         nfbuild.buildTarget(library_target)
     if buildOptions.checkOption(options, "runIntegrationTests"):
         nfbuild.runIntegrationTests()
+    if buildOptions.checkOption(options, 'runTests'):
+        nfbuild.runTests()
+    if buildOptions.checkOption(options, 'runBenchmarks'):
+        nfbuild.runBenchmarks()
     if buildOptions.checkOption(options, 'packageArtifacts'):
         nfbuild.packageArtifacts()
 
@@ -118,6 +118,46 @@ class NFBuild(object):
         if cli_result:
             sys.exit(cli_result)
 
+    def runBenchmarks(self):
+        # Build the benchmark target
+        benchmark_target_name = 'NFHTTPBenchmark'
+        self.buildTarget(benchmark_target_name)
+        benchmark_binary = self.targetBinary(benchmark_target_name)
+        # Launch the stand-in server
+        root_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+        server_script = os.path.join(os.path.join(root_path, 'tools'), 'benchmark-server.py')
+        cmd = 'python ' + server_script + ' 6583'
+        pro = subprocess.Popen(cmd, stdout=subprocess.PIPE, preexec_fn=os.setsid, shell=True)
+        time.sleep(3)
+        benchmark_results = os.path.join(self.build_directory, 'benchmark.json')
+        self.build_print("Running Benchmarks: " + benchmark_results)
+        benchmark_result = subprocess.call([
+            benchmark_binary,
+            '-d', os.path.join(self.build_directory, 'benchmark-cache'),
+            '-o', benchmark_results])
+        os.killpg(os.getpgid(pro.pid), signal.SIGTERM)
+        if benchmark_result:
+            sys.exit(benchmark_result)
+
+    def runTests(self):
+        # Build the test target
+        tests_target_name = 'NFHTTPTests'
+        self.buildTarget(tests_target_name)
+        tests_binary = self.targetBinary(tests_target_name)
+        # Launch the stand-in server
+        root_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+        server_script = os.path.join(os.path.join(root_path, 'tools'), 'benchmark-server.py')
+        cmd = 'python ' + server_script + ' 6583'
+        pro = subprocess.Popen(cmd, stdout=subprocess.PIPE, preexec_fn=os.setsid, shell=True)
+        time.sleep(3)
+        self.build_print("Running Tests")
+        tests_result = subprocess.call([
+            tests_binary,
+            '-d', os.path.join(self.build_directory, 'tests-scratch')])
+        os.killpg(os.getpgid(pro.pid), signal.SIGTERM)
+        if tests_result:
+            sys.exit(tests_result)
+
     def runIntegrationTestsUnderDummyServer(self, cli_binary, root_path):
         output_responses = os.path.join(root_path, 'responses')
         resources_path = os.path.join(root_path, 'resources')
@@ -36,6 +36,8 @@ def main():
                            "Lint CPP Files and fix them")
 
     buildOptions.addOption("integrationTests", "Run Integration Tests")
+    buildOptions.addOption("runTests", "Run the tests")
+    buildOptions.addOption("runBenchmarks", "Run the benchmarks")
 
     buildOptions.addOption("makeBuildDirectory",
                            "Wipe existing build directory")
@@ -149,6 +151,12 @@ def main():
     if buildOptions.checkOption(options, 'integrationTests'):
         nfbuild.runIntegrationTests()
 
+    if buildOptions.checkOption(options, 'runTests'):
+        nfbuild.runTests()
+
+    if buildOptions.checkOption(options, 'runBenchmarks'):
+        nfbuild.runBenchmarks()
+
     if buildOptions.checkOption(options, 'codeCoverage'):
         nfbuild.collectCodeCoverage()
 
@@ -21,9 +21,13 @@
 #pragma once
 
 #include <NFHTTP/Request.h>
+#include <NFHTTP/RequestObserver.h>
 #include <NFHTTP/RequestToken.h>
 #include <NFHTTP/Response.h>
+#include <NFHTTP/Statistics.h>
 
+#include <chrono>
+#include <cstdint>
 #include <functional>
 #include <memory>
 #include <mutex>
@@ -41,6 +45,25 @@ typedef std::function<void(
     const std::shared_ptr<Response> &response)>
     RESPONSE_MODIFIER_FUNCTION;
 
+#ifdef _WIN32
+typedef uintptr_t EVENT_LOOP_SOCKET;
+#else
+typedef int EVENT_LOOP_SOCKET;
+#endif
+
+// The events a socket is watched for, or has had, in an application's event loop
+enum EventLoopEvent : int {
+  EventLoopEventNone = 0,
+  EventLoopEventRead = 1 << 0,
+  EventLoopEventWrite = 1 << 1,
+  EventLoopEventError = 1 << 2
+};
+
+// Asks the event loop to watch a socket for events, EventLoopEventNone stops watching it
+typedef std::function<void(EVENT_LOOP_SOCKET socket, int events)> WATCH_SOCKET_FUNCTION;
+// Asks the event loop to call onTimeout after timeout_ms, -1 cancels the timeout
+typedef std::function<void(long timeout_ms)> SET_TIMEOUT_FUNCTION;
+
 extern const REQUEST_MODIFIER_FUNCTION DO_NOT_MODIFY_REQUESTS_FUNCTION;
 extern const RESPONSE_MODIFIER_FUNCTION DO_NOT_MODIFY_RESPONSES_FUNCTION;
 
@@ -51,25 +74,76 @@ class Client {
   virtual std::shared_ptr<RequestToken> performRequest(
       const std::shared_ptr<Request> &request,
       std::function<void(const std::shared_ptr<Response> &)> callback) = 0;
+  virtual std::vector<std::shared_ptr<RequestToken>> performRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks);
+  std::vector<std::shared_ptr<RequestToken>> performRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      std::function<void(const std::shared_ptr<Response> &)> callback,
+      std::function<void(const std::vector<std::shared_ptr<Response>> &)> completion_callback);
   virtual const std::shared_ptr<Response> performRequestSynchronously(
       const std::shared_ptr<Request> &request);
   virtual void pinResponse(const std::shared_ptr<Response> &response,
                            const std::string &pin_identifier);
   virtual void unpinResponse(const std::shared_ptr<Response> &response,
                              const std::string &pin_identifier);
+  // Pins or unpins many responses in one go, then calls back with the size of their payloads.
+  // Responses can also be named by the hash of their request, as given by Request::hash()
+  void pinResponses(const std::vector<std::shared_ptr<Response>> &responses,
+                    const std::string &pin_identifier,
+                    std::function<void(size_t pinned_bytes)> callback);
+  void unpinResponses(const std::vector<std::shared_ptr<Response>> &responses,
+                      const std::string &pin_identifier,
+                      std::function<void(size_t unpinned_bytes)> callback);
+  virtual void pinRequestHashes(const std::vector<std::string> &request_hashes,
+                                const std::string &pin_identifier,
+                                std::function<void(size_t pinned_bytes)> callback);
+  virtual void unpinRequestHashes(const std::vector<std::string> &request_hashes,
+                                  const std::string &pin_identifier,
+                                  std::function<void(size_t unpinned_bytes)> callback);
   virtual void removePinnedResponseForIdentifier(const std::string &pin_identifier);
   virtual void pinnedResponsesForIdentifier(
       const std::string &pin_identifier,
       std::function<void(const std::vector<std::shared_ptr<Response>> &)> callback);
   virtual void pinningIdentifiers(
       std::function<void(const std::vector<std::string> &identifiers)> callback);
+  virtual void prefetchRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::string &pin_identifier,
+      std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback);
+  virtual Statistics stats() const;
+  // Completed responses are shared with identical requests for the window, up to max_bytes
+  virtual void setCoalescingWindow(std::chrono::milliseconds window, size_t max_bytes);
+  // 404 and 410 responses that do not say how long they stay fresh are cached for this long
+  virtual void setNegativeCacheTime(std::chrono::seconds time);
+  // Writes the whole cache to a single archive, or fills the cache from one. Both block until done
+  virtual bool exportCache(const std::string &archive_path);
+  virtual bool importCache(const std::string &archive_path);
+  // Entry points for clients made by createEventLoopClient, call them from the event loop thread
+  virtual void process(EVENT_LOOP_SOCKET socket, int events);
+  virtual void onTimeout();
 };
 
 extern std::shared_ptr<Client> createClient(
     const std::string &cache_location,
     const std::string &user_agent,
     REQUEST_MODIFIER_FUNCTION request_modifier_function = DO_NOT_MODIFY_REQUESTS_FUNCTION,
-    RESPONSE_MODIFIER_FUNCTION response_modifier_function = DO_NOT_MODIFY_RESPONSES_FUNCTION);
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function = DO_NOT_MODIFY_RESPONSES_FUNCTION,
+    const std::shared_ptr<RequestObserver> &request_observer = nullptr);
+// Runs requests from the application's event loop rather than a thread of their own. The client
+// asks for sockets and a timeout to be watched, and the loop reports back through process and
+// onTimeout, which is where responses are delivered. Every call to the client, and its
+// destruction, must happen on the loop thread. The watch functions must not call back into the
+// client. These clients do not cache, as the cache works on threads of its own, so
+// cache_location is unused. Returns nullptr when NFHTTP is built without curl
+extern std::shared_ptr<Client> createEventLoopClient(
+    const std::string &cache_location,
+    const std::string &user_agent,
+    WATCH_SOCKET_FUNCTION watch_socket_function,
+    SET_TIMEOUT_FUNCTION set_timeout_function,
+    REQUEST_MODIFIER_FUNCTION request_modifier_function = DO_NOT_MODIFY_REQUESTS_FUNCTION,
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function = DO_NOT_MODIFY_RESPONSES_FUNCTION,
+    const std::shared_ptr<RequestObserver> &request_observer = nullptr);
 extern std::string standardCacheLocation();
 
 }  // namespace http
@@ -22,8 +22,10 @@
 
 #include <NFHTTP/Client.h>
 #include <NFHTTP/Request.h>
+#include <NFHTTP/RequestObserver.h>
 #include <NFHTTP/RequestToken.h>
 #include <NFHTTP/Response.h>
+#include <NFHTTP/Statistics.h>
 
 #include <string>
 
@@ -20,6 +20,7 @@
  */
 #pragma once
 
+#include <functional>
 #include <memory>
 #include <string>
 #include <unordered_map>
@@ -35,6 +36,17 @@ extern const std::string DeleteMethod;
 extern const std::string OptionsMethod;
 extern const std::string ConnectMethod;
 
+typedef enum : int {
+  RequestPriorityLow = 0,
+  RequestPriorityNormal = 1,
+  RequestPriorityHigh = 2
+} RequestPriority;
+
+// Fills up to data_length bytes of data with the next part of the body and returns how many bytes
+// it wrote, returning 0 once the body is complete
+typedef std::function<size_t(unsigned char *data, size_t data_length)>
+    REQUEST_DATA_PROVIDER_FUNCTION;
+
 class Request {
  public:
   typedef struct CacheControl {
@@ -59,7 +71,20 @@ class Request {
   virtual void setMethod(const std::string &method) = 0;
   virtual const unsigned char *data(size_t &data_length) const = 0;
   virtual void setData(const unsigned char *data, size_t data_length) = 0;
+  virtual std::string dataPath() const = 0;
+  virtual void setDataPath(const std::string &data_path) = 0;
+  virtual REQUEST_DATA_PROVIDER_FUNCTION dataProvider() const = 0;
+  virtual long long dataProviderLength() const = 0;
+  // A data length of -1 sends the body chunked
+  virtual void setDataProvider(REQUEST_DATA_PROVIDER_FUNCTION data_provider,
+                               long long data_length = -1) = 0;
   virtual CacheControl cacheControl() const = 0;
+  virtual RequestPriority priority() const = 0;
+  virtual void setPriority(RequestPriority priority) = 0;
+  virtual int segmentCount() const = 0;
+  virtual void setSegmentCount(int segment_count) = 0;
+  virtual std::string downloadPath() const = 0;
+  virtual void setDownloadPath(const std::string &download_path) = 0;
 };
 
 extern std::shared_ptr<Request> createRequest(
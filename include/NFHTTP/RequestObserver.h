@@ -0,0 +1,53 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <chrono>
+#include <string>
+
+namespace nativeformat {
+namespace http {
+
+typedef enum : int {
+  RequestEventEnqueued,
+  RequestEventCacheLookupStarted,
+  RequestEventCacheLookupFinished,
+  RequestEventCoalesced,
+  RequestEventNetworkStarted,
+  RequestEventFirstByte,
+  RequestEventCompleted,
+  RequestEventCancelled,
+  RequestEventRetried
+} RequestEvent;
+
+// A passive observer of requests as they move through the client, it cannot change them. Events
+// are delivered on whichever thread the client happens to be on, so keep them cheap.
+class RequestObserver {
+ public:
+  virtual ~RequestObserver();
+
+  virtual void requestEvent(RequestEvent event,
+                            const std::string &request_hash,
+                            std::chrono::system_clock::time_point time) = 0;
+};
+
+}  // namespace http
+}  // namespace nativeformat
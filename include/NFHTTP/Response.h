@@ -93,6 +93,8 @@ class Response {
 
   virtual const std::shared_ptr<Request> request() const = 0;
   virtual const unsigned char *data(size_t &data_length) const = 0;
+  virtual std::string dataPath() const = 0;
+  virtual size_t dataLength() const = 0;
   virtual StatusCode statusCode() const = 0;
   virtual bool cancelled() const = 0;
   virtual std::string serialise() const = 0;
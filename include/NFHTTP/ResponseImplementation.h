@@ -23,6 +23,7 @@
 #include <NFHTTP/Response.h>
 
 #include <memory>
+#include <mutex>
 #include <string>
 #include <unordered_map>
 
@@ -45,6 +46,8 @@ class ResponseImplementation : public Response {
   // Response
   const std::shared_ptr<Request> request() const override;
   const unsigned char *data(size_t &data_length) const override;
+  std::string dataPath() const override;
+  size_t dataLength() const override;
   StatusCode statusCode() const override;
   bool cancelled() const override;
   std::string serialise() const override;
@@ -56,10 +59,15 @@ class ResponseImplementation : public Response {
   std::unordered_map<std::string, std::string> metadata() const override;
   void setMetadata(const std::string &key, const std::string &value) override;
 
+  // Refer to a body that lives in a file, which is only read into memory if data() is called
+  void setDataPath(const std::string &data_path, size_t data_length);
+
  private:
   std::shared_ptr<Request> _request;
-  unsigned char *_data;
-  const size_t _data_length;
+  mutable unsigned char *_data;
+  size_t _data_length;
+  std::string _data_path;
+  mutable std::mutex _data_mutex;
   StatusCode _status_code;
   const bool _cancelled;
   std::unordered_map<std::string, std::string> _headers;
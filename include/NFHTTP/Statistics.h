@@ -0,0 +1,80 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <array>
+#include <cstddef>
+#include <cstdint>
+
+namespace nativeformat {
+namespace http {
+
+struct LatencyHistogram {
+  // Bucket 0 counts requests that took under 1ms, and bucket i counts requests that took between
+  // 2^(i-1) and 2^i milliseconds, with the last bucket also counting anything slower
+  static const size_t BUCKET_COUNT = 20;
+
+  std::array<uint64_t, BUCKET_COUNT> buckets = {};
+  uint64_t count = 0;
+  double total_milliseconds = 0.0;
+
+  static double bucketUpperBound(size_t bucket);
+  double mean() const;
+  double percentile(double percentile) const;
+};
+
+struct LayerStatistics {
+  // Index 0 counts responses without a status code, otherwise the index is the status class
+  static const size_t STATUS_CLASS_COUNT = 6;
+
+  uint64_t started = 0;
+  uint64_t in_flight = 0;
+  uint64_t completed = 0;
+  uint64_t cancelled = 0;
+  std::array<uint64_t, STATUS_CLASS_COUNT> status_classes = {};
+  LatencyHistogram latency;
+
+  uint64_t errors() const;
+};
+
+struct Statistics {
+  LayerStatistics modifier;
+  LayerStatistics multi_request;
+  LayerStatistics caching;
+  LayerStatistics native;
+
+  uint64_t coalesced_requests = 0;
+  uint64_t cache_hits = 0;
+  uint64_t cache_misses = 0;
+  uint64_t cache_revalidations = 0;
+  uint64_t cache_evictions = 0;
+  // Lookups the in-memory index of the cache answered without reading the database
+  uint64_t cache_index_skipped_lookups = 0;
+  double cache_index_build_seconds = 0.0;
+  uint64_t bytes_sent = 0;
+  uint64_t bytes_received = 0;
+
+  double coalescingRatio() const;
+  double cacheHitRatio() const;
+};
+
+}  // namespace http
+}  // namespace nativeformat
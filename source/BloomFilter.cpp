@@ -0,0 +1,92 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include "BloomFilter.h"
+
+#include <algorithm>
+#include <functional>
+#include <limits>
+
+namespace nativeformat {
+namespace http {
+
+const size_t BloomFilter::COUNTERS_PER_KEY;
+const size_t BloomFilter::HASH_COUNT;
+
+BloomFilter::BloomFilter(size_t capacity)
+    : _capacity(std::max<size_t>(capacity, 1)),
+      _counters(_capacity * COUNTERS_PER_KEY, 0),
+      _size(0) {}
+
+void BloomFilter::insert(const std::string &key) {
+  visitCounters(key, [this](size_t index) {
+    // A saturated counter stays saturated, as we no longer know how many keys share it
+    if (_counters[index] != std::numeric_limits<uint8_t>::max()) {
+      _counters[index]++;
+    }
+  });
+  _size++;
+}
+
+void BloomFilter::remove(const std::string &key) {
+  if (!mightContain(key)) {
+    return;
+  }
+  visitCounters(key, [this](size_t index) {
+    if (_counters[index] != std::numeric_limits<uint8_t>::max()) {
+      _counters[index]--;
+    }
+  });
+  if (_size > 0) {
+    _size--;
+  }
+}
+
+bool BloomFilter::mightContain(const std::string &key) const {
+  bool contains = true;
+  visitCounters(key, [this, &contains](size_t index) {
+    if (_counters[index] == 0) {
+      contains = false;
+    }
+  });
+  return contains;
+}
+
+size_t BloomFilter::size() const {
+  return _size;
+}
+
+size_t BloomFilter::capacity() const {
+  return _capacity;
+}
+
+template <typename Visitor>
+void BloomFilter::visitCounters(const std::string &key, Visitor visitor) const {
+  // Double hashing, with the second hash made odd so it steps through every counter
+  const uint64_t first_hash = std::hash<std::string>()(key);
+  uint64_t second_hash = first_hash * 0x9e3779b97f4a7c15ULL;
+  second_hash = (second_hash ^ (second_hash >> 31)) | 1;
+  for (size_t i = 0; i < HASH_COUNT; ++i) {
+    visitor((first_hash + i * second_hash) % _counters.size());
+  }
+}
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,58 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <cstdint>
+#include <string>
+#include <vector>
+
+namespace nativeformat {
+namespace http {
+
+// A counting Bloom filter, so keys can be removed as well as added. It can say a key was never
+// added, but a key it reports as present may still be missing. Only remove keys that were added,
+// otherwise it may forget other keys. Not thread safe
+class BloomFilter {
+ public:
+  BloomFilter(size_t capacity);
+
+  void insert(const std::string &key);
+  void remove(const std::string &key);
+  bool mightContain(const std::string &key) const;
+
+  // Past its capacity the filter still works, but reports more keys as present that are not
+  size_t size() const;
+  size_t capacity() const;
+
+ private:
+  static const size_t COUNTERS_PER_KEY = 10;
+  static const size_t HASH_COUNT = 7;
+
+  template <typename Visitor>
+  void visitCounters(const std::string &key, Visitor visitor) const;
+
+  const size_t _capacity;
+  std::vector<uint8_t> _counters;
+  size_t _size;
+};
+
+}  // namespace http
+}  // namespace nativeformat
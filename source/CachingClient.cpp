@@ -23,58 +23,164 @@
 #include <NFHTTP/ResponseImplementation.h>
 #include "RequestImplementation.h"
 
+#include <algorithm>
 #include <chrono>
 #include <cstdlib>
 #include <iomanip>
 #include <iostream>
+#include <limits>
 #include <locale>
 #include <sstream>
 #include <unordered_map>
 
+#if !_WIN32
+#include <unistd.h>
+#endif
+
+#include "DownloadFile.h"
+#include "RequestObserverNotification.h"
 #include "RequestTokenImplementation.h"
+#include "Timing.h"
 
 namespace nativeformat {
 namespace http {
 
 namespace {
 static const std::string CACHED_KEY("cached");
+static const std::string CACHE_TIME_KEY("cache_time");
+static const std::string RANGE_HEADER("Range");
+static const std::string IF_RANGE_HEADER("If-Range");
+static const std::string CONTENT_RANGE_HEADER("Content-Range");
+static const std::string ETAG_HEADER("ETag");
+static const std::string EXPIRES_HEADER("Expires");
+static const std::string RANGES_SUFFIX(".ranges");
+static const size_t OPEN_ENDED_RANGE = std::numeric_limits<size_t>::max();
+static const std::chrono::seconds PRUNE_INTERVAL(50);
+
+static std::string headerValue(const std::unordered_map<std::string, std::string> &headers,
+                               const std::string &header_name) {
+  for (const auto &header : headers) {
+    if (header.first.size() == header_name.size() &&
+        std::equal(
+            header.first.begin(), header.first.end(), header_name.begin(), [](char a, char b) {
+              return tolower(a) == tolower(b);
+            })) {
+      return header.second;
+    }
+  }
+  return "";
+}
+
+static bool isNegativeResponse(const std::shared_ptr<Response> &response) {
+  return response->statusCode() >= StatusCodeBadRequest;
+}
+
+static bool hasExplicitFreshness(const std::shared_ptr<Response> &response) {
+  return response->cacheControl().max_age > 0 ||
+         !headerValue(response->headerMap(), EXPIRES_HEADER).empty();
+}
 }  // namespace
 
 CachingClient::CachingClient(const std::shared_ptr<Client> &client,
-                             const std::string &cache_location)
+                             const std::string &cache_location,
+                             const std::shared_ptr<RequestObserver> &request_observer)
     : _client(client),
-      _cache_location(cache_location.back() == '/' ? cache_location : cache_location + "/") {}
+      _cache_location(cache_location.back() == '/' ? cache_location : cache_location + "/"),
+      _shutdown_prune_thread(false),
+      _metrics(std::make_shared<LayerMetrics>()),
+      _cache_hits(0),
+      _cache_misses(0),
+      _cache_revalidations(0),
+      _cache_evictions(0),
+      _negative_cache_time(0),
+      _request_observer(request_observer),
+      _lookup_pool(std::make_shared<WorkerPool>(LOOKUP_THREAD_COUNT)) {}
 
 CachingClient::~CachingClient() {
-  _shutdown_prune_thread = true;
-  _prune_thread.join();
+  {
+    std::lock_guard<std::mutex> prune_lock(_prune_mutex);
+    _shutdown_prune_thread = true;
+  }
+  _prune_condition.notify_one();
+  if (_prune_thread.joinable()) {
+    _prune_thread.join();
+  }
 }
 
 void CachingClient::requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) {
-  if (auto token = _tokens[request_token].lock()) {
-    token->cancel();
+  std::vector<std::weak_ptr<RequestToken>> wrapped_tokens;
+  {
+    std::lock_guard<std::mutex> lock(_wrapped_tokens_mutex);
+    auto wrapped_tokens_it = _wrapped_tokens.find(request_token);
+    if (wrapped_tokens_it == _wrapped_tokens.end()) {
+      return;
+    }
+    wrapped_tokens = wrapped_tokens_it->second;
+  }
+  // The wrapped client may answer a cancellation straight away, so no lock is held here
+  for (const auto &weak_token : wrapped_tokens) {
+    if (auto token = weak_token.lock()) {
+      token->cancel();
+    }
   }
 }
 
 void CachingClient::deleteDatabaseFile(const std::string &header_hash) {
-  remove((_cache_location + header_hash).c_str());
+  incrementCounter(_cache_evictions);
+  remove(databaseFilePath(header_hash).c_str());
+}
+
+std::string CachingClient::databaseFilePath(const std::string &header_hash) {
+  return _cache_location + header_hash;
 }
 
 std::shared_ptr<RequestToken> CachingClient::performRequest(
     const std::shared_ptr<Request> &request,
     std::function<void(const std::shared_ptr<Response> &)> callback) {
+  callback = LayerMetrics::trackRequest(_metrics, callback);
+
+  // Requests we never cache are passed straight through, without copying their bodies
+  if (!shouldCacheRequest(request)) {
+    return _client->performRequest(request, callback);
+  }
+
   std::shared_ptr<Request> new_request = std::make_shared<RequestImplementation>(*request.get());
-  std::string request_hash = new_request->hash();
+  std::shared_ptr<RequestToken> request_token =
+      std::make_shared<RequestTokenImplementation>(shared_from_this(), new_request->hash());
 
-  std::shared_ptr<RequestToken> request_token = nullptr;
-  if (!shouldCacheRequest(new_request)) {
-    request_token = _client->performRequest(new_request, callback);
+  // The lookup is handed to the pool, so the caller gets its token without touching the disk
+  std::weak_ptr<CachingClient> weak_this = shared_from_this();
+  _lookup_pool->enqueue([weak_this, new_request, request_token, callback] {
+    auto strong_this = weak_this.lock();
+    if (!strong_this || request_token->cancelled()) {
+      callback(std::make_shared<ResponseImplementation>(
+          new_request, nullptr, 0, StatusCodeInvalid, true));
+      return;
+    }
+    strong_this->performCachedRequest(new_request, request_token, callback);
+  });
+  return request_token;
+}
+
+void CachingClient::performCachedRequest(
+    const std::shared_ptr<Request> &new_request,
+    const std::shared_ptr<RequestToken> &request_token,
+    std::function<void(const std::shared_ptr<Response> &)> callback) {
+  std::string request_hash = request_token->identifier();
+  size_t range_start = 0;
+  size_t range_end = 0;
+  if (rangeForRequest(new_request, range_start, range_end)) {
+    performRangeRequest(new_request, request_token, range_start, range_end, callback);
   } else {
-    request_token = std::make_shared<RequestTokenImplementation>(shared_from_this(), request_hash);
+    const TIMING_POINT start_time = timingNow();
+    notifyRequestObserver(_request_observer, RequestEventCacheLookupStarted, request_hash);
     _database->fetchItemForRequest(
         request_hash,
-        [request_token, callback, new_request, this](CachingDatabase::ErrorCode code,
-                                                     const CacheItem &item) {
+        [request_token, callback, new_request, start_time, request_hash, this](
+            CachingDatabase::ErrorCode code, const CacheItem &item) {
+          notifyRequestObserver(_request_observer, RequestEventCacheLookupFinished, request_hash);
+          // Time spent in the cache is the lookup plus any store once the response comes back
+          const double lookup_time = secondsSince(start_time);
           if (request_token->cancelled()) {
             std::shared_ptr<Response> cancelled_response = std::make_shared<ResponseImplementation>(
                 new_request, nullptr, 0, StatusCodeInvalid, true);
@@ -84,55 +190,40 @@ std::shared_ptr<RequestToken> CachingClient::performRequest(
           // Possible problem here when cancel is called after this, we need to
           // do this atomically
 
-          auto wrapped_callback = [callback, item, this, request_token](
+          auto wrapped_callback = [callback, item, lookup_time, this, request_token](
                                       const std::shared_ptr<Response> &response) {
-            Response::CacheControl cache_control = response->cacheControl();
-            if (cache_control.no_store || cache_control.no_cache) {
+            const TIMING_POINT store_start_time = timingNow();
+            auto timed_callback = [callback, lookup_time, store_start_time](
+                                      const std::shared_ptr<Response> &response) {
+              response->setMetadata(CACHE_TIME_KEY,
+                                    timingString(lookup_time + secondsSince(store_start_time)));
               callback(response);
+            };
+            Response::CacheControl cache_control = response->cacheControl();
+            if (shouldCacheResponse(response)) {
+              storeResponse(response, item, timed_callback);
+            } else if (response->statusCode() == StatusCodeNotModified && !cache_control.no_store &&
+                       !cache_control.no_cache) {
+              _database->storeResponse(
+                  responseFromCacheItem(item, response, response->request()->downloadPath()),
+                  [timed_callback](CachingDatabase::ErrorCode code,
+                                   const std::shared_ptr<Response> &response) {
+                    timed_callback(response);
+                  });
             } else {
-              switch (response->statusCode()) {
-                case StatusCodeOK:
-                case StatusCodeCreated:
-                case StatusCodeAccepted:
-                case StatusCodeNonAuthoritiveInformation:
-                case StatusCodeNoContent:
-                case StatusCodeResetContent:
-                case StatusCodePartialContent:
-                  _database->storeResponse(
-                      response,
-                      [callback, item, this](CachingDatabase::ErrorCode code,
-                                             const std::shared_ptr<Response> &response) {
-                        // Write the cached file back to disk
-                        std::string filename =
-                            item.valid ? item.payload_filename : response->request()->hash();
-                        FILE *cache_file = fopen((_cache_location + filename).c_str(), "w");
-                        size_t data_length = 0;
-                        const unsigned char *data = response->data(data_length);
-                        fwrite(data, data_length, 1, cache_file);
-                        fclose(cache_file);
-                        callback(response);
-                      });
-                  break;
-                case StatusCodeNotModified:
-                  _database->storeResponse(responseFromCacheItem(item, response),
-                                           [callback](CachingDatabase::ErrorCode code,
-                                                      const std::shared_ptr<Response> &response) {
-                                             callback(response);
-                                           });
-                  break;
-                default:
-                  callback(response);
-                  break;
-              }
+              timed_callback(response);
             }
-            _tokens.erase(request_token);
+            removeWrappedTokens(request_token);
           };
 
           // Should we only contact the cache?
           if (item.valid) {
             Request::CacheControl cache_control = new_request->cacheControl();
-            std::shared_ptr<Response> response = responseFromCacheItem(item);
+            std::shared_ptr<Response> response =
+                responseFromCacheItem(item, nullptr, new_request->downloadPath());
             if (cache_control.only_if_cached) {
+              incrementCounter(_cache_hits);
+              response->setMetadata(CACHE_TIME_KEY, timingString(secondsSince(start_time)));
               callback(response);
               return;
             }
@@ -142,50 +233,57 @@ std::shared_ptr<RequestToken> CachingClient::performRequest(
             std::time_t result = std::time(nullptr);
             bool expired = difftime(result, item.expiry_time) > cache_control.max_stale;
             if (expired || response_cache_control.must_revalidate) {
+              incrementCounter(_cache_revalidations);
               // If it has expired, lets add some extra caching headers
               if (item.etag.length() > 0) {
                 (*new_request)["If-None-Match"] = item.etag;
               } else if (item.last_modified != 0) {
-                auto tm = *std::localtime(&item.last_modified);
-                std::ostringstream output_string_stream;
+                auto tm = *std::gmtime(&item.last_modified);
                 // TODO: Replace the following with std::put_time when we move to gcc >= 5
-                char mod_time[24];
-                strftime(mod_time, sizeof(mod_time), "%d-%m-%Y %H-%M-%S", &tm);
+                char mod_time[32];
+                strftime(mod_time, sizeof(mod_time), "%a, %d %b %Y %H:%M:%S GMT", &tm);
                 // END OF TODO
-                // output_string_stream << std::put_time(&tm, "%d-%m-%Y %H-%M-%S");
-                (*new_request)["If-Modified-Since"] = output_string_stream.str();
+                (*new_request)["If-Modified-Since"] = mod_time;
               }
-              _tokens[request_token] = _client->performRequest(new_request, wrapped_callback);
+              expectWrappedTokens(request_token);
+              setWrappedTokens(request_token,
+                               {_client->performRequest(new_request, wrapped_callback)});
               return;
             } else {
+              incrementCounter(_cache_hits);
+              response->setMetadata(CACHE_TIME_KEY, timingString(secondsSince(start_time)));
               callback(response);
-              _tokens.erase(request_token);
               return;
             }
           }
 
-          _tokens[request_token] = _client->performRequest(new_request, wrapped_callback);
+          incrementCounter(_cache_misses);
+          expectWrappedTokens(request_token);
+          setWrappedTokens(request_token, {_client->performRequest(new_request, wrapped_callback)});
         });
   }
-  return request_token;
 }
 
 void CachingClient::pinResponse(const std::shared_ptr<Response> &response,
                                 const std::string &pin_identifier) {
-  _database->fetchItemForRequest(
-      response->request()->hash(),
-      [this, pin_identifier](CachingDatabase::ErrorCode error_code, const CacheItem &item) {
-        _database->pinItem(item, pin_identifier);
-      });
+  _database->pinItems({response->request()->hash()}, pin_identifier);
 }
 
 void CachingClient::unpinResponse(const std::shared_ptr<Response> &response,
                                   const std::string &pin_identifier) {
-  _database->fetchItemForRequest(
-      response->request()->hash(),
-      [this, pin_identifier](CachingDatabase::ErrorCode error_code, const CacheItem &item) {
-        _database->unpinItem(item, pin_identifier);
-      });
+  _database->unpinItems({response->request()->hash()}, pin_identifier);
+}
+
+void CachingClient::pinRequestHashes(const std::vector<std::string> &request_hashes,
+                                     const std::string &pin_identifier,
+                                     std::function<void(size_t pinned_bytes)> callback) {
+  callback(_database->pinItems(request_hashes, pin_identifier));
+}
+
+void CachingClient::unpinRequestHashes(const std::vector<std::string> &request_hashes,
+                                       const std::string &pin_identifier,
+                                       std::function<void(size_t unpinned_bytes)> callback) {
+  callback(_database->unpinItems(request_hashes, pin_identifier));
 }
 
 void CachingClient::removePinnedResponseForIdentifier(const std::string &pin_identifier) {
@@ -210,19 +308,167 @@ void CachingClient::pinningIdentifiers(
   _database->pinningIdentifiers(callback);
 }
 
-void CachingClient::pruneThread(CachingClient *client) {
-  int counter = 0;
-  while (!client->_shutdown_prune_thread) {
-    std::this_thread::sleep_for(std::chrono::milliseconds(1));
-    if (counter++ == 50000) {
-      client->_database->prune();
-      counter = 0;
+void CachingClient::prefetchRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::string &pin_identifier,
+    std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback) {
+  struct Prefetch {
+    std::mutex mutex;
+    size_t lookups_remaining;
+    size_t completed;
+    size_t bytes;
+    std::vector<std::shared_ptr<Request>> requests;
+    std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
+  };
+  const size_t total = requests.size();
+  if (total == 0) {
+    if (progress_callback) {
+      progress_callback(0, 0, 0);
+    }
+    return;
+  }
+  auto prefetch = std::make_shared<Prefetch>();
+  prefetch->lookups_remaining = total;
+  prefetch->completed = 0;
+  prefetch->bytes = 0;
+  auto report_progress = [prefetch, total, progress_callback](size_t bytes) {
+    size_t completed = 0;
+    size_t total_bytes = 0;
+    {
+      std::lock_guard<std::mutex> lock(prefetch->mutex);
+      completed = ++prefetch->completed;
+      total_bytes = prefetch->bytes += bytes;
     }
+    if (progress_callback) {
+      progress_callback(completed, total, total_bytes);
+    }
+  };
+  // Once every cache lookup is done, the misses are sent to the network as one batch
+  auto lookup_finished = [prefetch, this](
+                             const std::shared_ptr<Request> &request,
+                             std::function<void(const std::shared_ptr<Response> &)> callback) {
+    std::vector<std::shared_ptr<Request>> fetch_requests;
+    std::vector<std::function<void(const std::shared_ptr<Response> &)>> fetch_callbacks;
+    {
+      std::lock_guard<std::mutex> lock(prefetch->mutex);
+      if (request) {
+        prefetch->requests.push_back(request);
+        prefetch->callbacks.push_back(callback);
+      }
+      if (--prefetch->lookups_remaining != 0) {
+        return;
+      }
+      fetch_requests.swap(prefetch->requests);
+      fetch_callbacks.swap(prefetch->callbacks);
+    }
+    if (!fetch_requests.empty()) {
+      _client->performRequests(fetch_requests, fetch_callbacks);
+    }
+  };
+
+  for (const auto &request : requests) {
+    std::shared_ptr<Request> new_request = std::make_shared<RequestImplementation>(*request.get());
+    new_request->setPriority(RequestPriorityLow);
+    if (!shouldCacheRequest(new_request)) {
+      report_progress(0);
+      lookup_finished(nullptr, nullptr);
+      continue;
+    }
+    size_t range_start = 0;
+    size_t range_end = 0;
+    if (rangeForRequest(new_request, range_start, range_end)) {
+      // Byte ranges are stored as segments of their resource rather than as responses
+      performRangeRequest(
+          new_request,
+          std::make_shared<RequestTokenImplementation>(shared_from_this(), new_request->hash()),
+          range_start,
+          range_end,
+          [report_progress](const std::shared_ptr<Response> &response) {
+            report_progress(
+                response->statusCode() == StatusCodePartialContent ? response->dataLength() : 0);
+          });
+      lookup_finished(nullptr, nullptr);
+      continue;
+    }
+    _database->fetchItemForRequest(
+        new_request->hash(),
+        [this, new_request, pin_identifier, report_progress, lookup_finished](
+            CachingDatabase::ErrorCode code, const CacheItem &item) {
+          // Items that are already fresh in the cache only need pinning
+          if (item.valid && difftime(std::time(nullptr), item.expiry_time) <= 0) {
+            if (!pin_identifier.empty()) {
+              _database->pinItem(item, pin_identifier);
+            }
+            report_progress(0);
+            lookup_finished(nullptr, nullptr);
+            return;
+          }
+          lookup_finished(new_request,
+                          [this, item, pin_identifier, report_progress](
+                              const std::shared_ptr<Response> &response) {
+                            if (!shouldCacheResponse(response)) {
+                              report_progress(0);
+                              return;
+                            }
+                            const size_t data_length = response->dataLength();
+                            storeResponse(response,
+                                          item,
+                                          [this, pin_identifier, report_progress, data_length](
+                                              const std::shared_ptr<Response> &response) {
+                                            if (!pin_identifier.empty()) {
+                                              pinResponse(response, pin_identifier);
+                                            }
+                                            report_progress(data_length);
+                                          });
+                          });
+        });
+  }
+}
+
+Statistics CachingClient::stats() const {
+  Statistics statistics = _client->stats();
+  statistics.caching = _metrics->statistics();
+  statistics.cache_hits = counterValue(_cache_hits);
+  statistics.cache_misses = counterValue(_cache_misses);
+  statistics.cache_revalidations = counterValue(_cache_revalidations);
+  statistics.cache_evictions = counterValue(_cache_evictions);
+  if (_database) {
+    _database->addStatistics(statistics);
+  }
+  return statistics;
+}
+
+void CachingClient::pruneThread(CachingClient *client) {
+  std::unique_lock<std::mutex> prune_lock(client->_prune_mutex);
+  while (!client->_prune_condition.wait_for(
+      prune_lock, PRUNE_INTERVAL, [client] { return client->_shutdown_prune_thread.load(); })) {
+    prune_lock.unlock();
+    client->_database->prune();
+    prune_lock.lock();
   }
 }
 
 const std::shared_ptr<Response> CachingClient::responseFromCacheItem(
-    const CacheItem &item, const std::shared_ptr<Response> &response) const {
+    const CacheItem &item,
+    const std::shared_ptr<Response> &response,
+    const std::string &download_path) const {
+  // Downloads get a copy of the cached file rather than its contents in memory
+  const std::string cache_path = _cache_location + item.payload_filename;
+  if (!download_path.empty() && item.valid && copyDownloadFile(cache_path, download_path)) {
+    const std::shared_ptr<ResponseImplementation> output_response =
+        std::make_shared<ResponseImplementation>(item.response, nullptr, 0, response);
+    FILE *download_file = fopen(download_path.c_str(), "rb");
+    size_t data_length = 0;
+    if (download_file != nullptr) {
+      fseek(download_file, 0, SEEK_END);
+      data_length = ftell(download_file);
+      fclose(download_file);
+    }
+    output_response->setDataPath(download_path, data_length);
+    output_response->setMetadata(CACHED_KEY, "1");
+    return output_response;
+  }
+
   FILE *cache_file = fopen((_cache_location + item.payload_filename).c_str(), "r");
   size_t data_length = 0;
   unsigned char *data = NULL;
@@ -245,12 +491,88 @@ const std::shared_ptr<Response> CachingClient::responseFromCacheItem(
   return output_response;
 }
 
+void CachingClient::storeResponse(const std::shared_ptr<Response> &response,
+                                  const CacheItem &item,
+                                  std::function<void(const std::shared_ptr<Response> &)> callback) {
+  if (isNegativeResponse(response)) {
+    // Negative entries are only a row, so drop any payload left over from an earlier response
+    const std::string filename = item.valid ? item.payload_filename : response->request()->hash();
+    remove((_cache_location + filename).c_str());
+    _database->storeNegativeResponse(
+        response,
+        _negative_cache_time,
+        [callback](CachingDatabase::ErrorCode code, const std::shared_ptr<Response> &response) {
+          callback(response);
+        });
+    return;
+  }
+  _database->storeResponse(response,
+                           [callback, item, this](CachingDatabase::ErrorCode code,
+                                                  const std::shared_ptr<Response> &response) {
+                             // Write the cached file back to disk
+                             std::string filename =
+                                 item.valid ? item.payload_filename : response->request()->hash();
+                             const std::string data_path = response->dataPath();
+                             if (!data_path.empty()) {
+                               // Downloads are already on disk, so link them into the cache where
+                               // possible and only copy them when we have to
+                               const std::string cache_path = _cache_location + filename;
+                               remove(cache_path.c_str());
+                               bool linked = false;
+#if !_WIN32
+                               linked = link(data_path.c_str(), cache_path.c_str()) == 0;
+#endif
+                               if (!linked) {
+                                 copyDownloadFile(data_path, cache_path);
+                               }
+                               callback(response);
+                               return;
+                             }
+                             FILE *cache_file = fopen((_cache_location + filename).c_str(), "w");
+                             if (cache_file != nullptr) {
+                               size_t data_length = 0;
+                               const unsigned char *data = response->data(data_length);
+                               fwrite(data, data_length, 1, cache_file);
+                               fclose(cache_file);
+                             }
+                             callback(response);
+                           });
+}
+
+bool CachingClient::shouldCacheResponse(const std::shared_ptr<Response> &response) {
+  Response::CacheControl cache_control = response->cacheControl();
+  if (cache_control.no_store || cache_control.no_cache) {
+    return false;
+  }
+
+  switch (response->statusCode()) {
+    case StatusCodeOK:
+    case StatusCodeCreated:
+    case StatusCodeAccepted:
+    case StatusCodeNonAuthoritiveInformation:
+    case StatusCodeNoContent:
+    case StatusCodeResetContent:
+      return true;
+    case StatusCodeNotFound:
+    case StatusCodeGone:
+      return _negative_cache_time > 0 || hasExplicitFreshness(response);
+    default:
+      // Other errors are only kept for as long as the server says they stay fresh
+      return isNegativeResponse(response) && hasExplicitFreshness(response);
+  }
+}
+
 bool CachingClient::shouldCacheRequest(const std::shared_ptr<Request> &request) {
   if (request->method() == PostMethod || request->method() == DeleteMethod ||
       request->method() == PutMethod) {
     return false;
   }
 
+  // Streamed bodies are uploads, which are never answered from the cache
+  if (!request->dataPath().empty() || request->dataProvider()) {
+    return false;
+  }
+
   Request::CacheControl cache_control = request->cacheControl();
   if (cache_control.no_cache || cache_control.no_store) {
     return false;
@@ -259,6 +581,350 @@ bool CachingClient::shouldCacheRequest(const std::shared_ptr<Request> &request)
   return true;
 }
 
+bool CachingClient::rangeForRequest(const std::shared_ptr<Request> &request,
+                                    size_t &start,
+                                    size_t &end) {
+  // Only a single "bytes=start-end" or "bytes=start-" range is served from the cache
+  const auto &header_map = request->headerMap();
+  auto range_iterator = header_map.find(RANGE_HEADER);
+  if (request->method() != GetMethod || range_iterator == header_map.end() ||
+      !request->downloadPath().empty()) {
+    return false;
+  }
+  const std::string &range = range_iterator->second;
+  static const std::string bytes_prefix("bytes=");
+  if (range.compare(0, bytes_prefix.size(), bytes_prefix) != 0 ||
+      range.find(',') != std::string::npos) {
+    return false;
+  }
+  const size_t separator = range.find('-', bytes_prefix.size());
+  if (separator == std::string::npos || separator == bytes_prefix.size()) {
+    return false;
+  }
+  char *parse_end = nullptr;
+  const std::string start_string =
+      range.substr(bytes_prefix.size(), separator - bytes_prefix.size());
+  start = std::strtoull(start_string.c_str(), &parse_end, 10);
+  if (*parse_end != '\0') {
+    return false;
+  }
+  const std::string end_string = range.substr(separator + 1);
+  if (end_string.empty()) {
+    end = OPEN_ENDED_RANGE;
+    return true;
+  }
+  end = std::strtoull(end_string.c_str(), &parse_end, 10);
+  return *parse_end == '\0' && end >= start;
+}
+
+std::string CachingClient::resourceIdentifierForRequest(const std::shared_ptr<Request> &request) {
+  std::shared_ptr<Request> resource_request =
+      std::make_shared<RequestImplementation>(*request.get());
+  resource_request->headerMap().erase(RANGE_HEADER);
+  resource_request->headerMap().erase(IF_RANGE_HEADER);
+  return resource_request->hash() + RANGES_SUFFIX;
+}
+
+void CachingClient::performRangeRequest(
+    const std::shared_ptr<Request> &request,
+    const std::shared_ptr<RequestToken> &request_token,
+    size_t start,
+    size_t end,
+    std::function<void(const std::shared_ptr<Response> &)> callback) {
+  const std::string resource_identifier = resourceIdentifierForRequest(request);
+  const TIMING_POINT start_time = timingNow();
+  notifyRequestObserver(_request_observer, RequestEventCacheLookupStarted, request);
+  _database->fetchRangesForResource(
+      resource_identifier,
+      [this, request, request_token, start, end, callback, resource_identifier, start_time](
+          CachingDatabase::ErrorCode code, const std::vector<CacheRange> &ranges) {
+        notifyRequestObserver(_request_observer, RequestEventCacheLookupFinished, request);
+        if (request_token->cancelled()) {
+          callback(std::make_shared<ResponseImplementation>(
+              request, nullptr, 0, StatusCodeInvalid, true));
+          return;
+        }
+        const size_t total_length = ranges.empty() ? 0 : ranges.front().total_length;
+        const size_t range_end = total_length == 0 ? end : std::min(end, total_length - 1);
+        if (range_end == OPEN_ENDED_RANGE || (total_length != 0 && start >= total_length)) {
+          incrementCounter(_cache_misses);
+          performUncachedRangeRequest(request, request_token, resource_identifier, callback);
+          return;
+        }
+        if (auto response =
+                responseFromCacheRanges(request, resource_identifier, start, range_end, ranges)) {
+          incrementCounter(_cache_hits);
+          response->setMetadata(CACHED_KEY, "1");
+          response->setMetadata(CACHE_TIME_KEY, timingString(secondsSince(start_time)));
+          callback(response);
+          return;
+        }
+
+        // Work out which parts of the range are missing from the cache
+        incrementCounter(_cache_misses);
+        std::vector<std::pair<size_t, size_t>> gaps;
+        size_t position = start;
+        for (const auto &range : ranges) {
+          if (range.end < position) {
+            continue;
+          }
+          if (range.start > range_end) {
+            break;
+          }
+          if (range.start > position) {
+            gaps.push_back(std::make_pair(position, range.start - 1));
+          }
+          position = range.end + 1;
+          if (position > range_end) {
+            break;
+          }
+        }
+        if (position <= range_end) {
+          gaps.push_back(std::make_pair(position, range_end));
+        }
+        if (gaps.empty()) {
+          performUncachedRangeRequest(request, request_token, resource_identifier, callback);
+          return;
+        }
+
+        // Fetch only the gaps, then serve the whole range from the merged segments
+        struct RangeFetch {
+          std::mutex mutex;
+          size_t remaining;
+          bool failed;
+          // A gap response that answers the request as it stands, used when it cannot be cached
+          std::shared_ptr<Response> direct_response;
+        };
+        auto fetch = std::make_shared<RangeFetch>();
+        fetch->remaining = gaps.size();
+        fetch->failed = false;
+        const std::string etag = ranges.empty() ? "" : ranges.front().etag;
+        std::vector<std::shared_ptr<Request>> gap_requests;
+        std::vector<std::function<void(const std::shared_ptr<Response> &)>> gap_callbacks;
+        for (const auto &gap : gaps) {
+          std::shared_ptr<Request> gap_request =
+              std::make_shared<RequestImplementation>(*request.get());
+          (*gap_request)[RANGE_HEADER] =
+              "bytes=" + std::to_string(gap.first) + "-" + std::to_string(gap.second);
+          if (!etag.empty() && etag.compare(0, 2, "W/") != 0) {
+            (*gap_request)[IF_RANGE_HEADER] = etag;
+          }
+          gap_requests.push_back(gap_request);
+          gap_callbacks.push_back([this,
+                                   fetch,
+                                   request,
+                                   request_token,
+                                   start,
+                                   range_end,
+                                   gap,
+                                   callback,
+                                   resource_identifier](const std::shared_ptr<Response> &response) {
+            const bool stored = storeRangeResponse(resource_identifier, response);
+            {
+              std::lock_guard<std::mutex> lock(fetch->mutex);
+              fetch->failed = fetch->failed || !stored;
+              // Errors, full bodies from servers that ignore ranges and uncacheable answers to
+              // the whole range are as good as anything a second request would get
+              const StatusCode status_code = response->statusCode();
+              const bool whole_range = gap.first == start && gap.second == range_end;
+              if (!stored && !fetch->direct_response &&
+                  (status_code == StatusCodeInvalid || status_code >= 400 ||
+                   status_code == StatusCodeOK ||
+                   (status_code == StatusCodePartialContent && whole_range))) {
+                fetch->direct_response = response;
+              }
+              if (--fetch->remaining != 0) {
+                return;
+              }
+            }
+            if (request_token->cancelled()) {
+              callback(std::make_shared<ResponseImplementation>(
+                  request, nullptr, 0, StatusCodeInvalid, true));
+              removeWrappedTokens(request_token);
+              return;
+            }
+            std::shared_ptr<Response> output_response = nullptr;
+            if (!fetch->failed) {
+              _database->fetchRangesForResource(
+                  resource_identifier,
+                  [&](CachingDatabase::ErrorCode code, const std::vector<CacheRange> &ranges) {
+                    output_response = responseFromCacheRanges(
+                        request, resource_identifier, start, range_end, ranges);
+                  });
+            }
+            if (!output_response && fetch->direct_response) {
+              output_response = fetch->direct_response;
+            }
+            if (!output_response) {
+              // The cached segments no longer fit together, so ask for the range directly
+              performUncachedRangeRequest(request, request_token, resource_identifier, callback);
+              return;
+            }
+            callback(output_response);
+            removeWrappedTokens(request_token);
+          });
+        }
+        expectWrappedTokens(request_token);
+        setWrappedTokens(request_token, _client->performRequests(gap_requests, gap_callbacks));
+      });
+}
+
+void CachingClient::performUncachedRangeRequest(
+    const std::shared_ptr<Request> &request,
+    const std::shared_ptr<RequestToken> &request_token,
+    const std::string &resource_identifier,
+    std::function<void(const std::shared_ptr<Response> &)> callback) {
+  expectWrappedTokens(request_token);
+  auto token = _client->performRequest(request,
+                                       [this, request_token, resource_identifier, callback](
+                                           const std::shared_ptr<Response> &response) {
+                                         storeRangeResponse(resource_identifier, response);
+                                         callback(response);
+                                         removeWrappedTokens(request_token);
+                                       });
+  setWrappedTokens(request_token, {token});
+}
+
+const std::shared_ptr<Response> CachingClient::responseFromCacheRanges(
+    const std::shared_ptr<Request> &request,
+    const std::string &resource_identifier,
+    size_t start,
+    size_t end,
+    const std::vector<CacheRange> &ranges) {
+  // Merged segments never overlap, so a cached range must sit entirely inside one of them
+  auto range_iterator =
+      std::find_if(ranges.begin(), ranges.end(), [start, end](const CacheRange &range) {
+        return range.start <= start && range.end >= end;
+      });
+  if (range_iterator == ranges.end()) {
+    return nullptr;
+  }
+  const size_t data_length = end - start + 1;
+  std::vector<unsigned char> data(data_length);
+  {
+    std::lock_guard<std::mutex> lock(_ranges_mutex);
+    FILE *cache_file = fopen((_cache_location + resource_identifier).c_str(), "rb");
+    if (cache_file == nullptr) {
+      return nullptr;
+    }
+    const bool read = fseek(cache_file, start, SEEK_SET) == 0 &&
+                      fread(data.data(), data_length, 1, cache_file) == 1;
+    fclose(cache_file);
+    if (!read) {
+      return nullptr;
+    }
+  }
+  std::shared_ptr<Response> response = std::make_shared<ResponseImplementation>(
+      request, data.data(), data_length, StatusCodePartialContent, false);
+  (*response)[CONTENT_RANGE_HEADER] =
+      "bytes " + std::to_string(start) + "-" + std::to_string(end) + "/" +
+      (range_iterator->total_length == 0 ? "*" : std::to_string(range_iterator->total_length));
+  (*response)["Content-Length"] = std::to_string(data_length);
+  if (!range_iterator->etag.empty()) {
+    (*response)[ETAG_HEADER] = range_iterator->etag;
+  }
+  return response;
+}
+
+bool CachingClient::storeRangeResponse(const std::string &resource_identifier,
+                                       const std::shared_ptr<Response> &response) {
+  Response::CacheControl cache_control = response->cacheControl();
+  if (response->cancelled() || response->statusCode() != StatusCodePartialContent ||
+      cache_control.no_store || cache_control.no_cache) {
+    return false;
+  }
+
+  // Content-Range: bytes <start>-<end>/<total or *>
+  const auto &header_map = response->headerMap();
+  const std::string content_range = headerValue(header_map, CONTENT_RANGE_HEADER);
+  unsigned long long start = 0;
+  unsigned long long end = 0;
+  unsigned long long total_length = 0;
+  if (sscanf(content_range.c_str(), "bytes %llu-%llu/%llu", &start, &end, &total_length) < 2 ||
+      end < start) {
+    return false;
+  }
+  const size_t data_length = response->dataLength();
+  if (data_length != end - start + 1) {
+    return false;
+  }
+  const std::string data_path = response->dataPath();
+
+  // Write the segment into the sparse payload file for the whole resource
+  {
+    std::lock_guard<std::mutex> lock(_ranges_mutex);
+    const std::string filename = _cache_location + resource_identifier;
+    FILE *cache_file = fopen(filename.c_str(), "r+b");
+    if (cache_file == nullptr) {
+      cache_file = fopen(filename.c_str(), "w+b");
+    }
+    if (cache_file == nullptr) {
+      return false;
+    }
+    bool written = fseek(cache_file, start, SEEK_SET) == 0;
+    if (written && !data_path.empty()) {
+      // Downloaded segments stay on disk, so copy them across without reading them into memory
+      written = copyFileContents(data_path, cache_file);
+    } else if (written) {
+      size_t length = 0;
+      const unsigned char *data = response->data(length);
+      written = fwrite(data, data_length, 1, cache_file) == 1;
+    }
+    fclose(cache_file);
+    if (!written) {
+      return false;
+    }
+  }
+  _database->storeRange(resource_identifier,
+                        {static_cast<size_t>(start),
+                         static_cast<size_t>(end),
+                         static_cast<size_t>(total_length),
+                         headerValue(header_map, ETAG_HEADER)},
+                        response);
+  return true;
+}
+
+void CachingClient::expectWrappedTokens(const std::shared_ptr<RequestToken> &request_token) {
+  std::lock_guard<std::mutex> lock(_wrapped_tokens_mutex);
+  _wrapped_tokens[request_token].clear();
+}
+
+void CachingClient::setWrappedTokens(
+    const std::shared_ptr<RequestToken> &request_token,
+    const std::vector<std::shared_ptr<RequestToken>> &wrapped_tokens) {
+  std::lock_guard<std::mutex> lock(_wrapped_tokens_mutex);
+  // The wrapped requests may already have finished, in which case there is nothing to track
+  auto wrapped_tokens_it = _wrapped_tokens.find(request_token);
+  if (wrapped_tokens_it != _wrapped_tokens.end()) {
+    wrapped_tokens_it->second.assign(wrapped_tokens.begin(), wrapped_tokens.end());
+  }
+}
+
+void CachingClient::removeWrappedTokens(const std::shared_ptr<RequestToken> &request_token) {
+  std::lock_guard<std::mutex> lock(_wrapped_tokens_mutex);
+  _wrapped_tokens.erase(request_token);
+}
+
+void CachingClient::setNegativeCacheTime(std::chrono::seconds time) {
+  _negative_cache_time = time.count();
+}
+
+bool CachingClient::exportCache(const std::string &archive_path) {
+  return _database->exportSnapshot(archive_path);
+}
+
+bool CachingClient::importCache(const std::string &archive_path) {
+  return _database->importSnapshot(archive_path);
+}
+
+void CachingClient::process(EVENT_LOOP_SOCKET socket, int events) {
+  _client->process(socket, events);
+}
+
+void CachingClient::onTimeout() {
+  _client->onTimeout();
+}
+
 void CachingClient::initialise() {
   _database = createCachingDatabase(_cache_location, "sqlite", shared_from_this());
   _prune_thread = std::thread(pruneThread, this);
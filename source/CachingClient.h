@@ -23,22 +23,31 @@
 #include <NFHTTP/Client.h>
 
 #include <atomic>
+#include <condition_variable>
 #include <memory>
+#include <mutex>
 #include <thread>
 #include <unordered_map>
 
 #include "CachingDatabase.h"
+#include "Metrics.h"
 #include "RequestTokenDelegate.h"
+#include "WorkerPool.h"
 
 namespace nativeformat {
 namespace http {
 
+// Cache lookups run on their own threads so performRequest never waits on the disk
+static const size_t LOOKUP_THREAD_COUNT = 4;
+
 class CachingClient : public Client,
                       public RequestTokenDelegate,
                       public std::enable_shared_from_this<CachingClient>,
                       public CachingDatabaseDelegate {
  public:
-  CachingClient(const std::shared_ptr<Client> &client, const std::string &cache_location);
+  CachingClient(const std::shared_ptr<Client> &client,
+                const std::string &cache_location,
+                const std::shared_ptr<RequestObserver> &request_observer = nullptr);
   virtual ~CachingClient();
 
   // RequestTokenDelegate
@@ -46,6 +55,7 @@ class CachingClient : public Client,
 
   // CachingDatabaseDelegate
   void deleteDatabaseFile(const std::string &header_hash) override;
+  std::string databaseFilePath(const std::string &header_hash) override;
 
   // Client
   std::shared_ptr<RequestToken> performRequest(
@@ -55,12 +65,28 @@ class CachingClient : public Client,
                    const std::string &pin_identifier) override;
   void unpinResponse(const std::shared_ptr<Response> &response,
                      const std::string &pin_identifier) override;
+  void pinRequestHashes(const std::vector<std::string> &request_hashes,
+                        const std::string &pin_identifier,
+                        std::function<void(size_t pinned_bytes)> callback) override;
+  void unpinRequestHashes(const std::vector<std::string> &request_hashes,
+                          const std::string &pin_identifier,
+                          std::function<void(size_t unpinned_bytes)> callback) override;
   void removePinnedResponseForIdentifier(const std::string &pin_identifier) override;
   void pinnedResponsesForIdentifier(
       const std::string &pin_identifier,
       std::function<void(const std::vector<std::shared_ptr<Response>> &)> callback) override;
   void pinningIdentifiers(
       std::function<void(const std::vector<std::string> &identifiers)> callback) override;
+  void prefetchRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::string &pin_identifier,
+      std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback) override;
+  Statistics stats() const override;
+  void setNegativeCacheTime(std::chrono::seconds time) override;
+  bool exportCache(const std::string &archive_path) override;
+  bool importCache(const std::string &archive_path) override;
+  void process(EVENT_LOOP_SOCKET socket, int events) override;
+  void onTimeout() override;
 
   void initialise();
 
@@ -68,16 +94,64 @@ class CachingClient : public Client,
   static void pruneThread(CachingClient *client);
 
   const std::shared_ptr<Response> responseFromCacheItem(
-      const CacheItem &item, const std::shared_ptr<Response> &response = nullptr) const;
+      const CacheItem &item,
+      const std::shared_ptr<Response> &response = nullptr,
+      const std::string &download_path = "") const;
+  void storeResponse(const std::shared_ptr<Response> &response,
+                     const CacheItem &item,
+                     std::function<void(const std::shared_ptr<Response> &)> callback);
+  bool shouldCacheResponse(const std::shared_ptr<Response> &response);
   bool shouldCacheRequest(const std::shared_ptr<Request> &request);
+  void performCachedRequest(const std::shared_ptr<Request> &request,
+                            const std::shared_ptr<RequestToken> &request_token,
+                            std::function<void(const std::shared_ptr<Response> &)> callback);
+
+  static bool rangeForRequest(const std::shared_ptr<Request> &request, size_t &start, size_t &end);
+  static std::string resourceIdentifierForRequest(const std::shared_ptr<Request> &request);
+  void performRangeRequest(const std::shared_ptr<Request> &request,
+                           const std::shared_ptr<RequestToken> &request_token,
+                           size_t start,
+                           size_t end,
+                           std::function<void(const std::shared_ptr<Response> &)> callback);
+  void performUncachedRangeRequest(const std::shared_ptr<Request> &request,
+                                   const std::shared_ptr<RequestToken> &request_token,
+                                   const std::string &resource_identifier,
+                                   std::function<void(const std::shared_ptr<Response> &)> callback);
+  const std::shared_ptr<Response> responseFromCacheRanges(const std::shared_ptr<Request> &request,
+                                                          const std::string &resource_identifier,
+                                                          size_t start,
+                                                          size_t end,
+                                                          const std::vector<CacheRange> &ranges);
+  bool storeRangeResponse(const std::string &resource_identifier,
+                          const std::shared_ptr<Response> &response);
+  void expectWrappedTokens(const std::shared_ptr<RequestToken> &request_token);
+  void setWrappedTokens(const std::shared_ptr<RequestToken> &request_token,
+                        const std::vector<std::shared_ptr<RequestToken>> &wrapped_tokens);
+  void removeWrappedTokens(const std::shared_ptr<RequestToken> &request_token);
 
   const std::shared_ptr<Client> _client;
   const std::string _cache_location;
   std::thread _prune_thread;
   std::shared_ptr<CachingDatabase> _database;
 
-  std::unordered_map<std::shared_ptr<RequestToken>, std::weak_ptr<RequestToken>> _tokens;
+  // The requests in the wrapped client that each of our tokens is waiting on
+  std::unordered_map<std::shared_ptr<RequestToken>, std::vector<std::weak_ptr<RequestToken>>>
+      _wrapped_tokens;
+  std::mutex _wrapped_tokens_mutex;
+  std::mutex _ranges_mutex;
   std::atomic<bool> _shutdown_prune_thread;
+  std::mutex _prune_mutex;
+  std::condition_variable _prune_condition;
+
+  const std::shared_ptr<LayerMetrics> _metrics;
+  std::atomic<uint64_t> _cache_hits;
+  std::atomic<uint64_t> _cache_misses;
+  std::atomic<uint64_t> _cache_revalidations;
+  std::atomic<uint64_t> _cache_evictions;
+  std::atomic<std::chrono::seconds::rep> _negative_cache_time;
+  const std::shared_ptr<RequestObserver> _request_observer;
+  // Declared last so that lookups still queued finish before anything else is torn down
+  const std::shared_ptr<WorkerPool> _lookup_pool;
 };
 
 }  // namespace http
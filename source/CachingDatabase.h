@@ -21,6 +21,7 @@
 #pragma once
 
 #include <NFHTTP/Response.h>
+#include <NFHTTP/Statistics.h>
 
 #include <ctime>
 #include <functional>
@@ -43,6 +44,13 @@ typedef struct CacheItem {
   const bool valid;
 } CacheItem;
 
+typedef struct CacheRange {
+  std::size_t start;
+  std::size_t end;
+  std::size_t total_length;
+  std::string etag;
+} CacheRange;
+
 class CachingDatabase {
  public:
   typedef enum : int { ErrorCodeNone } ErrorCode;
@@ -53,15 +61,39 @@ class CachingDatabase {
   virtual void storeResponse(
       const std::shared_ptr<Response> &response,
       std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) = 0;
+  // Stores an error response as a row without a payload, using default_max_age seconds when the
+  // response has no freshness of its own
+  virtual void storeNegativeResponse(
+      const std::shared_ptr<Response> &response,
+      long long default_max_age,
+      std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) = 0;
   virtual void prune() = 0;
   virtual void pinItem(const CacheItem &item, const std::string &pin_identifier) = 0;
   virtual void unpinItem(const CacheItem &item, const std::string &pin_identifier) = 0;
+  // Pins or unpins every stored item among the header hashes in one go, returning the size of
+  // their payloads. Items that are not stored are skipped
+  virtual size_t pinItems(const std::vector<std::string> &header_hashes,
+                          const std::string &pin_identifier) = 0;
+  virtual size_t unpinItems(const std::vector<std::string> &header_hashes,
+                            const std::string &pin_identifier) = 0;
   virtual void removePinnedItemsForIdentifier(const std::string &pin_identifier) = 0;
   virtual void pinnedItemsForIdentifier(
       const std::string &pin_identifier,
       std::function<void(const std::vector<CacheItem> &)> callback) = 0;
   virtual void pinningIdentifiers(
       std::function<void(const std::vector<std::string> &)> callback) = 0;
+  virtual void fetchRangesForResource(
+      const std::string &resource_identifier,
+      std::function<void(ErrorCode, const std::vector<CacheRange> &)> callback) = 0;
+  virtual void storeRange(const std::string &resource_identifier,
+                          const CacheRange &range,
+                          const std::shared_ptr<Response> &response) = 0;
+  virtual void addStatistics(Statistics &statistics) const = 0;
+  // A snapshot is a single archive of every stored response, its payload and its pins. It starts
+  // with the line "NFHTTP-CACHE 1", then the length of a JSON manifest on its own line, then the
+  // manifest, then each payload in the order the manifest lists them
+  virtual bool exportSnapshot(const std::string &archive_path) = 0;
+  virtual bool importSnapshot(const std::string &archive_path) = 0;
 };
 
 extern std::shared_ptr<CachingDatabase> createCachingDatabase(
@@ -20,6 +20,8 @@
  */
 #pragma once
 
+#include <string>
+
 namespace nativeformat {
 namespace http {
 
@@ -28,6 +30,7 @@ class CachingDatabase;
 class CachingDatabaseDelegate {
  public:
   virtual void deleteDatabaseFile(const std::string &header_hash) = 0;
+  virtual std::string databaseFilePath(const std::string &header_hash) = 0;
 };
 
 }  // namespace http
@@ -20,12 +20,19 @@
  */
 #include "CachingSQLiteDatabase.h"
 
+#include <algorithm>
+#include <cstdio>
 #include <iomanip>
 #include <iostream>
 #include <locale>
 #include <sstream>
 #include <vector>
 
+#include <nlohmann/json.hpp>
+
+#include "Metrics.h"
+#include "Timing.h"
+
 namespace nativeformat {
 namespace http {
 
@@ -47,18 +54,68 @@ static const std::string pinned_items_table_name("pinned_items");
 static const std::string pin_identifier_column_name("PIN_IDENTIFIER");
 static const std::string etag_header_name("ETag");
 static const std::string last_modified_header_name("Last-Modified");
+static const std::string ranges_table_name("ranges");
+static const std::string range_start_column_name("RANGE_START");
+static const std::string range_end_column_name("RANGE_END");
+static const std::string total_length_column_name("TOTAL_LENGTH");
 
 static const int maximum_cache_file_size = 524288000;  // 500 MB
+static const int busy_timeout_milliseconds = 5000;
+static const size_t minimum_index_capacity = 1024;
+static const std::string snapshot_magic("NFHTTP-CACHE 1");
+
+static const size_t header_hash_length = 64;
+static const std::string snapshot_temporary_suffix(".import");
+
+// Header hashes name payload files, so anything read from an archive must look like one
+static bool isHeaderHash(const std::string &header_hash) {
+  return header_hash.size() == header_hash_length &&
+         std::all_of(header_hash.begin(), header_hash.end(), [](char c) {
+           return (c >= '0' && c <= '9') || (c >= 'a' && c <= 'f');
+         });
+}
+
+static long fileSize(const std::string &path) {
+  FILE *file = fopen(path.c_str(), "rb");
+  if (file == nullptr) {
+    return -1;
+  }
+  fseek(file, 0, SEEK_END);
+  const long size = ftell(file);
+  fclose(file);
+  return size;
+}
+
+static bool copyFileBytes(FILE *source, FILE *destination, size_t length) {
+  char buffer[65536];
+  while (length > 0) {
+    const size_t chunk = std::min(length, sizeof(buffer));
+    if (fread(buffer, 1, chunk, source) != chunk ||
+        (destination != nullptr && fwrite(buffer, 1, chunk, destination) != chunk)) {
+      return false;
+    }
+    length -= chunk;
+  }
+  return true;
+}
 
 CachingSQLiteDatabase::CachingSQLiteDatabase(const std::string &cache_location,
                                              const std::weak_ptr<CachingDatabaseDelegate> &delegate)
-    : _delegate(delegate) {
-  int sqlite_error = sqlite3_open((cache_location + ".nfhttp").c_str(), &_sqlite_handle);
+    : _index_skipped_lookups(0), _index_build_seconds(0.0), _delegate(delegate) {
+  const std::string database_path = cache_location + ".nfhttp";
+  int sqlite_error =
+      sqlite3_open_v2(database_path.c_str(),
+                      &_sqlite_handle,
+                      SQLITE_OPEN_READWRITE | SQLITE_OPEN_CREATE | SQLITE_OPEN_NOMUTEX,
+                      nullptr);
   if (sqlite_error != SQLITE_OK) {
     printf("SQLite failed to open: %d\n", sqlite_error);
   } else {
+    sqlite3_busy_timeout(_sqlite_handle, busy_timeout_milliseconds);
+    // Write ahead logging lets the read connections run while the writer commits
+    std::string create_tables_query = "PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL;";
     // Create our tables
-    std::string create_tables_query =
+    create_tables_query +=
         "CREATE TABLE IF NOT EXISTS " + http_table_name + "(" + header_hash_column_name +
         " STRING PRIMARY KEY NOT NULL, " + expiry_column_name + " DATETIME NOT NULL, " +
         etag_column_name + " STRING, " + modified_column_name + " DATETIME NOT NULL, " +
@@ -70,16 +127,42 @@ CachingSQLiteDatabase::CachingSQLiteDatabase(const std::string &cache_location,
                            header_hash_column_name + ", " + pin_identifier_column_name +
                            "), FOREIGN KEY(" + header_hash_column_name + ") REFERENCES " +
                            http_table_name + "(" + header_hash_column_name + "));";
+    create_tables_query +=
+        "CREATE TABLE IF NOT EXISTS " + ranges_table_name + " (" + header_hash_column_name +
+        " STRING NOT NULL, " + range_start_column_name + " INT NOT NULL, " + range_end_column_name +
+        " INT NOT NULL, " + total_length_column_name + " INT NOT NULL, " + etag_column_name +
+        " STRING, " + expiry_column_name + " DATETIME NOT NULL, PRIMARY KEY(" +
+        header_hash_column_name + ", " + range_start_column_name + "));";
     char *error_message = nullptr;
     sqlite_error =
         sqlite3_exec(_sqlite_handle, create_tables_query.c_str(), nullptr, this, &error_message);
     if (sqlite_error != SQLITE_OK) {
       printf("Failed to create the tables: %d %s\n", sqlite_error, error_message);
+    } else {
+      buildIndex();
     }
+
+    // If these fail to open, reads share the writing connection instead
+    for (size_t i = 0; i < READ_CONNECTION_COUNT; ++i) {
+      sqlite3 *read_handle = nullptr;
+      sqlite_error = sqlite3_open_v2(
+          database_path.c_str(), &read_handle, SQLITE_OPEN_READONLY | SQLITE_OPEN_NOMUTEX, nullptr);
+      if (sqlite_error != SQLITE_OK) {
+        printf("SQLite failed to open a read connection: %d\n", sqlite_error);
+        sqlite3_close(read_handle);
+        break;
+      }
+      sqlite3_busy_timeout(read_handle, busy_timeout_milliseconds);
+      _read_handles.push_back(read_handle);
+    }
+    _free_read_handles = _read_handles;
   }
 }
 
 CachingSQLiteDatabase::~CachingSQLiteDatabase() {
+  for (sqlite3 *read_handle : _read_handles) {
+    sqlite3_close(read_handle);
+  }
   if (_sqlite_handle != nullptr) {
     sqlite3_close(_sqlite_handle);
   }
@@ -92,99 +175,151 @@ std::string CachingSQLiteDatabase::cachingType() const {
 void CachingSQLiteDatabase::fetchItemForRequest(
     const std::string &request_identifier,
     std::function<void(ErrorCode, const CacheItem &)> callback) {
-  bool executed = false;
-  caching_callback cache_function = [callback, this, &executed](
-                                        const std::unordered_map<std::string, std::string> &map) {
-    std::string header_hash = map.at(header_hash_column_name);
-    char *error_message = nullptr;
-    sqlite3_exec(_sqlite_handle,
-                 ("UPDATE " + http_table_name + " SET " + last_accessed_column_name +
-                  " = date('now') WHERE " + header_hash_column_name + " = '" + header_hash + "'")
-                     .c_str(),
-                 nullptr,
-                 nullptr,
-                 &error_message);
+  bool indexed = true;
+  {
+    std::lock_guard<std::mutex> index_lock(_index_mutex);
+    indexed = !_index || _index->mightContain(request_identifier);
+  }
+  if (!indexed) {
+    incrementCounter(_index_skipped_lookups);
+    const CacheItem cache_item = {0, 0, "", 0, "", "", false};
+    callback(ErrorCodeNone, cache_item);
+    return;
+  }
 
-    CacheItem item = {timeFromSQLDateTimeString(map.at(expiry_column_name)),
-                      timeFromSQLDateTimeString(map.at(modified_column_name)),
-                      map.at(etag_column_name),
-                      timeFromSQLDateTimeString(map.at(last_accessed_column_name)),
-                      map.at(response_serialised_column_name),
-                      map.at(header_hash_column_name),
-                      true};
-    callback(ErrorCodeNone, item);
-    executed = true;
-  };
+  bool executed = false;
+  std::unordered_map<std::string, std::string> item_map;
+  caching_callback cache_function =
+      [&item_map, &executed](const std::unordered_map<std::string, std::string> &map) {
+        item_map = map;
+        executed = true;
+      };
 
-  char *error_message = nullptr;
-  int error = sqlite3_exec(
-      _sqlite_handle,
-      ("SELECT " + header_hash_column_name + ", " + expiry_column_name + ", " + etag_column_name +
-       ", " + modified_column_name + ", " + response_serialised_column_name + ", " +
-       last_accessed_column_name + " FROM " + http_table_name + " WHERE " +
-       header_hash_column_name + " = '" + request_identifier + "'")
-          .c_str(),
-      &sqliteSelectHTTPCallback,
-      &cache_function,
-      &error_message);
+  int error = SQLITE_OK;
+  read([&](sqlite3 *sqlite_handle) {
+    char *error_message = nullptr;
+    error = sqlite3_exec(
+        sqlite_handle,
+        ("SELECT " + header_hash_column_name + ", " + expiry_column_name + ", " + etag_column_name +
+         ", " + modified_column_name + ", " + response_serialised_column_name + ", " +
+         last_accessed_column_name + " FROM " + http_table_name + " WHERE " +
+         header_hash_column_name + " = '" + request_identifier + "'")
+            .c_str(),
+        &sqliteSelectHTTPCallback,
+        &cache_function,
+        &error_message);
+  });
   if (error != SQLITE_OK || !executed) {
     const CacheItem cache_item = {0, 0, "", 0, "", "", false};
     callback((ErrorCode)error, cache_item);
+    return;
+  }
+
+  // The access time is only kept to the day, so the update can wait for the next write
+  {
+    std::lock_guard<std::mutex> accessed_items_lock(_accessed_items_mutex);
+    _accessed_items.insert(item_map.at(header_hash_column_name));
   }
+
+  CacheItem item = {timeFromSQLDateTimeString(item_map.at(expiry_column_name)),
+                    timeFromSQLDateTimeString(item_map.at(last_accessed_column_name)),
+                    item_map.at(etag_column_name),
+                    timeFromSQLDateTimeString(item_map.at(modified_column_name)),
+                    item_map.at(response_serialised_column_name),
+                    item_map.at(header_hash_column_name),
+                    true};
+  callback(ErrorCodeNone, item);
 }
 
 void CachingSQLiteDatabase::storeResponse(
     const std::shared_ptr<Response> &response,
     std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) {
-  bool executed = false;
-  caching_callback cache_function =
-      [callback, response, &executed](const std::unordered_map<std::string, std::string> &map) {
-        callback(ErrorCodeNone, response);
-        executed = true;
-      };
+  replaceResponse(response, 0, response->dataLength(), callback);
+}
 
+void CachingSQLiteDatabase::storeNegativeResponse(
+    const std::shared_ptr<Response> &response,
+    long long default_max_age,
+    std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) {
+  replaceResponse(response, default_max_age, 0, callback);
+}
+
+void CachingSQLiteDatabase::replaceResponse(
+    const std::shared_ptr<Response> &response,
+    long long default_max_age,
+    size_t data_length,
+    std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) {
   // Determine expiry time
   const auto &header_map = response->headerMap();
   Response::CacheControl cache_control = response->cacheControl();
-  std::string expiry_value =
-      "date('now', '+" + std::to_string(cache_control.max_age) + " seconds')";
-  if (cache_control.max_age == 0) {
+  long long max_age = cache_control.max_age;
+  std::string expiry_value;
+  if (max_age == 0) {
     // Perhaps we have an expires header
     if (header_map.find(expires_header_name) != header_map.end()) {
-      expiry_value = "date('" + header_map.at(expires_header_name) + "')";
+      const std::time_t expiry_time = timeFromHTTPDateString(header_map.at(expires_header_name));
+      if (expiry_time != 0) {
+        expiry_value = "datetime(" + std::to_string((long long)expiry_time) + ", 'unixepoch')";
+      }
     }
+    if (expiry_value.empty()) {
+      max_age = default_max_age;
+    }
+  }
+  if (expiry_value.empty()) {
+    expiry_value = "datetime('now', '+" + std::to_string(max_age) + " seconds')";
   }
 
   // Store response
-  size_t data_length = 0;
-  response->data(data_length);
   char *error_message = nullptr;
   std::string etag = "";
   if (header_map.find(etag_header_name) != header_map.end()) {
     etag = header_map.at(etag_header_name);
   }
-  std::string last_modified = "";
+  std::string last_modified = "''";
   if (header_map.find(last_modified_header_name) != header_map.end()) {
-    last_modified = header_map.at(last_modified_header_name);
+    const std::time_t last_modified_time =
+        timeFromHTTPDateString(header_map.at(last_modified_header_name));
+    if (last_modified_time != 0) {
+      last_modified =
+          "datetime(" + std::to_string((long long)last_modified_time) + ", 'unixepoch')";
+    }
   }
-  int error =
-      sqlite3_exec(_sqlite_handle,
-                   ("REPLACE INTO " + http_table_name + " (" + header_hash_column_name + ", " +
-                    expiry_column_name + ", " + etag_column_name + ", " + modified_column_name +
-                    ", " + response_serialised_column_name + ", " + last_accessed_column_name +
-                    ", " + file_size_column_name + ") VALUES ('" + response->request()->hash() +
-                    "', " + expiry_value + ", '" + etag + "', '" + last_modified + "', '" +
-                    response->serialise() + "', date('now'), " + std::to_string(data_length) + ");")
-                       .c_str(),
-                   &sqliteReplaceHTTPCallback,
-                   &cache_function,
-                   &error_message);
-  if (error != SQLITE_OK || !executed) {
-    callback((ErrorCode)error, response);
+  const std::string query = "REPLACE INTO " + http_table_name + " (" + header_hash_column_name +
+                            ", " + expiry_column_name + ", " + etag_column_name + ", " +
+                            modified_column_name + ", " + response_serialised_column_name + ", " +
+                            last_accessed_column_name + ", " + file_size_column_name +
+                            ") VALUES ('" + response->request()->hash() + "', " + expiry_value +
+                            ", '" + etag + "', " + last_modified + ", '" + response->serialise() +
+                            "', date('now'), " + std::to_string(data_length) + ");";
+  int error = SQLITE_OK;
+  {
+    std::lock_guard<std::mutex> write_lock(_write_mutex);
+    flushAccessedItems();
+    error = sqlite3_exec(_sqlite_handle, query.c_str(), nullptr, nullptr, &error_message);
+    if (error == SQLITE_OK) {
+      std::lock_guard<std::mutex> index_lock(_index_mutex);
+      if (_index) {
+        _index->insert(response->request()->hash());
+      }
+    }
   }
+  callback((ErrorCode)error, response);
 }
 
 void CachingSQLiteDatabase::prune() {
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
+  pruneRanges();
+  {
+    // Replacing a response adds its key again, so the index grows past the table over time
+    std::unique_lock<std::mutex> index_lock(_index_mutex);
+    if (_index && _index->size() > _index->capacity()) {
+      index_lock.unlock();
+      buildIndex();
+    }
+  }
+
   caching_callback cache_function = [this](
                                         const std::unordered_map<std::string, std::string> &map) {
     int current_size = std::stoi(map.at(current_size_virtual_column_name));
@@ -206,7 +341,8 @@ void CachingSQLiteDatabase::prune() {
                                           nullptr,
                                           nullptr,
                                           &error_message);
-            if (error_code == SQLITE_OK) {
+            if (error_code == SQLITE_OK && sqlite3_changes(_sqlite_handle) > 0) {
+              removeFromIndex(header_hash);
               if (auto delegate = _delegate.lock()) {
                 delegate->deleteDatabaseFile(header_hash);
               }
@@ -237,7 +373,8 @@ void CachingSQLiteDatabase::prune() {
                                    nullptr,
                                    nullptr,
                                    &error_message);
-                  if (error_code == SQLITE_OK) {
+                  if (error_code == SQLITE_OK && sqlite3_changes(_sqlite_handle) > 0) {
+                    removeFromIndex(header_hash);
                     if (auto delegate = _delegate.lock()) {
                       delegate->deleteDatabaseFile(header_hash);
                     }
@@ -280,6 +417,8 @@ void CachingSQLiteDatabase::prune() {
 }
 
 void CachingSQLiteDatabase::pinItem(const CacheItem &item, const std::string &pin_identifier) {
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
   char *error_message = nullptr;
   sqlite3_exec(_sqlite_handle,
                ("REPLACE INTO " + pinned_items_table_name + " (" + header_hash_column_name + ", " +
@@ -292,6 +431,8 @@ void CachingSQLiteDatabase::pinItem(const CacheItem &item, const std::string &pi
 }
 
 void CachingSQLiteDatabase::unpinItem(const CacheItem &item, const std::string &pin_identifier) {
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
   char *error_message = nullptr;
   sqlite3_exec(_sqlite_handle,
                ("DELETE FROM " + pinned_items_table_name + " WHERE " + header_hash_column_name +
@@ -303,7 +444,76 @@ void CachingSQLiteDatabase::unpinItem(const CacheItem &item, const std::string &
                &error_message);
 }
 
+size_t CachingSQLiteDatabase::pinItems(const std::vector<std::string> &header_hashes,
+                                       const std::string &pin_identifier) {
+  return changePins(header_hashes, pin_identifier, true);
+}
+
+size_t CachingSQLiteDatabase::unpinItems(const std::vector<std::string> &header_hashes,
+                                         const std::string &pin_identifier) {
+  return changePins(header_hashes, pin_identifier, false);
+}
+
+size_t CachingSQLiteDatabase::changePins(const std::vector<std::string> &header_hashes,
+                                         const std::string &pin_identifier,
+                                         bool pin) {
+  const std::unordered_set<std::string> unique_header_hashes(header_hashes.begin(),
+                                                             header_hashes.end());
+  const std::string pin_query =
+      pin ? "REPLACE INTO " + pinned_items_table_name + " (" + header_hash_column_name + ", " +
+                pin_identifier_column_name + ") VALUES (?, ?)"
+          : "DELETE FROM " + pinned_items_table_name + " WHERE " + header_hash_column_name +
+                " = ? AND " + pin_identifier_column_name + " = ?";
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
+  sqlite3_stmt *size_statement = nullptr;
+  sqlite3_stmt *pin_statement = nullptr;
+  bool changed =
+      sqlite3_exec(_sqlite_handle, "BEGIN TRANSACTION;", nullptr, nullptr, nullptr) == SQLITE_OK &&
+      sqlite3_prepare_v2(_sqlite_handle,
+                         ("SELECT " + file_size_column_name + " FROM " + http_table_name +
+                          " WHERE " + header_hash_column_name + " = ?")
+                             .c_str(),
+                         -1,
+                         &size_statement,
+                         nullptr) == SQLITE_OK &&
+      sqlite3_prepare_v2(_sqlite_handle, pin_query.c_str(), -1, &pin_statement, nullptr) ==
+          SQLITE_OK;
+  size_t changed_bytes = 0;
+  for (const auto &header_hash : unique_header_hashes) {
+    if (!changed) {
+      break;
+    }
+    sqlite3_bind_text(size_statement, 1, header_hash.c_str(), -1, SQLITE_TRANSIENT);
+    const int size_result = sqlite3_step(size_statement);
+    const bool stored = size_result == SQLITE_ROW;
+    const size_t file_size = stored ? sqlite3_column_int64(size_statement, 0) : 0;
+    sqlite3_reset(size_statement);
+    // Only stored items can be pinned, but pins left behind by evicted items can still be removed
+    if (size_result != SQLITE_ROW && size_result != SQLITE_DONE) {
+      changed = false;
+    } else if (stored || !pin) {
+      sqlite3_bind_text(pin_statement, 1, header_hash.c_str(), -1, SQLITE_TRANSIENT);
+      sqlite3_bind_text(pin_statement, 2, pin_identifier.c_str(), -1, SQLITE_TRANSIENT);
+      changed = sqlite3_step(pin_statement) == SQLITE_DONE;
+      sqlite3_reset(pin_statement);
+      if (changed && (pin || sqlite3_changes(_sqlite_handle) > 0)) {
+        changed_bytes += file_size;
+      }
+    }
+  }
+  sqlite3_finalize(size_statement);
+  sqlite3_finalize(pin_statement);
+  if (!changed || sqlite3_exec(_sqlite_handle, "COMMIT;", nullptr, nullptr, nullptr) != SQLITE_OK) {
+    sqlite3_exec(_sqlite_handle, "ROLLBACK;", nullptr, nullptr, nullptr);
+    return 0;
+  }
+  return changed_bytes;
+}
+
 void CachingSQLiteDatabase::removePinnedItemsForIdentifier(const std::string &pin_identifier) {
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
   char *error_message = nullptr;
   sqlite3_exec(_sqlite_handle,
                ("DELETE FROM " + pinned_items_table_name + " WHERE " + pin_identifier_column_name +
@@ -317,58 +527,504 @@ void CachingSQLiteDatabase::removePinnedItemsForIdentifier(const std::string &pi
 void CachingSQLiteDatabase::pinnedItemsForIdentifier(
     const std::string &pin_identifier,
     std::function<void(const std::vector<CacheItem> &)> callback) {
-  caching_vector_callback sqlite_callback =
-      [callback](const std::vector<std::unordered_map<std::string, std::string>> &results) {
-        std::vector<CacheItem> items;
-        for (const auto &result : results) {
-          items.push_back({timeFromSQLDateTimeString(result.at(expiry_column_name)),
-                           timeFromSQLDateTimeString(result.at(modified_column_name)),
-                           result.at(etag_column_name),
-                           timeFromSQLDateTimeString(result.at(last_accessed_column_name)),
-                           result.at(response_serialised_column_name),
-                           result.at(header_hash_column_name),
-                           true});
-        }
-        callback(items);
+  // Rows arrive one at a time, so they are gathered up and handed over together
+  std::vector<std::unordered_map<std::string, std::string>> results;
+  caching_callback sqlite_callback =
+      [&results](const std::unordered_map<std::string, std::string> &map) {
+        results.push_back(map);
       };
 
-  char *error_message = nullptr;
-  sqlite3_exec(
-      _sqlite_handle,
-      ("SELECT " + http_table_name + "." + expiry_column_name + " AS " + expiry_column_name + ", " +
-       http_table_name + "." + etag_column_name + " AS " + etag_column_name + ", " +
-       http_table_name + "." + modified_column_name + " AS " + modified_column_name + ", " +
-       http_table_name + "." + header_hash_column_name + " AS " + header_hash_column_name + ", " +
-       http_table_name + "." + response_serialised_column_name + " AS " +
-       response_serialised_column_name + ", " + http_table_name + "." + last_accessed_column_name +
-       " AS " + last_accessed_column_name + " FROM " + http_table_name + ", " +
-       pinned_items_table_name + " WHERE " + http_table_name + "." + header_hash_column_name +
-       " = " + pinned_items_table_name + "." + header_hash_column_name + " AND " +
-       pinned_items_table_name + "." + pin_identifier_column_name + " = '" + pin_identifier + "'")
-          .c_str(),
-      &sqliteSelectVectorHTTPCallback,
-      &sqlite_callback,
-      &error_message);
+  read([&](sqlite3 *sqlite_handle) {
+    char *error_message = nullptr;
+    sqlite3_exec(
+        sqlite_handle,
+        ("SELECT " + http_table_name + "." + expiry_column_name + " AS " + expiry_column_name +
+         ", " + http_table_name + "." + etag_column_name + " AS " + etag_column_name + ", " +
+         http_table_name + "." + modified_column_name + " AS " + modified_column_name + ", " +
+         http_table_name + "." + header_hash_column_name + " AS " + header_hash_column_name + ", " +
+         http_table_name + "." + response_serialised_column_name + " AS " +
+         response_serialised_column_name + ", " + http_table_name + "." +
+         last_accessed_column_name + " AS " + last_accessed_column_name + " FROM " +
+         http_table_name + ", " + pinned_items_table_name + " WHERE " + http_table_name + "." +
+         header_hash_column_name + " = " + pinned_items_table_name + "." + header_hash_column_name +
+         " AND " + pinned_items_table_name + "." + pin_identifier_column_name + " = '" +
+         pin_identifier + "'")
+            .c_str(),
+        &sqliteSelectHTTPCallback,
+        &sqlite_callback,
+        &error_message);
+  });
+  std::vector<CacheItem> items;
+  for (const auto &result : results) {
+    items.push_back({timeFromSQLDateTimeString(result.at(expiry_column_name)),
+                     timeFromSQLDateTimeString(result.at(last_accessed_column_name)),
+                     result.at(etag_column_name),
+                     timeFromSQLDateTimeString(result.at(modified_column_name)),
+                     result.at(response_serialised_column_name),
+                     result.at(header_hash_column_name),
+                     true});
+  }
+  callback(items);
 }
 
 void CachingSQLiteDatabase::pinningIdentifiers(
     std::function<void(const std::vector<std::string> &)> callback) {
-  caching_vector_callback sqlite_callback =
-      [callback](const std::vector<std::unordered_map<std::string, std::string>> &results) {
-        std::vector<std::string> pinned_identifiers;
-        for (const auto &result : results) {
-          pinned_identifiers.push_back(result.at(pin_identifier_column_name));
+  std::vector<std::string> pinned_identifiers;
+  caching_callback sqlite_callback =
+      [&pinned_identifiers](const std::unordered_map<std::string, std::string> &map) {
+        pinned_identifiers.push_back(map.at(pin_identifier_column_name));
+      };
+
+  read([&](sqlite3 *sqlite_handle) {
+    char *error_message = nullptr;
+    sqlite3_exec(
+        sqlite_handle,
+        ("SELECT DISTINCT " + pin_identifier_column_name + " FROM " + pinned_items_table_name)
+            .c_str(),
+        &sqliteSelectHTTPCallback,
+        &sqlite_callback,
+        &error_message);
+  });
+  callback(pinned_identifiers);
+}
+
+void CachingSQLiteDatabase::fetchRangesForResource(
+    const std::string &resource_identifier,
+    std::function<void(ErrorCode, const std::vector<CacheRange> &)> callback) {
+  std::vector<std::unordered_map<std::string, std::string>> results;
+  read([&](sqlite3 *sqlite_handle) {
+    results = rangesForResource(sqlite_handle, resource_identifier);
+  });
+  std::vector<CacheRange> ranges;
+  for (const auto &result : results) {
+    ranges.push_back({std::stoull(result.at(range_start_column_name)),
+                      std::stoull(result.at(range_end_column_name)),
+                      std::stoull(result.at(total_length_column_name)),
+                      result.count(etag_column_name) ? result.at(etag_column_name) : ""});
+  }
+  callback(ErrorCodeNone, ranges);
+}
+
+void CachingSQLiteDatabase::storeRange(const std::string &resource_identifier,
+                                       const CacheRange &range,
+                                       const std::shared_ptr<Response> &response) {
+  std::string expiry_value =
+      "datetime('now', '+" + std::to_string(response->cacheControl().max_age) + " seconds')";
+  size_t start = range.start;
+  size_t end = range.end;
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
+  std::string merge_query = "BEGIN TRANSACTION;";
+  for (const auto &result : rangesForResource(_sqlite_handle, resource_identifier)) {
+    const std::string etag = result.count(etag_column_name) ? result.at(etag_column_name) : "";
+    const size_t result_start = std::stoull(result.at(range_start_column_name));
+    const size_t result_end = std::stoull(result.at(range_end_column_name));
+    const bool same_resource =
+        etag == range.etag &&
+        std::stoull(result.at(total_length_column_name)) == range.total_length;
+    // Overlapping or adjacent segments of the same representation are merged into one row, while
+    // segments of a stale representation are dropped entirely
+    if (same_resource && (result_start > end + 1 || start > result_end + 1)) {
+      continue;
+    }
+    if (same_resource) {
+      start = std::min(start, result_start);
+      end = std::max(end, result_end);
+      expiry_value = "MIN(" + expiry_value + ", '" + result.at(expiry_column_name) + "')";
+    }
+    merge_query += "DELETE FROM " + ranges_table_name + " WHERE " + header_hash_column_name +
+                   " = '" + resource_identifier + "' AND " + range_start_column_name + " = " +
+                   std::to_string(result_start) + ";";
+  }
+  merge_query += "REPLACE INTO " + ranges_table_name + " (" + header_hash_column_name + ", " +
+                 range_start_column_name + ", " + range_end_column_name + ", " +
+                 total_length_column_name + ", " + etag_column_name + ", " + expiry_column_name +
+                 ") VALUES ('" + resource_identifier + "', " + std::to_string(start) + ", " +
+                 std::to_string(end) + ", " + std::to_string(range.total_length) + ", '" +
+                 range.etag + "', " + expiry_value + ");COMMIT;";
+  char *error_message = nullptr;
+  int error = sqlite3_exec(_sqlite_handle, merge_query.c_str(), nullptr, nullptr, &error_message);
+  if (error != SQLITE_OK) {
+    sqlite3_exec(_sqlite_handle, "ROLLBACK;", nullptr, nullptr, nullptr);
+  }
+}
+
+void CachingSQLiteDatabase::read(const std::function<void(sqlite3 *)> &query) {
+  if (_read_handles.empty()) {
+    std::lock_guard<std::mutex> write_lock(_write_mutex);
+    query(_sqlite_handle);
+    return;
+  }
+
+  sqlite3 *read_handle = nullptr;
+  {
+    std::unique_lock<std::mutex> read_handles_lock(_read_handles_mutex);
+    _read_handles_condition.wait(read_handles_lock, [this] { return !_free_read_handles.empty(); });
+    read_handle = _free_read_handles.back();
+    _free_read_handles.pop_back();
+  }
+  query(read_handle);
+  {
+    std::lock_guard<std::mutex> read_handles_lock(_read_handles_mutex);
+    _free_read_handles.push_back(read_handle);
+  }
+  _read_handles_condition.notify_one();
+}
+
+void CachingSQLiteDatabase::flushAccessedItems() {
+  // Expects the write mutex to be held
+  std::unordered_set<std::string> accessed_items;
+  {
+    std::lock_guard<std::mutex> accessed_items_lock(_accessed_items_mutex);
+    accessed_items.swap(_accessed_items);
+  }
+  if (accessed_items.empty()) {
+    return;
+  }
+
+  std::string header_hashes;
+  for (const auto &header_hash : accessed_items) {
+    header_hashes += (header_hashes.empty() ? "'" : ", '") + header_hash + "'";
+  }
+  char *error_message = nullptr;
+  sqlite3_exec(_sqlite_handle,
+               ("UPDATE " + http_table_name + " SET " + last_accessed_column_name +
+                " = date('now') WHERE " + header_hash_column_name + " IN (" + header_hashes + ")")
+                   .c_str(),
+               nullptr,
+               nullptr,
+               &error_message);
+}
+
+void CachingSQLiteDatabase::buildIndex() {
+  // Expects the write mutex to be held, or the database not yet shared
+  const TIMING_POINT start_time = timingNow();
+  std::vector<std::string> header_hashes;
+  caching_callback cache_function =
+      [&header_hashes](const std::unordered_map<std::string, std::string> &map) {
+        header_hashes.push_back(map.at(header_hash_column_name));
+      };
+  char *error_message = nullptr;
+  int error =
+      sqlite3_exec(_sqlite_handle,
+                   ("SELECT " + header_hash_column_name + " FROM " + http_table_name).c_str(),
+                   &sqliteSelectHTTPCallback,
+                   &cache_function,
+                   &error_message);
+  if (error != SQLITE_OK) {
+    // Without an index every lookup goes to the database
+    std::lock_guard<std::mutex> index_lock(_index_mutex);
+    _index.reset();
+    return;
+  }
+
+  // Leave room for the cache to double before the index needs rebuilding
+  std::unique_ptr<BloomFilter> index(
+      new BloomFilter(std::max(minimum_index_capacity, header_hashes.size() * 2)));
+  for (const auto &header_hash : header_hashes) {
+    index->insert(header_hash);
+  }
+  std::lock_guard<std::mutex> index_lock(_index_mutex);
+  _index = std::move(index);
+  _index_build_seconds = secondsSince(start_time);
+}
+
+void CachingSQLiteDatabase::removeFromIndex(const std::string &header_hash) {
+  std::lock_guard<std::mutex> index_lock(_index_mutex);
+  if (_index) {
+    _index->remove(header_hash);
+  }
+}
+
+void CachingSQLiteDatabase::addStatistics(Statistics &statistics) const {
+  statistics.cache_index_skipped_lookups = counterValue(_index_skipped_lookups);
+  std::lock_guard<std::mutex> index_lock(_index_mutex);
+  statistics.cache_index_build_seconds = _index_build_seconds;
+}
+
+bool CachingSQLiteDatabase::exportSnapshot(const std::string &archive_path) {
+  auto delegate = _delegate.lock();
+  if (!delegate) {
+    return false;
+  }
+
+  // Read both tables in one transaction so the pins match the responses
+  std::vector<std::unordered_map<std::string, std::string>> items;
+  std::vector<std::unordered_map<std::string, std::string>> pins;
+  caching_callback item_function =
+      [&items](const std::unordered_map<std::string, std::string> &map) { items.push_back(map); };
+  caching_callback pin_function = [&pins](const std::unordered_map<std::string, std::string> &map) {
+    pins.push_back(map);
+  };
+  int error = SQLITE_OK;
+  read([&](sqlite3 *sqlite_handle) {
+    char *error_message = nullptr;
+    error = sqlite3_exec(
+        sqlite_handle,
+        ("BEGIN TRANSACTION;SELECT " + header_hash_column_name + ", " + expiry_column_name + ", " +
+         etag_column_name + ", " + modified_column_name + ", " + response_serialised_column_name +
+         ", " + last_accessed_column_name + " FROM " + http_table_name)
+            .c_str(),
+        &sqliteSelectHTTPCallback,
+        &item_function,
+        &error_message);
+    if (error == SQLITE_OK) {
+      error = sqlite3_exec(sqlite_handle,
+                           ("SELECT " + header_hash_column_name + ", " +
+                            pin_identifier_column_name + " FROM " + pinned_items_table_name)
+                               .c_str(),
+                           &sqliteSelectHTTPCallback,
+                           &pin_function,
+                           &error_message);
+    }
+    sqlite3_exec(sqlite_handle, "COMMIT;", nullptr, nullptr, nullptr);
+  });
+  if (error != SQLITE_OK) {
+    return false;
+  }
+
+  nlohmann::json manifest = {{"items", nlohmann::json::array()}, {"pins", nlohmann::json::array()}};
+  std::vector<std::string> payload_paths;
+  for (auto &item : items) {
+    // Negative entries have no payload file
+    const std::string payload_path = delegate->databaseFilePath(item[header_hash_column_name]);
+    const long payload_size = fileSize(payload_path);
+    payload_paths.push_back(payload_size > 0 ? payload_path : "");
+    manifest["items"].push_back({{"header_hash", item[header_hash_column_name]},
+                                 {"expiry", item[expiry_column_name]},
+                                 {"etag", item[etag_column_name]},
+                                 {"modified", item[modified_column_name]},
+                                 {"response", item[response_serialised_column_name]},
+                                 {"last_accessed", item[last_accessed_column_name]},
+                                 {"payload_size", std::max<long>(payload_size, 0)}});
+  }
+  for (const auto &pin : pins) {
+    manifest["pins"].push_back({{"header_hash", pin.at(header_hash_column_name)},
+                                {"pin_identifier", pin.at(pin_identifier_column_name)}});
+  }
+
+  // Write next to the archive and move it into place, so a failed export leaves nothing behind
+  const std::string temporary_path = archive_path + ".tmp";
+  FILE *archive = fopen(temporary_path.c_str(), "wb");
+  if (archive == nullptr) {
+    return false;
+  }
+  const std::string manifest_string = manifest.dump();
+  bool written =
+      fprintf(archive, "%s\n%zu\n", snapshot_magic.c_str(), manifest_string.size()) > 0 &&
+      fwrite(manifest_string.data(), 1, manifest_string.size(), archive) == manifest_string.size();
+  for (size_t i = 0; written && i < payload_paths.size(); ++i) {
+    const size_t payload_size = manifest["items"][i]["payload_size"];
+    if (payload_size == 0) {
+      continue;
+    }
+    FILE *payload_file = fopen(payload_paths[i].c_str(), "rb");
+    written = payload_file != nullptr && copyFileBytes(payload_file, archive, payload_size);
+    if (payload_file != nullptr) {
+      fclose(payload_file);
+    }
+  }
+  written = fclose(archive) == 0 && written;
+  if (!written || rename(temporary_path.c_str(), archive_path.c_str()) != 0) {
+    remove(temporary_path.c_str());
+    return false;
+  }
+  return true;
+}
+
+bool CachingSQLiteDatabase::importSnapshot(const std::string &archive_path) {
+  auto delegate = _delegate.lock();
+  if (!delegate) {
+    return false;
+  }
+  FILE *archive = fopen(archive_path.c_str(), "rb");
+  if (archive == nullptr) {
+    return false;
+  }
+  char magic[32] = {};
+  size_t manifest_size = 0;
+  nlohmann::json manifest;
+  if (fgets(magic, sizeof(magic), archive) == nullptr ||
+      std::string(magic) != snapshot_magic + "\n" || fscanf(archive, "%zu", &manifest_size) != 1 ||
+      fgetc(archive) != '\n') {
+    fclose(archive);
+    return false;
+  }
+  std::string manifest_string(manifest_size, '\0');
+  if (fread(&manifest_string[0], 1, manifest_size, archive) != manifest_size) {
+    fclose(archive);
+    return false;
+  }
+  try {
+    manifest = nlohmann::json::parse(manifest_string);
+  } catch (const std::exception &) {
+    fclose(archive);
+    return false;
+  }
+
+  // Everything goes in as one transaction. The payloads are written next to their final paths as
+  // we reach them, and only moved into place once the transaction has committed
+  std::lock_guard<std::mutex> write_lock(_write_mutex);
+  flushAccessedItems();
+  sqlite3_stmt *item_statement = nullptr;
+  sqlite3_stmt *pin_statement = nullptr;
+  bool imported =
+      sqlite3_exec(_sqlite_handle, "BEGIN TRANSACTION;", nullptr, nullptr, nullptr) == SQLITE_OK &&
+      sqlite3_prepare_v2(
+          _sqlite_handle,
+          ("REPLACE INTO " + http_table_name + " (" + header_hash_column_name + ", " +
+           expiry_column_name + ", " + etag_column_name + ", " + modified_column_name + ", " +
+           response_serialised_column_name + ", " + last_accessed_column_name + ", " +
+           file_size_column_name + ") VALUES (?, ?, ?, ?, ?, ?, ?)")
+              .c_str(),
+          -1,
+          &item_statement,
+          nullptr) == SQLITE_OK &&
+      sqlite3_prepare_v2(
+          _sqlite_handle,
+          ("REPLACE INTO " + pinned_items_table_name + " (" + header_hash_column_name + ", " +
+           pin_identifier_column_name + ") VALUES (?, ?)")
+              .c_str(),
+          -1,
+          &pin_statement,
+          nullptr) == SQLITE_OK;
+  std::vector<std::string> header_hashes;
+  std::vector<bool> has_payloads;
+  try {
+    for (const auto &item : manifest["items"]) {
+      if (!imported) {
+        break;
+      }
+      const std::string header_hash = item["header_hash"];
+      const size_t payload_size = item["payload_size"];
+      if (!isHeaderHash(header_hash)) {
+        imported = false;
+        break;
+      }
+      const std::string payload_path = delegate->databaseFilePath(header_hash);
+      header_hashes.push_back(header_hash);
+      has_payloads.push_back(payload_size > 0);
+      if (payload_size > 0) {
+        FILE *payload_file = fopen((payload_path + snapshot_temporary_suffix).c_str(), "wb");
+        imported = payload_file != nullptr && copyFileBytes(archive, payload_file, payload_size);
+        if (payload_file != nullptr) {
+          imported = fclose(payload_file) == 0 && imported;
         }
-        callback(pinned_identifiers);
+      }
+      const std::string columns[] = {header_hash,
+                                     item["expiry"],
+                                     item["etag"],
+                                     item["modified"],
+                                     item["response"],
+                                     item["last_accessed"]};
+      for (int i = 0; i < 6; ++i) {
+        sqlite3_bind_text(item_statement, i + 1, columns[i].c_str(), -1, SQLITE_TRANSIENT);
+      }
+      sqlite3_bind_int64(item_statement, 7, payload_size);
+      imported = imported && sqlite3_step(item_statement) == SQLITE_DONE;
+      sqlite3_reset(item_statement);
+    }
+    for (const auto &pin : manifest["pins"]) {
+      if (!imported) {
+        break;
+      }
+      const std::string header_hash = pin["header_hash"];
+      const std::string pin_identifier = pin["pin_identifier"];
+      if (!isHeaderHash(header_hash)) {
+        imported = false;
+        break;
+      }
+      sqlite3_bind_text(pin_statement, 1, header_hash.c_str(), -1, SQLITE_TRANSIENT);
+      sqlite3_bind_text(pin_statement, 2, pin_identifier.c_str(), -1, SQLITE_TRANSIENT);
+      imported = sqlite3_step(pin_statement) == SQLITE_DONE;
+      sqlite3_reset(pin_statement);
+    }
+  } catch (const std::exception &) {
+    imported = false;
+  }
+  sqlite3_finalize(item_statement);
+  sqlite3_finalize(pin_statement);
+  fclose(archive);
+  if (!imported ||
+      sqlite3_exec(_sqlite_handle, "COMMIT;", nullptr, nullptr, nullptr) != SQLITE_OK) {
+    sqlite3_exec(_sqlite_handle, "ROLLBACK;", nullptr, nullptr, nullptr);
+    for (const auto &header_hash : header_hashes) {
+      remove((delegate->databaseFilePath(header_hash) + snapshot_temporary_suffix).c_str());
+    }
+    return false;
+  }
+
+  // The rows are in, so swap the payloads in underneath them. Negative entries have none
+  for (size_t i = 0; i < header_hashes.size(); ++i) {
+    const std::string payload_path = delegate->databaseFilePath(header_hashes[i]);
+    remove(payload_path.c_str());
+    if (has_payloads[i] &&
+        rename((payload_path + snapshot_temporary_suffix).c_str(), payload_path.c_str()) != 0) {
+      remove((payload_path + snapshot_temporary_suffix).c_str());
+      imported = false;
+    }
+  }
+
+  std::lock_guard<std::mutex> index_lock(_index_mutex);
+  if (_index) {
+    for (const auto &header_hash : header_hashes) {
+      _index->insert(header_hash);
+    }
+  }
+  return imported;
+}
+
+void CachingSQLiteDatabase::pruneRanges() {
+  // Expects the write mutex to be held
+  std::vector<std::string> expired_resources;
+  caching_callback cache_function =
+      [&expired_resources](const std::unordered_map<std::string, std::string> &map) {
+        expired_resources.push_back(map.at(header_hash_column_name));
       };
+  char *error_message = nullptr;
+  sqlite3_exec(_sqlite_handle,
+               ("SELECT DISTINCT " + header_hash_column_name + " FROM " + ranges_table_name +
+                " WHERE " + expiry_column_name + " <= datetime('now')")
+                   .c_str(),
+               &sqliteSelectHTTPCallback,
+               &cache_function,
+               &error_message);
+  for (const auto &resource_identifier : expired_resources) {
+    int error_code = sqlite3_exec(
+        _sqlite_handle,
+        ("DELETE FROM " + ranges_table_name + " WHERE " + header_hash_column_name + " = '" +
+         resource_identifier + "' AND " + expiry_column_name + " <= datetime('now')")
+            .c_str(),
+        nullptr,
+        nullptr,
+        &error_message);
+    if (error_code == SQLITE_OK && rangesForResource(_sqlite_handle, resource_identifier).empty()) {
+      if (auto delegate = _delegate.lock()) {
+        delegate->deleteDatabaseFile(resource_identifier);
+      }
+    }
+  }
+}
 
+std::vector<std::unordered_map<std::string, std::string>> CachingSQLiteDatabase::rangesForResource(
+    sqlite3 *sqlite_handle, const std::string &resource_identifier) {
+  std::vector<std::unordered_map<std::string, std::string>> results;
+  caching_callback cache_function =
+      [&results](const std::unordered_map<std::string, std::string> &map) {
+        results.push_back(map);
+      };
   char *error_message = nullptr;
-  sqlite3_exec(
-      _sqlite_handle,
-      ("SELECT UNIQUE(" + pin_identifier_column_name + ") FROM " + pinned_items_table_name).c_str(),
-      &sqliteSelectVectorHTTPCallback,
-      &sqlite_callback,
-      &error_message);
+  sqlite3_exec(sqlite_handle,
+               ("SELECT " + range_start_column_name + ", " + range_end_column_name + ", " +
+                total_length_column_name + ", " + etag_column_name + ", " + expiry_column_name +
+                " FROM " + ranges_table_name + " WHERE " + header_hash_column_name + " = '" +
+                resource_identifier + "' AND " + expiry_column_name +
+                " > datetime('now') ORDER BY " + range_start_column_name + " ASC")
+                   .c_str(),
+               &sqliteSelectHTTPCallback,
+               &cache_function,
+               &error_message);
+  return results;
 }
 
 int CachingSQLiteDatabase::sqliteSelectHTTPCallback(void *context,
@@ -416,13 +1072,25 @@ int CachingSQLiteDatabase::sqliteSelectVectorHTTPCallback(void *context,
 }
 
 std::time_t CachingSQLiteDatabase::timeFromSQLDateTimeString(const std::string &date_time_string) {
+  if (date_time_string.empty()) {
+    return 0;
+  }
   std::tm expiry_time_values = {};
   // TODO: Use sstream impl after we up to gcc >= 5
   strptime(date_time_string.c_str(), "%Y-%m-%d %H:%M:%S", &expiry_time_values);
   //  std::istringstream expiry_stream(date_time_string);
   //  expiry_stream.imbue(std::locale("en.utf-8"));
   //  expiry_stream >> std::get_time(&expiry_time_values, "%Y-%m-%d %H:%M:%S");
-  return mktime(&expiry_time_values);
+  // SQLite keeps its times in UTC
+  return timegm(&expiry_time_values);
+}
+
+std::time_t CachingSQLiteDatabase::timeFromHTTPDateString(const std::string &date_string) {
+  std::tm date_values = {};
+  if (strptime(date_string.c_str(), "%a, %d %b %Y %H:%M:%S", &date_values) == nullptr) {
+    return 0;
+  }
+  return timegm(&date_values);
 }
 
 }  // namespace http
@@ -20,13 +20,25 @@
  */
 #pragma once
 
+#include "BloomFilter.h"
 #include "CachingDatabase.h"
 
 #include <sqlite3.h>
 
+#include <atomic>
+#include <condition_variable>
+#include <mutex>
+#include <unordered_map>
+#include <unordered_set>
+#include <vector>
+
 namespace nativeformat {
 namespace http {
 
+// Reads each take one of these read only connections, so lookups run alongside each other and
+// alongside the single connection that writes
+static const size_t READ_CONNECTION_COUNT = 4;
+
 class CachingSQLiteDatabase : public CachingDatabase {
  public:
   CachingSQLiteDatabase(const std::string &cache_location,
@@ -40,14 +52,31 @@ class CachingSQLiteDatabase : public CachingDatabase {
   void storeResponse(
       const std::shared_ptr<Response> &response,
       std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) override;
+  void storeNegativeResponse(
+      const std::shared_ptr<Response> &response,
+      long long default_max_age,
+      std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback) override;
   void prune() override;
   void pinItem(const CacheItem &item, const std::string &pin_identifier) override;
   void unpinItem(const CacheItem &item, const std::string &pin_identifier) override;
+  size_t pinItems(const std::vector<std::string> &header_hashes,
+                  const std::string &pin_identifier) override;
+  size_t unpinItems(const std::vector<std::string> &header_hashes,
+                    const std::string &pin_identifier) override;
   void removePinnedItemsForIdentifier(const std::string &pin_identifier) override;
   void pinnedItemsForIdentifier(
       const std::string &pin_identifier,
       std::function<void(const std::vector<CacheItem> &)> callback) override;
   void pinningIdentifiers(std::function<void(const std::vector<std::string> &)> callback) override;
+  void fetchRangesForResource(
+      const std::string &resource_identifier,
+      std::function<void(ErrorCode, const std::vector<CacheRange> &)> callback) override;
+  void storeRange(const std::string &resource_identifier,
+                  const CacheRange &range,
+                  const std::shared_ptr<Response> &response) override;
+  void addStatistics(Statistics &statistics) const override;
+  bool exportSnapshot(const std::string &archive_path) override;
+  bool importSnapshot(const std::string &archive_path) override;
 
  private:
   static int sqliteSelectHTTPCallback(void *context, int argc, char **argv, char **column_names);
@@ -56,9 +85,40 @@ class CachingSQLiteDatabase : public CachingDatabase {
                                             int argc,
                                             char **argv,
                                             char **column_names);
+  void replaceResponse(
+      const std::shared_ptr<Response> &response,
+      long long default_max_age,
+      size_t data_length,
+      std::function<void(ErrorCode, const std::shared_ptr<Response> &response)> callback);
+  void read(const std::function<void(sqlite3 *)> &query);
+  void flushAccessedItems();
+  void buildIndex();
+  size_t changePins(const std::vector<std::string> &header_hashes,
+                    const std::string &pin_identifier,
+                    bool pin);
+  void removeFromIndex(const std::string &header_hash);
+  void pruneRanges();
+  static std::vector<std::unordered_map<std::string, std::string>> rangesForResource(
+      sqlite3 *sqlite_handle, const std::string &resource_identifier);
+
   static std::time_t timeFromSQLDateTimeString(const std::string &date_time_string);
+  static std::time_t timeFromHTTPDateString(const std::string &date_string);
 
+  // Every write goes through this connection while holding the write mutex
   sqlite3 *_sqlite_handle;
+  std::mutex _write_mutex;
+  std::vector<sqlite3 *> _read_handles;
+  std::vector<sqlite3 *> _free_read_handles;
+  std::mutex _read_handles_mutex;
+  std::condition_variable _read_handles_condition;
+  // Items looked up since the last write, whose access times are updated in one batch
+  std::unordered_set<std::string> _accessed_items;
+  std::mutex _accessed_items_mutex;
+  // Every key in the http table, so lookups for keys we never stored skip the database
+  std::unique_ptr<BloomFilter> _index;
+  mutable std::mutex _index_mutex;
+  std::atomic<uint64_t> _index_skipped_lookups;
+  double _index_build_seconds;
   const std::weak_ptr<CachingDatabaseDelegate> _delegate;
 };
 
@@ -22,12 +22,15 @@
 
 #include <sys/stat.h>
 
+#include <cstdio>
+
 #include "CachingClient.h"
 #include "ClientCpprestsdk.h"
 #include "ClientCurl.h"
 #include "ClientModifierImplementation.h"
 #include "ClientMultiRequestImplementation.h"
 #include "ClientNSURLSession.h"
+#include "ClientSegmentedImplementation.h"
 
 namespace nativeformat {
 namespace http {
@@ -49,6 +52,54 @@ const RESPONSE_MODIFIER_FUNCTION DO_NOT_MODIFY_RESPONSES_FUNCTION = &doNotModify
 
 Client::~Client() {}
 
+std::vector<std::shared_ptr<RequestToken>> Client::performRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks) {
+  std::vector<std::shared_ptr<RequestToken>> request_tokens;
+  for (size_t i = 0; i < requests.size(); ++i) {
+    request_tokens.push_back(performRequest(requests[i], callbacks[i]));
+  }
+  return request_tokens;
+}
+
+std::vector<std::shared_ptr<RequestToken>> Client::performRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    std::function<void(const std::shared_ptr<Response> &)> callback,
+    std::function<void(const std::vector<std::shared_ptr<Response>> &)> completion_callback) {
+  struct Batch {
+    std::mutex mutex;
+    std::vector<std::shared_ptr<Response>> responses;
+    size_t remaining;
+  };
+  auto batch = std::make_shared<Batch>();
+  batch->responses.resize(requests.size());
+  batch->remaining = requests.size();
+  if (requests.empty() && completion_callback) {
+    completion_callback(batch->responses);
+  }
+
+  // Responses are handed to the completion callback in the order they were requested
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
+  for (size_t i = 0; i < requests.size(); ++i) {
+    callbacks.push_back(
+        [batch, i, callback, completion_callback](const std::shared_ptr<Response> &response) {
+          if (callback) {
+            callback(response);
+          }
+          bool complete = false;
+          {
+            std::lock_guard<std::mutex> lock(batch->mutex);
+            batch->responses[i] = response;
+            complete = --batch->remaining == 0;
+          }
+          if (complete && completion_callback) {
+            completion_callback(batch->responses);
+          }
+        });
+  }
+  return performRequests(requests, callbacks);
+}
+
 const std::shared_ptr<Response> Client::performRequestSynchronously(
     const std::shared_ptr<Request> &request) {
   std::mutex mutex;
@@ -76,6 +127,38 @@ void Client::pinResponse(const std::shared_ptr<Response> &response,
 void Client::unpinResponse(const std::shared_ptr<Response> &response,
                            const std::string &pin_identifier) {}
 
+void Client::pinResponses(const std::vector<std::shared_ptr<Response>> &responses,
+                          const std::string &pin_identifier,
+                          std::function<void(size_t pinned_bytes)> callback) {
+  std::vector<std::string> request_hashes;
+  for (const auto &response : responses) {
+    request_hashes.push_back(response->request()->hash());
+  }
+  pinRequestHashes(request_hashes, pin_identifier, callback);
+}
+
+void Client::unpinResponses(const std::vector<std::shared_ptr<Response>> &responses,
+                            const std::string &pin_identifier,
+                            std::function<void(size_t unpinned_bytes)> callback) {
+  std::vector<std::string> request_hashes;
+  for (const auto &response : responses) {
+    request_hashes.push_back(response->request()->hash());
+  }
+  unpinRequestHashes(request_hashes, pin_identifier, callback);
+}
+
+void Client::pinRequestHashes(const std::vector<std::string> &request_hashes,
+                              const std::string &pin_identifier,
+                              std::function<void(size_t pinned_bytes)> callback) {
+  callback(0);
+}
+
+void Client::unpinRequestHashes(const std::vector<std::string> &request_hashes,
+                                const std::string &pin_identifier,
+                                std::function<void(size_t unpinned_bytes)> callback) {
+  callback(0);
+}
+
 void Client::removePinnedResponseForIdentifier(const std::string &pin_identifier) {}
 
 void Client::pinnedResponsesForIdentifier(
@@ -85,61 +168,165 @@ void Client::pinnedResponsesForIdentifier(
 void Client::pinningIdentifiers(
     std::function<void(const std::vector<std::string> &identifiers)> callback) {}
 
-std::shared_ptr<Client> createNativeClient(const std::string &cache_location,
-                                           const std::string &user_agent,
-                                           REQUEST_MODIFIER_FUNCTION request_modifier_function,
-                                           RESPONSE_MODIFIER_FUNCTION response_modifier_function) {
+void Client::prefetchRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::string &pin_identifier,
+    std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback) {
+  // Without a cache there is nothing to warm, so the prefetch is over before it starts
+  if (progress_callback) {
+    progress_callback(requests.size(), requests.size(), 0);
+  }
+}
+
+Statistics Client::stats() const {
+  return Statistics();
+}
+
+void Client::setCoalescingWindow(std::chrono::milliseconds window, size_t max_bytes) {}
+
+void Client::setNegativeCacheTime(std::chrono::seconds time) {
+  fprintf(stderr, "E: Negative caching needs a client with a cache\n");
+}
+
+bool Client::exportCache(const std::string &archive_path) {
+  fprintf(stderr, "E: Exporting needs a client with a cache\n");
+  return false;
+}
+
+bool Client::importCache(const std::string &archive_path) {
+  fprintf(stderr, "E: Importing needs a client with a cache\n");
+  return false;
+}
+
+void Client::process(EVENT_LOOP_SOCKET socket, int events) {}
+
+void Client::onTimeout() {}
+
+std::shared_ptr<Client> createNativeClient(
+    const std::string &cache_location,
+    const std::string &user_agent,
+    REQUEST_MODIFIER_FUNCTION request_modifier_function,
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+    const std::shared_ptr<RequestObserver> &request_observer) {
 #if USE_CURL
-  return createCurlClient();
+  return createCurlClient(request_observer);
 #elif USE_CPPRESTSDK
-  return createCpprestsdkClient();
+  return createCpprestsdkClient(request_observer);
 #elif __APPLE__
-  return createNSURLSessionClient();
+  return createNSURLSessionClient(request_observer);
 #else
-  return createCurlClient();
+  return createCurlClient(request_observer);
 #endif
 }
 
-std::shared_ptr<Client> createCachingClient(const std::string &cache_location,
-                                            const std::string &user_agent,
-                                            REQUEST_MODIFIER_FUNCTION request_modifier_function,
-                                            RESPONSE_MODIFIER_FUNCTION response_modifier_function) {
-  auto native_client = createNativeClient(
-      cache_location, user_agent, request_modifier_function, response_modifier_function);
-  // TODO: Make caching client work
-  // auto caching_client = std::make_shared<CachingClient>(native_client,
-  // cache_location, user_agent);  caching_client->initialise();  return
-  // caching_client;
-  return native_client;
+std::shared_ptr<Client> createSegmentedClient(
+    const std::string &cache_location,
+    const std::string &user_agent,
+    REQUEST_MODIFIER_FUNCTION request_modifier_function,
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+    const std::shared_ptr<RequestObserver> &request_observer,
+    std::shared_ptr<Client> native_client) {
+  return std::make_shared<ClientSegmentedImplementation>(native_client);
+}
+
+std::shared_ptr<Client> createCachingClient(
+    const std::string &cache_location,
+    const std::string &user_agent,
+    REQUEST_MODIFIER_FUNCTION request_modifier_function,
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+    const std::shared_ptr<RequestObserver> &request_observer,
+    const std::shared_ptr<Client> &native_client) {
+  auto segmented_client = createSegmentedClient(cache_location,
+                                                user_agent,
+                                                request_modifier_function,
+                                                response_modifier_function,
+                                                request_observer,
+                                                native_client);
+  // Without somewhere to keep it there is no cache
+  if (cache_location.empty()) {
+    return segmented_client;
+  }
+  auto caching_client =
+      std::make_shared<CachingClient>(segmented_client, cache_location, request_observer);
+  caching_client->initialise();
+  return caching_client;
 }
 
 std::shared_ptr<Client> createMultiRequestClient(
     const std::string &cache_location,
     const std::string &user_agent,
     REQUEST_MODIFIER_FUNCTION request_modifier_function,
-    RESPONSE_MODIFIER_FUNCTION response_modifier_function) {
-  auto caching_client = createCachingClient(
-      cache_location, user_agent, request_modifier_function, response_modifier_function);
-  return std::make_shared<ClientMultiRequestImplementation>(caching_client);
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+    const std::shared_ptr<RequestObserver> &request_observer,
+    const std::shared_ptr<Client> &native_client) {
+  auto caching_client = createCachingClient(cache_location,
+                                            user_agent,
+                                            request_modifier_function,
+                                            response_modifier_function,
+                                            request_observer,
+                                            native_client);
+  return std::make_shared<ClientMultiRequestImplementation>(caching_client, request_observer);
 }
 
 std::shared_ptr<Client> createModifierClient(
     const std::string &cache_location,
     const std::string &user_agent,
     REQUEST_MODIFIER_FUNCTION request_modifier_function,
-    RESPONSE_MODIFIER_FUNCTION response_modifier_function) {
-  auto multi_request_client = createMultiRequestClient(
-      cache_location, user_agent, request_modifier_function, response_modifier_function);
-  return std::make_shared<ClientModifierImplementation>(
-      request_modifier_function, response_modifier_function, multi_request_client);
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+    const std::shared_ptr<RequestObserver> &request_observer,
+    const std::shared_ptr<Client> &native_client) {
+  auto multi_request_client = createMultiRequestClient(cache_location,
+                                                       user_agent,
+                                                       request_modifier_function,
+                                                       response_modifier_function,
+                                                       request_observer,
+                                                       native_client);
+  return std::make_shared<ClientModifierImplementation>(request_modifier_function,
+                                                        response_modifier_function,
+                                                        multi_request_client,
+                                                        request_observer);
 }
 
 std::shared_ptr<Client> createClient(const std::string &cache_location,
                                      const std::string &user_agent,
                                      REQUEST_MODIFIER_FUNCTION request_modifier_function,
-                                     RESPONSE_MODIFIER_FUNCTION response_modifier_function) {
-  return createModifierClient(
-      cache_location, user_agent, request_modifier_function, response_modifier_function);
+                                     RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+                                     const std::shared_ptr<RequestObserver> &request_observer) {
+  auto native_client = createNativeClient(cache_location,
+                                          user_agent,
+                                          request_modifier_function,
+                                          response_modifier_function,
+                                          request_observer);
+  return createModifierClient(cache_location,
+                              user_agent,
+                              request_modifier_function,
+                              response_modifier_function,
+                              request_observer,
+                              native_client);
+}
+
+std::shared_ptr<Client> createEventLoopClient(
+    const std::string &cache_location,
+    const std::string &user_agent,
+    WATCH_SOCKET_FUNCTION watch_socket_function,
+    SET_TIMEOUT_FUNCTION set_timeout_function,
+    REQUEST_MODIFIER_FUNCTION request_modifier_function,
+    RESPONSE_MODIFIER_FUNCTION response_modifier_function,
+    const std::shared_ptr<RequestObserver> &request_observer) {
+#if USE_CURL || !(USE_CPPRESTSDK || __APPLE__)
+  // Only the curl client can hand its sockets to another loop. The cache is left out, as it looks
+  // requests up on threads of its own and would call into the native client off the loop thread
+  auto native_client =
+      createCurlClient(request_observer, watch_socket_function, set_timeout_function);
+  return createModifierClient("",
+                              user_agent,
+                              request_modifier_function,
+                              response_modifier_function,
+                              request_observer,
+                              native_client);
+#else
+  return nullptr;
+#endif
 }
 
 }  // namespace http
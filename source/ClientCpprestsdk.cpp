@@ -21,8 +21,14 @@
 
 #include "ClientCpprestsdk.h"
 
+#include <algorithm>
+#include <cstdlib>
 #include <cstring>
 #include <memory>
+#include <vector>
+
+#include "DownloadFile.h"
+#include "RequestObserverNotification.h"
 
 namespace nativeformat {
 namespace http {
@@ -41,64 +47,261 @@ static const std::string getRedirectUrl(const http_response &response,
                                         const std::string &request_url);
 
 // ClientCpprestsdk members
-ClientCpprestsdk::ClientCpprestsdk() {}
+ClientCpprestsdk::ClientCpprestsdk(const std::shared_ptr<RequestObserver> &request_observer)
+    : _next_request_id(0),
+      _metrics(std::make_shared<LayerMetrics>()),
+      _bytes_sent(0),
+      _bytes_received(0),
+      _request_observer(request_observer) {}
 ClientCpprestsdk::~ClientCpprestsdk() {}
 
 std::shared_ptr<RequestToken> ClientCpprestsdk::performRequest(
     const std::shared_ptr<Request> &request,
     std::function<void(const std::shared_ptr<Response> &)> callback) {
-  container_buffer<std::string> buf;
+  callback = LayerMetrics::trackRequest(_metrics, callback);
+  auto request_info = std::make_shared<RequestInfo>(request, _next_request_id++, callback);
+  std::shared_ptr<RequestToken> request_token = std::make_shared<RequestTokenImplementation>(
+      shared_from_this(), std::to_string(request_info->request_id));
+  std::vector<std::shared_ptr<RequestInfo>> ready_requests;
+  {
+    std::lock_guard<std::mutex> client_lock(_client_mutex);
+    _requests[request_info->request_id] = request_info;
+    _pending_requests[request_info->priority].push_back(request_info);
+    ready_requests = scheduleRequests();
+  }
+  for (const auto &ready_request : ready_requests) {
+    startRequest(ready_request);
+  }
+  return request_token;
+}
+
+std::shared_ptr<http_client> ClientCpprestsdk::clientForURI(const uri &request_uri) {
+  // The authority is the scheme, host and port, which is what a connection can be shared across
+  const uri authority = request_uri.authority();
+  const std::string key = conversions::to_utf8string(authority.to_string());
+  std::lock_guard<std::mutex> client_lock(_client_mutex);
+  auto &client = _clients[key];
+  if (!client) {
+    client = std::make_shared<http_client>(authority, clientConfigForProxy());
+  }
+  return client;
+}
+
+std::vector<std::shared_ptr<ClientCpprestsdk::RequestInfo>> ClientCpprestsdk::scheduleRequests() {
+  std::vector<std::shared_ptr<RequestInfo>> ready_requests;
+  // Higher priorities get first pick of the free slots
+  for (auto it = _pending_requests.rbegin(); it != _pending_requests.rend(); ++it) {
+    const RequestPriority priority = it->first;
+    auto &pending_requests = it->second;
+    // Low priority requests wait until there are no high priority requests running
+    if (priority == RequestPriorityLow && _running_requests[RequestPriorityHigh] > 0) {
+      continue;
+    }
+    while (!pending_requests.empty() &&
+           _running_requests[priority] < maximumRunningRequests(priority)) {
+      ready_requests.push_back(pending_requests.front());
+      pending_requests.front()->running = true;
+      pending_requests.pop_front();
+      _running_requests[priority]++;
+    }
+  }
+  return ready_requests;
+}
+
+void ClientCpprestsdk::startRequest(const std::shared_ptr<RequestInfo> &request_info) {
+  const std::shared_ptr<Request> &request = request_info->request;
   http_headers headers;
   http_request req;
-  const std::string base_url = request->url();
-  http_client client(conversions::utf8_to_utf16(base_url), clientConfigForProxy());
-  std::shared_ptr<ResponseImplementation> r = nullptr;
-
   for (const auto h : request->headerMap()) {
     headers.add(conversions::utf8_to_utf16(h.first), conversions::utf8_to_utf16(h.second));
   }
   req.headers() = headers;
   req.set_method(methodMap().at(request->method()));
+  size_t request_data_length = 0;
+  request->data(request_data_length);
+  incrementCounter(_bytes_sent, request_data_length);
 
   // printf("Starting request to %s...\n", request->url().c_str());
-  auto resp = client.request(req).then([=](http_response response) -> void {
-    // On request completion, create response and call callback
-    StatusCode status = StatusCode(response.status_code());
-
-    // Perform redirect if needed
-    if (isRedirect(status)) {
-      const std::string new_url = getRedirectUrl(response, request->url());
-      std::shared_ptr<Request> new_request = createRequest(new_url, request->headerMap());
-      this->performRequest(new_request, callback);
-      return;
+  notifyRequestObserver(_request_observer, RequestEventNetworkStarted, request);
+  if (!request->dataPath().empty()) {
+    // Stream the body from disk once the file is open
+    auto strong_this = shared_from_this();
+    file_stream<uint8_t>::open_istream(conversions::to_string_t(request->dataPath()))
+        .then([strong_this, request_info, req](pplx::task<basic_istream<uint8_t>> body_task) {
+          http_request body_request = req;
+          try {
+            body_request.set_body(body_task.get());
+          } catch (const std::exception &) {
+            strong_this->finishRequest(
+                request_info,
+                std::make_shared<ResponseImplementation>(
+                    request_info->request, nullptr, 0, StatusCodeInvalid, false));
+            return;
+          }
+          strong_this->sendRequest(request_info, body_request, request_info->request->url(), 0);
+        });
+    return;
+  } else if (auto data_provider = request->dataProvider()) {
+    std::vector<unsigned char> body;
+    unsigned char buffer[65536];
+    size_t buffer_length = 0;
+    while ((buffer_length = data_provider(buffer, sizeof(buffer))) > 0) {
+      body.insert(body.end(), buffer, buffer + buffer_length);
     }
-    response.body().read_to_end(buf).wait();
-    // printf("Response body:\n%s\n", buf.collection().c_str());
-    // printf("Returning response (status = %d)\n", response.status_code());
-    const std::string &data = buf.collection();
-    std::shared_ptr<ResponseImplementation> r = std::make_shared<ResponseImplementation>(
-        request, (const unsigned char *)data.c_str(), data.size(), status, false);
-    callback(r);
-  });
-
-  /*
+    req.set_body(std::move(body));
+  }
+  sendRequest(request_info, req, request->url(), 0);
+}
+
+void ClientCpprestsdk::sendRequest(const std::shared_ptr<RequestInfo> &request_info,
+                                   http_request req,
+                                   const std::string &url,
+                                   int redirects) {
+  const std::shared_ptr<Request> request = request_info->request;
+  auto strong_this = shared_from_this();
+  std::shared_ptr<http_client> client;
   try {
-        resp.wait();
-    } catch (web::http::http_exception& e) {
-        std::cout << "HTTP EXCEPTION: " << e.what() << " CODE: " <<
-  e.error_code() << std::endl; raise(SIGTRAP); } catch (std::exception& e) {
-        std::cout << "EXCEPTION: " << e.what() << std::endl;
-        raise(SIGTRAP);
+    const uri request_uri(conversions::to_string_t(url));
+    client = clientForURI(request_uri);
+    req.set_request_uri(request_uri.resource());
+  } catch (const std::exception &) {
+    finishRequest(
+        request_info,
+        std::make_shared<ResponseImplementation>(request, nullptr, 0, StatusCodeInvalid, false));
+    return;
+  }
+  // A sent request cannot be sent again, so keep the headers for any redirect
+  const http_headers headers = req.headers();
+  client->request(req, request_info->cancellation.get_token())
+      .then([strong_this, request_info, request, headers, url, redirects](
+                http_response response) -> pplx::task<void> {
+        // The continuation runs once the status line and headers have arrived
+        notifyRequestObserver(strong_this->_request_observer, RequestEventFirstByte, request);
+        StatusCode status = StatusCode(response.status_code());
+
+        // Follow the redirect on the same slot, rather than queueing it as a new request
+        if (isRedirect(status) && redirects < MAX_REDIRECTS) {
+          const std::string new_url = getRedirectUrl(response, url);
+          http_request redirect_request(methods::GET);
+          redirect_request.headers() = headers;
+          strong_this->sendRequest(request_info, redirect_request, new_url, redirects + 1);
+          return pplx::task_from_result();
+        }
+        // Read the body without holding a thread while it arrives
+        return response.extract_vector().then(
+            [strong_this, request_info, request, status](std::vector<unsigned char> data) {
+              // printf("Returning response (status = %d)\n", status);
+              incrementCounter(strong_this->_bytes_received, data.size());
+              std::shared_ptr<ResponseImplementation> r = std::make_shared<ResponseImplementation>(
+                  request, data.data(), data.size(), status, false);
+              const std::string download_path = request->downloadPath();
+              if (!download_path.empty() && status >= 200 && status < 300 &&
+                  writeDownloadFile(download_path, data.data(), data.size())) {
+                r->setDataPath(download_path, data.size());
+              }
+              strong_this->finishRequest(request_info, r);
+            });
+      })
+      .then([strong_this, request_info, request](pplx::task<void> task) {
+        try {
+          task.get();
+        } catch (const std::exception &) {
+          // Connection failures surface here, give the caller an invalid response instead
+          strong_this->finishRequest(request_info,
+                                     std::make_shared<ResponseImplementation>(
+                                         request, nullptr, 0, StatusCodeInvalid, false));
+        }
+      });
+}
+
+void ClientCpprestsdk::finishRequest(const std::shared_ptr<RequestInfo> &request_info,
+                                     const std::shared_ptr<Response> &response) {
+  // Hand the slot on before calling back, in case the callback adds a new request
+  std::vector<std::shared_ptr<RequestInfo>> ready_requests;
+  {
+    std::lock_guard<std::mutex> client_lock(_client_mutex);
+    // A failing callback surfaces in the task chain again, and cancelled requests finish early
+    if (request_info->finished) {
+      return;
     }
-  */
+    request_info->finished = true;
+    _requests.erase(request_info->request_id);
+    _running_requests[request_info->priority]--;
+    ready_requests = scheduleRequests();
+  }
+  for (const auto &ready_request : ready_requests) {
+    startRequest(ready_request);
+  }
+  if (request_info->callback) {
+    request_info->callback(response);
+  }
+}
 
-  std::string request_hash = request->hash();
-  std::shared_ptr<RequestToken> request_token =
-      std::make_shared<RequestTokenImplementation>(shared_from_this(), request_hash);
-  return request_token;
+long ClientCpprestsdk::maximumRunningRequests(RequestPriority priority) {
+  switch (priority) {
+    case RequestPriorityHigh:
+      return MAX_HIGH_PRIORITY_REQUESTS;
+    case RequestPriorityLow:
+      return MAX_LOW_PRIORITY_REQUESTS;
+    default:
+      return MAX_NORMAL_PRIORITY_REQUESTS;
+  }
+}
+
+Statistics ClientCpprestsdk::stats() const {
+  Statistics statistics;
+  statistics.native = _metrics->statistics();
+  statistics.bytes_sent = counterValue(_bytes_sent);
+  statistics.bytes_received = counterValue(_bytes_received);
+  return statistics;
+}
+
+void ClientCpprestsdk::requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) {
+  const uint64_t request_id = std::strtoull(request_token->identifier().c_str(), nullptr, 10);
+  std::shared_ptr<RequestInfo> request_info;
+  std::vector<std::shared_ptr<RequestInfo>> ready_requests;
+  {
+    std::lock_guard<std::mutex> client_lock(_client_mutex);
+    auto request_it = _requests.find(request_id);
+    if (request_it == _requests.end()) {
+      // Already answered
+      return;
+    }
+    request_info = request_it->second;
+    _requests.erase(request_it);
+    request_info->finished = true;
+    if (request_info->running) {
+      _running_requests[request_info->priority]--;
+      ready_requests = scheduleRequests();
+    } else {
+      auto &pending_requests = _pending_requests[request_info->priority];
+      pending_requests.erase(
+          std::remove(pending_requests.begin(), pending_requests.end(), request_info),
+          pending_requests.end());
+    }
+  }
+  // Running requests are abandoned by cpprestsdk, the task chain then finds them finished
+  request_info->cancellation.cancel();
+  for (const auto &ready_request : ready_requests) {
+    startRequest(ready_request);
+  }
+  notifyRequestObserver(_request_observer, RequestEventCancelled, request_info->request);
+  if (request_info->callback) {
+    request_info->callback(std::make_shared<ResponseImplementation>(
+        request_info->request, nullptr, 0, StatusCodeInvalid, true));
+  }
 }
 
-void ClientCpprestsdk::requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) {}
+ClientCpprestsdk::RequestInfo::RequestInfo(
+    const std::shared_ptr<Request> &req,
+    uint64_t id,
+    std::function<void(const std::shared_ptr<Response> &)> cbk)
+    : request(req),
+      request_id(id),
+      callback(cbk),
+      priority(req->priority()),
+      running(false),
+      finished(false) {}
 
 const std::map<std::string, web::http::method> &methodMap() {
   static const std::map<std::string, web::http::method> method_map = {
@@ -131,6 +334,10 @@ const web::http::client::http_client_config &clientConfigForProxy() {
     else
       client_config.set_proxy(web::web_proxy(env_http_proxy_string));
   }
+#if !defined(CPPREST_EXCLUDE_COMPRESSION)
+  // Negotiate gzip and deflate and decompress the body as it arrives
+  client_config.set_request_compressed_response(true);
+#endif
 
   return client_config;
 }
@@ -154,8 +361,9 @@ static const std::string getRedirectUrl(const http_response &response,
   return !std::strncmp("http", location.c_str(), 4) ? location : request_url + location;
 }
 
-std::shared_ptr<Client> createCpprestsdkClient() {
-  return std::make_shared<ClientCpprestsdk>();
+std::shared_ptr<Client> createCpprestsdkClient(
+    const std::shared_ptr<RequestObserver> &request_observer) {
+  return std::make_shared<ClientCpprestsdk>(request_observer);
 }
 
 }  // namespace http
@@ -25,13 +25,19 @@
 #include <NFHTTP/Client.h>
 #include <NFHTTP/ResponseImplementation.h>
 
+#include "Metrics.h"
 #include "RequestTokenDelegate.h"
 #include "RequestTokenImplementation.h"
 
 #include <cpprest/filestream.h>
 #include <cpprest/http_client.h>
 
-#include <thread>
+#include <atomic>
+#include <deque>
+#include <map>
+#include <mutex>
+#include <unordered_map>
+#include <vector>
 
 namespace nativeformat {
 namespace http {
@@ -39,20 +45,74 @@ namespace http {
 class ClientCpprestsdk : public Client,
                          public RequestTokenDelegate,
                          public std::enable_shared_from_this<ClientCpprestsdk> {
+  struct RequestInfo {
+    const std::shared_ptr<Request> request;
+    // Identical requests share a hash, so requests are told apart by an id of their own
+    const uint64_t request_id;
+    std::function<void(const std::shared_ptr<Response> &)> callback;
+    RequestPriority priority;
+    // Guarded by the client mutex, a request is answered exactly once
+    bool running;
+    bool finished;
+    pplx::cancellation_token_source cancellation;
+    RequestInfo(const std::shared_ptr<Request> &req,
+                uint64_t id,
+                std::function<void(const std::shared_ptr<Response> &)> cbk);
+  };
+
  public:
-  ClientCpprestsdk();
+  ClientCpprestsdk(const std::shared_ptr<RequestObserver> &request_observer = nullptr);
   virtual ~ClientCpprestsdk();
 
+  // The same limits the curl backend applies
+  static const long MAX_HIGH_PRIORITY_REQUESTS = 32;
+  static const long MAX_NORMAL_PRIORITY_REQUESTS = 32;
+  static const long MAX_LOW_PRIORITY_REQUESTS = 4;
+  static const int MAX_REDIRECTS = 10;
+
   // Client
   std::shared_ptr<RequestToken> performRequest(
       const std::shared_ptr<Request> &request,
       std::function<void(const std::shared_ptr<Response> &)> callback) override;
+  Statistics stats() const override;
 
   // RequestTokenDelegate
   void requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) override;
+
+ private:
+  // Obtain this lock before modifying any members
+  std::mutex _client_mutex;
+
+  // One client per scheme, host and port, so connections are kept alive between requests
+  std::unordered_map<std::string, std::shared_ptr<web::http::client::http_client>> _clients;
+
+  // Requests that have not been answered yet, by id
+  std::unordered_map<uint64_t, std::shared_ptr<RequestInfo>> _requests;
+  std::atomic<uint64_t> _next_request_id;
+
+  // Requests waiting for a slot, and the number of running requests, for each priority
+  std::map<RequestPriority, std::deque<std::shared_ptr<RequestInfo>>> _pending_requests;
+  std::map<RequestPriority, long> _running_requests;
+
+  const std::shared_ptr<LayerMetrics> _metrics;
+  std::atomic<uint64_t> _bytes_sent;
+  std::atomic<uint64_t> _bytes_received;
+  const std::shared_ptr<RequestObserver> _request_observer;
+
+  std::shared_ptr<web::http::client::http_client> clientForURI(const web::uri &request_uri);
+  std::vector<std::shared_ptr<RequestInfo>> scheduleRequests();
+  void startRequest(const std::shared_ptr<RequestInfo> &request_info);
+  void sendRequest(const std::shared_ptr<RequestInfo> &request_info,
+                   web::http::http_request req,
+                   const std::string &url,
+                   int redirects);
+  void finishRequest(const std::shared_ptr<RequestInfo> &request_info,
+                     const std::shared_ptr<Response> &response);
+  static long maximumRunningRequests(RequestPriority priority);
 };
 
-extern std::shared_ptr<Client> createCpprestsdkClient();
+extern std::shared_ptr<Client> createCpprestsdkClient(
+    const std::shared_ptr<RequestObserver> &request_observer = nullptr);
 
 }  // namespace http
 }  // namespace nativeformat
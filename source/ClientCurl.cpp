@@ -20,16 +20,137 @@
  */
 #include "ClientCurl.h"
 
+#include <algorithm>
+#include <cstdlib>
 #include <cstring>
 #include <sstream>
 #include <curl/multi.h>
 #include <unistd.h>
 
+#include "DownloadFile.h"
+#include "RequestObserverNotification.h"
+#include "Timing.h"
+
 namespace nativeformat {
 namespace http {
 
 namespace {
 
+static const std::string WIRE_SIZE_KEY("wire_size");
+static const std::string DECODED_SIZE_KEY("decoded_size");
+static const std::string HTTP_VERSION_KEY("http_version");
+static const std::string QUEUE_TIME_KEY("queue_time");
+static const std::string DNS_TIME_KEY("dns_time");
+static const std::string CONNECT_TIME_KEY("connect_time");
+static const std::string TLS_TIME_KEY("tls_time");
+static const std::string FIRST_BYTE_TIME_KEY("first_byte_time");
+static const std::string TOTAL_TIME_KEY("total_time");
+static const std::string BYTES_SENT_KEY("bytes_sent");
+static const std::string REDIRECT_COUNT_KEY("redirect_count");
+static const std::string CONNECTION_REUSED_KEY("connection_reused");
+
+#if LIBCURL_VERSION_NUM >= 0x073200
+static std::string httpVersionString(long http_version) {
+  switch (http_version) {
+    case CURL_HTTP_VERSION_1_0:
+      return "1.0";
+    case CURL_HTTP_VERSION_1_1:
+      return "1.1";
+    case CURL_HTTP_VERSION_2_0:
+      return "2";
+#if LIBCURL_VERSION_NUM >= 0x074200
+    case CURL_HTTP_VERSION_3:
+      return "3";
+#endif
+    default:
+      return "";
+  }
+}
+#endif
+
+static std::unordered_map<std::string, std::string> transferMetadata(CURL *handle) {
+  // curl reports each phase as the time elapsed since the transfer started, so the phases
+  // before the first byte are broken out into their own durations
+  double dns_time = 0.0;
+  double connect_time = 0.0;
+  double tls_time = 0.0;
+  double first_byte_time = 0.0;
+  double total_time = 0.0;
+  double bytes_sent = 0.0;
+  long redirect_count = 0;
+  long connects = 0;
+  curl_easy_getinfo(handle, CURLINFO_NAMELOOKUP_TIME, &dns_time);
+  curl_easy_getinfo(handle, CURLINFO_CONNECT_TIME, &connect_time);
+  curl_easy_getinfo(handle, CURLINFO_APPCONNECT_TIME, &tls_time);
+  curl_easy_getinfo(handle, CURLINFO_STARTTRANSFER_TIME, &first_byte_time);
+  curl_easy_getinfo(handle, CURLINFO_TOTAL_TIME, &total_time);
+  curl_easy_getinfo(handle, CURLINFO_SIZE_UPLOAD, &bytes_sent);
+  curl_easy_getinfo(handle, CURLINFO_REDIRECT_COUNT, &redirect_count);
+  curl_easy_getinfo(handle, CURLINFO_NUM_CONNECTS, &connects);
+
+  std::unordered_map<std::string, std::string> metadata;
+  metadata[DNS_TIME_KEY] = timingString(dns_time);
+  metadata[CONNECT_TIME_KEY] = timingString(std::max(connect_time - dns_time, 0.0));
+  metadata[TLS_TIME_KEY] =
+      timingString(tls_time > 0.0 ? std::max(tls_time - connect_time, 0.0) : 0.0);
+  metadata[FIRST_BYTE_TIME_KEY] = timingString(first_byte_time);
+  metadata[TOTAL_TIME_KEY] = timingString(total_time);
+  metadata[BYTES_SENT_KEY] = std::to_string((long long)bytes_sent);
+  metadata[REDIRECT_COUNT_KEY] = std::to_string(redirect_count);
+  metadata[CONNECTION_REUSED_KEY] = connects == 0 ? "1" : "0";
+#if LIBCURL_VERSION_NUM >= 0x073200
+  long http_version = 0;
+  curl_easy_getinfo(handle, CURLINFO_HTTP_VERSION, &http_version);
+  metadata[HTTP_VERSION_KEY] = httpVersionString(http_version);
+#endif
+  return metadata;
+}
+
+static bool headerNameEquals(const std::string &header_name, const std::string &other_header_name) {
+  return header_name.size() == other_header_name.size() &&
+         std::equal(
+             header_name.begin(), header_name.end(), other_header_name.begin(), [](char a, char b) {
+               return tolower(a) == tolower(b);
+             });
+}
+
+static bool isSecureURL(const std::string &url) {
+  static const std::string secure_scheme("https://");
+  return url.size() >= secure_scheme.size() &&
+         std::equal(secure_scheme.begin(), secure_scheme.end(), url.begin(), [](char a, char b) {
+           return a == tolower(b);
+         });
+}
+
+static bool hasHeader(const std::unordered_map<std::string, std::string> &headers,
+                      const std::string &header_name) {
+  return std::any_of(headers.begin(),
+                     headers.end(),
+                     [&header_name](const std::pair<const std::string, std::string> &header) {
+                       return headerNameEquals(header.first, header_name);
+                     });
+}
+
+static bool hasContentEncoding(const std::unordered_map<std::string, std::string> &headers) {
+  // An identity encoding means the body was sent as it is, so curl had nothing to decode
+  return std::any_of(
+      headers.begin(), headers.end(), [](const std::pair<const std::string, std::string> &header) {
+        return headerNameEquals(header.first, "Content-Encoding") &&
+               !headerNameEquals(header.second, "identity");
+      });
+}
+
+static void removeHeader(std::unordered_map<std::string, std::string> &headers,
+                         const std::string &header_name) {
+  for (auto header_iterator = headers.begin(); header_iterator != headers.end();) {
+    if (headerNameEquals(header_iterator->first, header_name)) {
+      header_iterator = headers.erase(header_iterator);
+    } else {
+      ++header_iterator;
+    }
+  }
+}
+
 static void setupCurlGlobalState(bool added_client) {
   static long curl_clients_active = 0;
   static std::mutex curl_clients_active_mutex;
@@ -47,44 +168,102 @@ static void setupCurlGlobalState(bool added_client) {
   }
 }
 
+// Set when a client is destroyed, so that if that happened inside one of its own callbacks the
+// code that called back knows to leave without touching the client again
+static thread_local const ClientCurl *destroyed_client = nullptr;
+
 }  // namespace
 
-ClientCurl::ClientCurl() : _new_request(false), _is_terminated(false) {
+ClientCurl::ClientCurl(const std::shared_ptr<RequestObserver> &request_observer,
+                       WATCH_SOCKET_FUNCTION watch_socket_function,
+                       SET_TIMEOUT_FUNCTION set_timeout_function,
+                       long max_connections,
+                       long max_streams_per_connection)
+    : _new_request(false),
+      _is_terminated(false),
+      _next_handle_id(0),
+      _low_priority_paused(false),
+      _metrics(std::make_shared<LayerMetrics>()),
+      _bytes_sent(0),
+      _bytes_received(0),
+      _request_observer(request_observer),
+      _watch_socket_function(watch_socket_function),
+      _set_timeout_function(set_timeout_function) {
+  if (destroyed_client == this) {
+    // A client destroyed earlier on this thread had our address
+    destroyed_client = nullptr;
+  }
+  // libcurl is initialised here for both modes, before any handle is created, as event loop
+  // clients never run mainClientLoop
   setupCurlGlobalState(true);
   _curl = curl_multi_init();
-  curl_multi_setopt(_curl, CURLMOPT_MAXCONNECTS, MAX_CONNECTIONS);
+  curl_multi_setopt(_curl, CURLMOPT_MAXCONNECTS, max_connections);
+#if LIBCURL_VERSION_NUM >= 0x072b00
+  // Multiplex concurrent requests to the same host over a single HTTP/2 connection
+  curl_multi_setopt(_curl, CURLMOPT_PIPELINING, CURLPIPE_MULTIPLEX);
+#endif
+#if LIBCURL_VERSION_NUM >= 0x074300
+  curl_multi_setopt(_curl, CURLMOPT_MAX_CONCURRENT_STREAMS, max_streams_per_connection);
+#endif
+  if (_watch_socket_function) {
+    // The application's loop watches the sockets, so there is no request thread to start
+    curl_multi_setopt(_curl, CURLMOPT_SOCKETFUNCTION, &ClientCurl::socket_callback);
+    curl_multi_setopt(_curl, CURLMOPT_SOCKETDATA, this);
+    curl_multi_setopt(_curl, CURLMOPT_TIMERFUNCTION, &ClientCurl::timer_callback);
+    curl_multi_setopt(_curl, CURLMOPT_TIMERDATA, this);
+    return;
+  }
   _request_thread = std::thread(&ClientCurl::mainClientLoop, this);
 }
 
 ClientCurl::~ClientCurl() {
-  std::unique_lock<std::mutex> client_lock(_client_mutex);
+  destroyed_client = this;
+  if (_request_thread.get_id() == std::this_thread::get_id()) {
+    // Destroyed from a callback, so the request thread cannot wait for itself to finish. It
+    // returns from the callback and leaves on its own
+    _request_thread.detach();
+  }
+  // Stop the request thread before taking curl away from under it
+  {
+    std::lock_guard<std::mutex> client_lock(_client_mutex);
+    _is_terminated = true;
+  }
+  _new_info_condition.notify_all();
+  if (_request_thread.joinable()) {
+    wakeRequestThread();
+    _request_thread.join();
+  }
 
+  std::unique_lock<std::mutex> client_lock(_client_mutex);
   // Remove any remaining requests
-  std::vector<std::string> hashes;
+  std::vector<uint64_t> handle_ids;
   for (auto &p : _handles) {
-    hashes.push_back(p.first);
-    curl_multi_remove_handle(_curl, p.second->handle);
+    handle_ids.push_back(p.first);
+    if (p.second->running) {
+      curl_multi_remove_handle(_curl, p.second->handle);
+    }
   }
-  for (auto h : hashes) {
-    requestCleanup(h);
+  for (auto handle_id : handle_ids) {
+    requestCleanup(handle_id);
   }
 
   curl_multi_cleanup(_curl);
   setupCurlGlobalState(false);
-  _is_terminated = true;
-  client_lock.unlock();
-
-  _new_info_condition.notify_all();
-  _request_thread.join();
 }
 
-size_t ClientCurl::header_callback(char *data, size_t size, size_t nitems, void *str) {
-  auto headers = reinterpret_cast<std::unordered_map<std::string, std::string> *>(str);
+size_t ClientCurl::header_callback(char *data, size_t size, size_t nitems, void *handle_info) {
+  auto info = static_cast<HandleInfo *>(handle_info);
+  if (!info->first_byte_received) {
+    info->first_byte_received = true;
+    notifyRequestObserver(info->request_observer, RequestEventFirstByte, info->request_hash);
+  }
+  auto headers = &info->response_headers;
   std::string s(data, size * nitems), k, v;
   size_t pos;
   if ((pos = s.find(":")) != std::string::npos) {
     k = s.substr(0, pos);
     v = s.substr(std::min(pos + 2, s.length()));
+    v.erase(v.find_last_not_of("\r\n") + 1);
   }
   if (!k.empty()) {
     (*headers)[k] = v;
@@ -97,101 +276,162 @@ size_t ClientCurl::write_callback(char *data, size_t size, size_t nitems, void *
   if (string_buffer == nullptr) {
     return 0;
   }
-  // Perhaps it would be good to have a file-backed option?
   string_buffer->append(data, size * nitems);
   return size * nitems;
 }
 
+size_t ClientCurl::file_write_callback(char *data, size_t size, size_t nitems, void *file) {
+  return fwrite(data, size, nitems, static_cast<FILE *>(file)) * size;
+}
+
+size_t ClientCurl::file_read_callback(char *data, size_t size, size_t nitems, void *file) {
+  return fread(data, 1, size * nitems, static_cast<FILE *>(file));
+}
+
+int ClientCurl::file_seek_callback(void *file, curl_off_t offset, int origin) {
+  return fseek(static_cast<FILE *>(file), offset, origin) == 0 ? CURL_SEEKFUNC_OK
+                                                               : CURL_SEEKFUNC_CANTSEEK;
+}
+
+size_t ClientCurl::provider_read_callback(char *data, size_t size, size_t nitems, void *provider) {
+  auto data_provider = static_cast<REQUEST_DATA_PROVIDER_FUNCTION *>(provider);
+  return (*data_provider)(reinterpret_cast<unsigned char *>(data), size * nitems);
+}
+
+int ClientCurl::socket_callback(
+    CURL *handle, curl_socket_t socket, int what, void *client, void *socket_data) {
+  auto curl_client = static_cast<ClientCurl *>(client);
+  int events = EventLoopEventNone;
+  if (what == CURL_POLL_IN || what == CURL_POLL_INOUT) {
+    events |= EventLoopEventRead;
+  }
+  if (what == CURL_POLL_OUT || what == CURL_POLL_INOUT) {
+    events |= EventLoopEventWrite;
+  }
+  curl_client->_watch_socket_function(static_cast<EVENT_LOOP_SOCKET>(socket), events);
+  return 0;
+}
+
+int ClientCurl::timer_callback(CURLM *multi, long timeout_ms, void *client) {
+  auto curl_client = static_cast<ClientCurl *>(client);
+  if (curl_client->_set_timeout_function) {
+    curl_client->_set_timeout_function(timeout_ms);
+  }
+  return 0;
+}
+
 std::shared_ptr<RequestToken> ClientCurl::performRequest(
     const std::shared_ptr<Request> &request,
     std::function<void(const std::shared_ptr<Response> &)> callback) {
-  // Lock client mutex before adding request
-  std::unique_lock<std::mutex> client_lock(_client_mutex);
-
-  std::string request_hash = request->hash();
+  return performRequests({request}, {callback}).front();
+}
 
-  // Add callback and request to map members
-  std::shared_ptr<RequestToken> request_token =
-      std::make_shared<RequestTokenImplementation>(shared_from_this(), request_hash);
+std::vector<std::shared_ptr<RequestToken>> ClientCurl::performRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks) {
+  // Configure the easy handles before taking the lock
+  std::vector<std::unique_ptr<HandleInfo>> handle_infos;
+  std::vector<std::shared_ptr<RequestToken>> request_tokens;
+  for (size_t i = 0; i < requests.size(); ++i) {
+    const uint64_t handle_id = _next_handle_id++;
+    handle_infos.push_back(std::unique_ptr<HandleInfo>(
+        new HandleInfo(requests[i],
+                       handle_id,
+                       LayerMetrics::trackRequest(_metrics, callbacks[i]),
+                       _request_observer)));
+    request_tokens.push_back(std::make_shared<RequestTokenImplementation>(
+        shared_from_this(), std::to_string(handle_id)));
+  }
 
-  _handles[request_hash] = std::unique_ptr<HandleInfo>(new HandleInfo(request, callback));
-  std::unique_ptr<HandleInfo> &handle_info = _handles[request_hash];
+  // Lock client mutex once for the whole batch
+  std::unique_lock<std::mutex> client_lock = lockClient();
+  bool failed_requests = false;
+  for (auto &handle_info : handle_infos) {
+    // Queue the easy handle, the request thread adds it to the multi handle when there is room
+    const uint64_t handle_id = handle_info->handle_id;
+    if (handle_info->failed) {
+      _failed_handles.push_back(handle_id);
+      failed_requests = true;
+    } else {
+      _pending_handles[handle_info->priority].push_back(handle_id);
+    }
+    _handles[handle_id] = std::move(handle_info);
+  }
 
-  // Add easy handle to multi handle
-  curl_multi_add_handle(_curl, handle_info->handle);
+  if (_watch_socket_function) {
+    // Start what we can now, curl asks the event loop for a timeout to drive the transfers
+    scheduleRequests();
+    if (failed_requests && _set_timeout_function) {
+      // Failed requests are answered from the loop, so have it come back straight away
+      _set_timeout_function(0);
+    }
+    return request_tokens;
+  }
 
   // Wake up request thread if it's waiting
   _new_request = true;
   client_lock.unlock();
   _new_info_condition.notify_one();
+  wakeRequestThread();
+
+  return request_tokens;
+}
+
+Statistics ClientCurl::stats() const {
+  Statistics statistics;
+  statistics.native = _metrics->statistics();
+  statistics.bytes_sent = counterValue(_bytes_sent);
+  statistics.bytes_received = counterValue(_bytes_received);
+  return statistics;
+}
+
+void ClientCurl::process(EVENT_LOOP_SOCKET socket, int events) {
+  int curl_events = 0;
+  if (events & EventLoopEventRead) {
+    curl_events |= CURL_CSELECT_IN;
+  }
+  if (events & EventLoopEventWrite) {
+    curl_events |= CURL_CSELECT_OUT;
+  }
+  if (events & EventLoopEventError) {
+    curl_events |= CURL_CSELECT_ERR;
+  }
+  socketAction(static_cast<curl_socket_t>(socket), curl_events);
+}
+
+void ClientCurl::onTimeout() {
+  socketAction(CURL_SOCKET_TIMEOUT, 0);
+}
 
-  return request_token;
+void ClientCurl::socketAction(curl_socket_t socket, int curl_events) {
+  if (!_watch_socket_function) {
+    return;
+  }
+  std::unique_lock<std::mutex> client_lock = lockClient();
+  int running_handles = 0;
+  curl_multi_socket_action(_curl, socket, curl_events, &running_handles);
+  // Finished requests free up slots for the ones waiting on them
+  if (finishRequests(client_lock) > 0 && destroyed_client != this) {
+    scheduleRequests();
+  }
 }
 
 void ClientCurl::mainClientLoop() {
-  CURLMsg *msg;
   long L = 0;
-  int M, Q, active_requests = -1;
+  int M, active_requests = -1;
   fd_set R, W, E;
   struct timeval T;
 
-  curl_global_init(CURL_GLOBAL_ALL);
-
   std::unique_lock<std::mutex> client_lock(_client_mutex);
-  while (true) {
+  while (!_is_terminated) {
     // launch any waiting requests
+    scheduleRequests();
     curl_multi_perform(_curl, &active_requests);
 
     // read any messages that are ready
-    size_t msg_count = 0;
-    while ((msg = curl_multi_info_read(_curl, &Q))) {
-      msg_count++;
-      if (msg->msg == CURLMSG_DONE) {
-        std::string *request_hash;
-        CURL *e = msg->easy_handle;
-        curl_easy_getinfo(msg->easy_handle, CURLINFO_PRIVATE, &request_hash);
-
-        // TODO retry?
-        if (msg->data.result == CURLE_OPERATION_TIMEDOUT) {
-        }
-
-        // make response to send to callback
-        long status_code = 0;
-        curl_easy_getinfo(e, CURLINFO_RESPONSE_CODE, &status_code);
-
-        // Look up response data and original request
-        HandleInfo *handle_info = _handles[*request_hash].get();
-        const std::shared_ptr<Request> request = handle_info->request;
-        const unsigned char *data = (const unsigned char *)handle_info->response.c_str();
-        size_t data_length = handle_info->response.size();
-
-        /*
-        printf("Got response for: %s\n", request->url().c_str());
-        printf("Response code: %lu\n", status_code);
-        printf("Response size: %lu\n", data_length);
-        */
-
-        std::shared_ptr<Response> new_response = std::make_shared<ResponseImplementation>(
-            request, data, data_length, StatusCode(status_code), false);
-
-        auto &response_headers = new_response->headerMap();
-        response_headers = std::move(handle_info->response_headers);
-
-        // Save callback before cleanup
-        auto cb = handle_info->callback;
-        curl_multi_remove_handle(_curl, e);
-        requestCleanup(*request_hash);
-
-        if (cb) {
-          // Release lock before calling callback
-          // In case the callback adds a new request
-          client_lock.unlock();
-          cb(new_response);
-          client_lock.lock();
-        }
-      } else {
-        fprintf(stderr, "E: CURLMsg (%d)\n", msg->msg);
-      }
+    size_t msg_count = finishRequests(client_lock);
+    if (destroyed_client == this) {
+      return;
     }
 
     // If we processed a message since checking the active request count,
@@ -199,6 +439,19 @@ void ClientCurl::mainClientLoop() {
     if (msg_count) continue;
 
     if (active_requests) {
+      if (curl_multi_timeout(_curl, &L)) {
+        fprintf(stderr, "E: curl_multi_timeout\n");
+      }
+      if (L == -1) L = 100;
+
+      // Only this thread drives curl, so the lock is let go while waiting on the sockets. Other
+      // threads queue their requests and cancellations in the meantime and wake us up
+      client_lock.unlock();
+#if LIBCURL_VERSION_NUM >= 0x074400
+      // Transfers waiting on a connection have no socket to wake us up, so come back to them
+      // as often as curl suggests for that case
+      curl_multi_poll(_curl, nullptr, 0, static_cast<int>(std::min(L, 100L)), nullptr);
+#else
       FD_ZERO(&R);
       FD_ZERO(&W);
       FD_ZERO(&E);
@@ -207,15 +460,8 @@ void ClientCurl::mainClientLoop() {
         fprintf(stderr, "E: curl_multi_fdset\n");
       }
 
-      if (curl_multi_timeout(_curl, &L)) {
-        fprintf(stderr, "E: curl_multi_timeout\n");
-      }
-      if (L == -1) L = 100;
-
       if (M == -1) {
-        client_lock.unlock();
         usleep((unsigned long)L);
-        client_lock.lock();
       } else {
         T.tv_sec = L / 1000;
         T.tv_usec = (L % 1000) * 1000;
@@ -224,6 +470,8 @@ void ClientCurl::mainClientLoop() {
           fprintf(stderr, "E: select(%i,,,,%li): %i: %s\n", M + 1, L, errno, strerror(errno));
         }
       }
+#endif
+      client_lock.lock();
     } else {
       // If there are no active requests, wait on condition variable
       _new_request = false;
@@ -236,24 +484,354 @@ void ClientCurl::mainClientLoop() {
   }
 }
 
-void ClientCurl::requestCleanup(std::string hash) {
-  _handles.erase(hash);
+size_t ClientCurl::finishFailedRequests(std::unique_lock<std::mutex> &client_lock) {
+  size_t failed_count = 0;
+  while (!_failed_handles.empty()) {
+    auto handle_it = _handles.find(_failed_handles.front());
+    _failed_handles.pop_front();
+    if (handle_it == _handles.end() || !handle_it->second->failed) {
+      continue;
+    }
+    failed_count++;
+    const std::shared_ptr<Request> request = handle_it->second->request;
+    auto cb = handle_it->second->callback;
+    requestCleanup(handle_it->first);
+
+    unlockClient(client_lock);
+    if (cb) {
+      cb(std::make_shared<ResponseImplementation>(request, nullptr, 0, StatusCodeInvalid, false));
+    }
+    if (destroyed_client == this) {
+      return failed_count;
+    }
+    relockClient(client_lock);
+  }
+  return failed_count;
+}
+
+size_t ClientCurl::finishCancelledRequests(std::unique_lock<std::mutex> &client_lock) {
+  size_t cancelled_count = 0;
+  while (!_cancelled_handles.empty()) {
+    auto handle_it = _handles.find(_cancelled_handles.front());
+    _cancelled_handles.pop_front();
+    if (handle_it == _handles.end()) {
+      continue;
+    }
+    cancelled_count++;
+    HandleInfo *handle_info = handle_it->second.get();
+    if (handle_info->running) {
+      curl_multi_remove_handle(_curl, handle_info->handle);
+      _running_handles[handle_info->priority]--;
+    } else if (!handle_info->failed) {
+      auto &pending_handles = _pending_handles[handle_info->priority];
+      auto pending_it =
+          std::find(pending_handles.begin(), pending_handles.end(), handle_info->handle_id);
+      if (pending_it != pending_handles.end()) {
+        pending_handles.erase(pending_it);
+      }
+    }
+    const std::shared_ptr<Request> request = handle_info->request;
+    const std::string request_hash = handle_info->request_hash;
+    auto cb = handle_info->callback;
+    requestCleanup(handle_it->first);
+
+    unlockClient(client_lock);
+    notifyRequestObserver(_request_observer, RequestEventCancelled, request_hash);
+    if (cb) {
+      cb(std::make_shared<ResponseImplementation>(request, nullptr, 0, StatusCodeInvalid, true));
+    }
+    if (destroyed_client == this) {
+      return cancelled_count;
+    }
+    relockClient(client_lock);
+  }
+  return cancelled_count;
+}
+
+size_t ClientCurl::finishRequests(std::unique_lock<std::mutex> &client_lock) {
+  CURLMsg *msg;
+  int Q;
+  size_t msg_count = finishCancelledRequests(client_lock);
+  if (destroyed_client == this) {
+    return msg_count;
+  }
+  msg_count += finishFailedRequests(client_lock);
+  if (destroyed_client == this) {
+    return msg_count;
+  }
+  while ((msg = curl_multi_info_read(_curl, &Q))) {
+    msg_count++;
+    if (msg->msg == CURLMSG_DONE) {
+      HandleInfo *handle_info = nullptr;
+      CURL *e = msg->easy_handle;
+      curl_easy_getinfo(msg->easy_handle, CURLINFO_PRIVATE, &handle_info);
+
+      // TODO retry?
+      if (msg->data.result == CURLE_OPERATION_TIMEDOUT) {
+      }
+
+      // make response to send to callback
+      long status_code = 0;
+      curl_easy_getinfo(e, CURLINFO_RESPONSE_CODE, &status_code);
+
+      // Look up response data and original request
+      const std::shared_ptr<Request> request = handle_info->request;
+      std::string data = std::move(handle_info->response);
+      std::unordered_map<std::string, std::string> response_headers =
+          std::move(handle_info->response_headers);
+      FILE *download_file = handle_info->download_file;
+      handle_info->download_file = nullptr;
+      const CURLcode result = msg->data.result;
+      const bool decode_content = handle_info->decode_content;
+#if LIBCURL_VERSION_NUM >= 0x073700
+      curl_off_t wire_size = 0;
+      curl_easy_getinfo(e, CURLINFO_SIZE_DOWNLOAD_T, &wire_size);
+#else
+      double wire_size = 0;
+      curl_easy_getinfo(e, CURLINFO_SIZE_DOWNLOAD, &wire_size);
+#endif
+      double bytes_sent = 0.0;
+      curl_easy_getinfo(e, CURLINFO_SIZE_UPLOAD, &bytes_sent);
+      incrementCounter(_bytes_sent, static_cast<uint64_t>(bytes_sent));
+      incrementCounter(_bytes_received, static_cast<uint64_t>(wire_size));
+      std::unordered_map<std::string, std::string> transfer_metadata = transferMetadata(e);
+      transfer_metadata[QUEUE_TIME_KEY] = timingString(
+          std::chrono::duration<double>(handle_info->started_time - handle_info->enqueued_time)
+              .count());
+
+      /*
+      printf("Got response for: %s\n", request->url().c_str());
+      printf("Response code: %lu\n", status_code);
+      printf("Response size: %lu\n", data.size());
+      */
+
+      // Save callback before cleanup
+      auto cb = handle_info->callback;
+      _running_handles[handle_info->priority]--;
+      curl_multi_remove_handle(_curl, e);
+      requestCleanup(handle_info->handle_id);
+
+      // Release lock before finishing the response
+      // In case the callback adds a new request, or the download takes a while to sync
+      unlockClient(client_lock);
+      size_t download_length = 0;
+      bool downloaded = false;
+      if (download_file != nullptr) {
+        download_length = ftell(download_file);
+        if (result == CURLE_OK && status_code >= 200 && status_code < 300) {
+          downloaded = commitDownloadFile(download_file, request->downloadPath());
+          if (!downloaded) {
+            // The body never made it to the download path, so this is not a successful response
+            status_code = StatusCodeInvalid;
+            download_length = 0;
+          }
+        } else {
+          // Error bodies are small, so hand them back in memory rather than as the download
+          data.resize(download_length);
+          rewind(download_file);
+          if (download_length > 0 && fread(&data[0], download_length, 1, download_file) != 1) {
+            data.clear();
+          }
+          discardDownloadFile(download_file, request->downloadPath());
+        }
+      }
+      auto new_response =
+          std::make_shared<ResponseImplementation>(request,
+                                                   (const unsigned char *)data.c_str(),
+                                                   data.size(),
+                                                   StatusCode(status_code),
+                                                   false);
+      new_response->headerMap() = std::move(response_headers);
+      if (downloaded) {
+        new_response->setDataPath(request->downloadPath(), download_length);
+      }
+      if (decode_content && hasContentEncoding(new_response->headerMap())) {
+        // The body has already been decoded, so the encoding headers no longer describe it
+        removeHeader(new_response->headerMap(), "Content-Encoding");
+        removeHeader(new_response->headerMap(), "Content-Length");
+      }
+      new_response->setMetadata(WIRE_SIZE_KEY, std::to_string((long long)wire_size));
+      new_response->setMetadata(DECODED_SIZE_KEY,
+                                std::to_string(downloaded ? download_length : data.size()));
+      for (const auto &metadata : transfer_metadata) {
+        new_response->setMetadata(metadata.first, metadata.second);
+      }
+      if (cb) {
+        cb(new_response);
+      }
+      if (destroyed_client == this) {
+        return msg_count;
+      }
+      relockClient(client_lock);
+    } else {
+      fprintf(stderr, "E: CURLMsg (%d)\n", msg->msg);
+    }
+  }
+  return msg_count;
+}
+
+void ClientCurl::scheduleRequests() {
+  // Higher priorities get first pick of the free slots
+  for (auto it = _pending_handles.rbegin(); it != _pending_handles.rend(); ++it) {
+    const RequestPriority priority = it->first;
+    auto &pending_handles = it->second;
+    // Low priority requests wait until there are no high priority requests running
+    if (priority == RequestPriorityLow && _running_handles[RequestPriorityHigh] > 0) {
+      continue;
+    }
+    while (!pending_handles.empty() &&
+           _running_handles[priority] < maximumRunningRequests(priority)) {
+      auto handle_it = _handles.find(pending_handles.front());
+      pending_handles.pop_front();
+      if (handle_it == _handles.end() || handle_it->second->running) {
+        continue;
+      }
+      HandleInfo *handle_info = handle_it->second.get();
+      handle_info->running = true;
+      handle_info->started_time = timingNow();
+      notifyRequestObserver(
+          _request_observer, RequestEventNetworkStarted, handle_info->request_hash);
+      _running_handles[priority]++;
+      curl_multi_add_handle(_curl, handle_info->handle);
+    }
+  }
+
+  // Pause running low priority transfers while high priority ones are in flight
+  bool pause_low_priority = _running_handles[RequestPriorityHigh] > 0;
+  if (pause_low_priority == _low_priority_paused) {
+    return;
+  }
+  _low_priority_paused = pause_low_priority;
+  for (auto &handle_pair : _handles) {
+    HandleInfo *handle_info = handle_pair.second.get();
+    if (!handle_info->running || handle_info->priority != RequestPriorityLow ||
+        handle_info->paused == pause_low_priority) {
+      continue;
+    }
+    // Other requests may be waiting to multiplex over the connection a transfer is still
+    // setting up, so transfers are only paused once their response has started
+    if (pause_low_priority && !handle_info->first_byte_received) {
+      continue;
+    }
+    curl_easy_pause(handle_info->handle, pause_low_priority ? CURLPAUSE_ALL : CURLPAUSE_CONT);
+    handle_info->paused = pause_low_priority;
+  }
 }
 
-void ClientCurl::requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) {}
+long ClientCurl::maximumRunningRequests(RequestPriority priority) {
+  switch (priority) {
+    case RequestPriorityHigh:
+      return MAX_HIGH_PRIORITY_REQUESTS;
+    case RequestPriorityLow:
+      return MAX_LOW_PRIORITY_REQUESTS;
+    default:
+      return MAX_NORMAL_PRIORITY_REQUESTS;
+  }
+}
+
+void ClientCurl::requestCleanup(uint64_t handle_id) {
+  _handles.erase(handle_id);
+}
+
+void ClientCurl::requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) {
+  const uint64_t handle_id = std::strtoull(request_token->identifier().c_str(), nullptr, 10);
+  std::unique_lock<std::mutex> client_lock = lockClient();
+  if (_handles.find(handle_id) == _handles.end()) {
+    // Already answered
+    return;
+  }
+  // Only the thread driving curl may take a handle back out of it
+  _cancelled_handles.push_back(handle_id);
+  if (_watch_socket_function) {
+    finishCancelledRequests(client_lock);
+    if (destroyed_client != this) {
+      scheduleRequests();
+    }
+    return;
+  }
+  _new_request = true;
+  client_lock.unlock();
+  _new_info_condition.notify_one();
+  wakeRequestThread();
+}
+
+std::unique_lock<std::mutex> ClientCurl::lockClient() {
+  if (_watch_socket_function) {
+    // Only the event loop thread calls into the client, so there is nobody to lock out
+    return std::unique_lock<std::mutex>();
+  }
+  return std::unique_lock<std::mutex>(_client_mutex);
+}
+
+void ClientCurl::unlockClient(std::unique_lock<std::mutex> &client_lock) {
+  if (client_lock.owns_lock()) {
+    client_lock.unlock();
+  }
+}
+
+void ClientCurl::relockClient(std::unique_lock<std::mutex> &client_lock) {
+  if (client_lock.mutex() != nullptr) {
+    client_lock.lock();
+  }
+}
+
+void ClientCurl::wakeRequestThread() {
+#if LIBCURL_VERSION_NUM >= 0x074400
+  curl_multi_wakeup(_curl);
+#endif
+}
 
 ClientCurl::HandleInfo::HandleInfo(std::shared_ptr<Request> req,
-                                   std::function<void(const std::shared_ptr<Response> &)> cbk)
-    : request(req), request_headers(nullptr), callback(cbk) {
+                                   uint64_t id,
+                                   std::function<void(const std::shared_ptr<Response> &)> cbk,
+                                   const std::shared_ptr<RequestObserver> &observer)
+    : request(req),
+      handle_id(id),
+      download_file(nullptr),
+      upload_file(nullptr),
+      data_provider(nullptr),
+      request_headers(nullptr),
+      callback(cbk),
+      request_observer(observer),
+      priority(req->priority()),
+      decode_content(false),
+      running(false),
+      paused(false),
+      first_byte_received(false),
+      failed(false),
+      enqueued_time(timingNow()),
+      started_time(enqueued_time) {
   handle = curl_easy_init();
   request_hash = request->hash();
   configureCurlHandle();
 }
 
 ClientCurl::HandleInfo::HandleInfo()
-    : handle(nullptr), request(nullptr), request_headers(nullptr), callback(nullptr) {}
+    : handle(nullptr),
+      request(nullptr),
+      handle_id(0),
+      download_file(nullptr),
+      upload_file(nullptr),
+      data_provider(nullptr),
+      request_headers(nullptr),
+      callback(nullptr),
+      request_observer(nullptr),
+      priority(RequestPriorityNormal),
+      decode_content(false),
+      running(false),
+      paused(false),
+      first_byte_received(false),
+      failed(false),
+      enqueued_time(timingNow()),
+      started_time(enqueued_time) {}
 
 ClientCurl::HandleInfo::~HandleInfo() {
+  if (download_file) {
+    discardDownloadFile(download_file, request->downloadPath());
+  }
+  if (upload_file) {
+    fclose(upload_file);
+  }
   if (request_headers) {
     curl_slist_free_all(request_headers);
   }
@@ -262,6 +840,42 @@ ClientCurl::HandleInfo::~HandleInfo() {
   }
 }
 
+void ClientCurl::HandleInfo::configureUpload() {
+  // Stream bodies from a file or a provider rather than holding them in memory
+  curl_off_t upload_length = -1;
+  if (request->method() == GetMethod || request->method() == HeadMethod) {
+    return;
+  }
+  if (!request->dataPath().empty()) {
+    upload_file = fopen(request->dataPath().c_str(), "rb");
+    if (upload_file == nullptr || fseek(upload_file, 0, SEEK_END) != 0 ||
+        (upload_length = ftell(upload_file)) < 0) {
+      // Never send the request without the body it asked for
+      failed = true;
+      return;
+    }
+    rewind(upload_file);
+    curl_easy_setopt(handle, CURLOPT_READFUNCTION, file_read_callback);
+    curl_easy_setopt(handle, CURLOPT_READDATA, upload_file);
+    curl_easy_setopt(handle, CURLOPT_SEEKFUNCTION, file_seek_callback);
+    curl_easy_setopt(handle, CURLOPT_SEEKDATA, upload_file);
+  } else if (request->dataProvider()) {
+    data_provider = request->dataProvider();
+    upload_length = request->dataProviderLength();
+    curl_easy_setopt(handle, CURLOPT_READFUNCTION, provider_read_callback);
+    curl_easy_setopt(handle, CURLOPT_READDATA, &data_provider);
+  } else {
+    return;
+  }
+
+  if (request->method() == PostMethod) {
+    curl_easy_setopt(handle, CURLOPT_POSTFIELDSIZE_LARGE, upload_length);
+  } else {
+    curl_easy_setopt(handle, CURLOPT_UPLOAD, 1L);
+    curl_easy_setopt(handle, CURLOPT_INFILESIZE_LARGE, upload_length);
+  }
+}
+
 void ClientCurl::HandleInfo::configureHeaders() {
   struct curl_slist *headers = NULL;
   for (const auto &header : request->headerMap()) {
@@ -284,17 +898,55 @@ void ClientCurl::HandleInfo::configureCurlHandle() {
   curl_easy_setopt(handle, CURLOPT_WRITEFUNCTION, write_callback);
   curl_easy_setopt(handle, CURLOPT_WRITEDATA, &response);
   curl_easy_setopt(handle, CURLOPT_HEADERFUNCTION, header_callback);
-  curl_easy_setopt(handle, CURLOPT_WRITEHEADER, &response_headers);
+  curl_easy_setopt(handle, CURLOPT_HEADERDATA, this);
 
   curl_easy_setopt(handle, CURLOPT_TIMEOUT, 30);
 
+#if LIBCURL_VERSION_NUM >= 0x072f00
+  // Prefer HTTP/2 over TLS, falling back to HTTP/1.1 when the server does not negotiate it
+  curl_easy_setopt(handle, CURLOPT_HTTP_VERSION, CURL_HTTP_VERSION_2TLS);
+#endif
+#if LIBCURL_VERSION_NUM >= 0x072b00
+  // Wait for an existing connection to become available for multiplexing rather than racing a
+  // new one. HTTP/2 is only negotiated over TLS, so plain requests would be left waiting on a
+  // connection they can never share
+  if (isSecureURL(request->url())) {
+    curl_easy_setopt(handle, CURLOPT_PIPEWAIT, 1L);
+  }
+#endif
+
+  // Negotiate every encoding curl can decode and decode the body as it streams in, unless the
+  // caller asked for an encoding themselves, in which case the encoded bytes are passed through.
+  // Ranges always refer to the identity encoding, so they are never negotiated.
+  const auto &header_map = request->headerMap();
+  decode_content = !hasHeader(header_map, "Accept-Encoding") && !hasHeader(header_map, "Range");
+  if (decode_content) {
+    curl_easy_setopt(handle, CURLOPT_ACCEPT_ENCODING, "");
+  }
+
+  // Stream downloads straight to disk rather than buffering the body
+  if (!request->downloadPath().empty() &&
+      (download_file = openDownloadFile(request->downloadPath())) != nullptr) {
+    curl_easy_setopt(handle, CURLOPT_WRITEFUNCTION, file_write_callback);
+    curl_easy_setopt(handle, CURLOPT_WRITEDATA, download_file);
+  }
+
+  // Large downloads can legitimately take longer than 30 seconds, and low priority transfers are
+  // paused while high priority ones run, so both only give up on stalls. Paused transfers are
+  // exempt from the speed check.
+  if (download_file != nullptr || priority == RequestPriorityLow) {
+    curl_easy_setopt(handle, CURLOPT_TIMEOUT, 0L);
+    curl_easy_setopt(handle, CURLOPT_LOW_SPEED_LIMIT, 1L);
+    curl_easy_setopt(handle, CURLOPT_LOW_SPEED_TIME, 30L);
+  }
+
 #if __APPLE__ || ANDROID
   curl_easy_setopt(handle, CURLOPT_SSL_VERIFYPEER, false);
   curl_easy_setopt(handle, CURLOPT_SSL_VERIFYHOST, false);
 #endif
 
-  // Stash request hash in a pointer so we can get callback later
-  curl_easy_setopt(handle, CURLOPT_PRIVATE, &request_hash);
+  // Stash the handle info in a pointer so we can get callback later
+  curl_easy_setopt(handle, CURLOPT_PRIVATE, this);
 
   // Set method
   if (request->method() == GetMethod) {
@@ -316,6 +968,8 @@ void ClientCurl::HandleInfo::configureCurlHandle() {
   if (data_length) {
     curl_easy_setopt(handle, CURLOPT_POSTFIELDSIZE, data_length);
     curl_easy_setopt(handle, CURLOPT_POSTFIELDS, request_data);
+  } else {
+    configureUpload();
   }
 
   // Set custom headers
@@ -324,8 +978,16 @@ void ClientCurl::HandleInfo::configureCurlHandle() {
   curl_easy_setopt(handle, CURLOPT_HTTPHEADER, request_headers);
 }
 
-std::shared_ptr<Client> createCurlClient() {
-  return std::make_shared<ClientCurl>();
+std::shared_ptr<Client> createCurlClient(const std::shared_ptr<RequestObserver> &request_observer,
+                                         WATCH_SOCKET_FUNCTION watch_socket_function,
+                                         SET_TIMEOUT_FUNCTION set_timeout_function,
+                                         long max_connections,
+                                         long max_streams_per_connection) {
+  return std::make_shared<ClientCurl>(request_observer,
+                                      watch_socket_function,
+                                      set_timeout_function,
+                                      max_connections,
+                                      max_streams_per_connection);
 }
 
 }  // namespace http
@@ -26,10 +26,14 @@
 #include "curl/curl.h"
 
 #include <condition_variable>
+#include <deque>
+#include <map>
 #include <thread>
 
+#include "Metrics.h"
 #include "RequestTokenDelegate.h"
 #include "RequestTokenImplementation.h"
+#include "Timing.h"
 
 namespace nativeformat {
 namespace http {
@@ -40,30 +44,66 @@ class ClientCurl : public Client,
   struct HandleInfo {
     CURL *handle;
     const std::shared_ptr<Request> request;
+    // Identical requests share a hash, so handles are told apart by an id of their own
+    uint64_t handle_id;
     std::string request_hash;
     std::string response;
+    FILE *download_file;
+    FILE *upload_file;
+    REQUEST_DATA_PROVIDER_FUNCTION data_provider;
     curl_slist *request_headers;
     std::unordered_map<std::string, std::string> response_headers;
     std::function<void(const std::shared_ptr<Response> &)> callback;
+    const std::shared_ptr<RequestObserver> request_observer;
+    RequestPriority priority;
+    bool decode_content;
+    bool running;
+    bool paused;
+    bool first_byte_received;
+    bool failed;
+    TIMING_POINT enqueued_time;
+    TIMING_POINT started_time;
     HandleInfo(std::shared_ptr<Request> req,
-               std::function<void(const std::shared_ptr<Response> &)> cbk);
+               uint64_t id,
+               std::function<void(const std::shared_ptr<Response> &)> cbk,
+               const std::shared_ptr<RequestObserver> &observer);
     HandleInfo();
     ~HandleInfo();
 
     void configureHeaders();
     void configureCurlHandle();
+    void configureUpload();
   };
 
  public:
-  ClientCurl();
+  // With a watch socket function the client has no thread of its own, it is driven through
+  // process and onTimeout instead. The connection cache and the HTTP/2 streams multiplexed over
+  // each connection are bounded by max_connections and max_streams_per_connection
+  ClientCurl(const std::shared_ptr<RequestObserver> &request_observer = nullptr,
+             WATCH_SOCKET_FUNCTION watch_socket_function = nullptr,
+             SET_TIMEOUT_FUNCTION set_timeout_function = nullptr,
+             long max_connections = MAX_CONNECTIONS,
+             long max_streams_per_connection = MAX_STREAMS_PER_CONNECTION);
   virtual ~ClientCurl();
 
   static const long MAX_CONNECTIONS = 10;
+  static const long MAX_STREAMS_PER_CONNECTION = 100;
+  static const long MAX_HIGH_PRIORITY_REQUESTS = 32;
+  static const long MAX_NORMAL_PRIORITY_REQUESTS = 32;
+  static const long MAX_LOW_PRIORITY_REQUESTS = 4;
 
   // Client
+  using Client::performRequests;
   std::shared_ptr<RequestToken> performRequest(
       const std::shared_ptr<Request> &request,
       std::function<void(const std::shared_ptr<Response> &)> callback) override;
+  std::vector<std::shared_ptr<RequestToken>> performRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks)
+      override;
+  Statistics stats() const override;
+  void process(EVENT_LOOP_SOCKET socket, int events) override;
+  void onTimeout() override;
 
   // RequestTokenDelegate
   void requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) override;
@@ -79,19 +119,61 @@ class ClientCurl : public Client,
   std::atomic<bool> _is_terminated;
   std::thread _request_thread;
 
-  std::unordered_map<std::string, std::unique_ptr<HandleInfo>> _handles;
-  std::atomic<long> _request_count;
+  std::unordered_map<uint64_t, std::unique_ptr<HandleInfo>> _handles;
+  std::atomic<uint64_t> _next_handle_id;
+
+  // Requests waiting for a slot, and the number of running requests, for each priority
+  std::map<RequestPriority, std::deque<uint64_t>> _pending_handles;
+  std::map<RequestPriority, long> _running_handles;
+  bool _low_priority_paused;
+
+  // Requests that could not be set up, they are answered with an error instead of being sent
+  std::deque<uint64_t> _failed_handles;
+  // Requests cancelled since curl was last driven, they are taken out by the thread driving it
+  std::deque<uint64_t> _cancelled_handles;
+
+  const std::shared_ptr<LayerMetrics> _metrics;
+  std::atomic<uint64_t> _bytes_sent;
+  std::atomic<uint64_t> _bytes_received;
+  const std::shared_ptr<RequestObserver> _request_observer;
+
+  // Set when the application's event loop drives the client
+  const WATCH_SOCKET_FUNCTION _watch_socket_function;
+  const SET_TIMEOUT_FUNCTION _set_timeout_function;
 
   void mainClientLoop();
-  void requestCleanup(std::string hash);
+  size_t finishRequests(std::unique_lock<std::mutex> &client_lock);
+  size_t finishFailedRequests(std::unique_lock<std::mutex> &client_lock);
+  size_t finishCancelledRequests(std::unique_lock<std::mutex> &client_lock);
+  void wakeRequestThread();
+  // Event loop clients get a lock with no mutex behind it, as they are only called from one thread
+  std::unique_lock<std::mutex> lockClient();
+  void unlockClient(std::unique_lock<std::mutex> &client_lock);
+  void relockClient(std::unique_lock<std::mutex> &client_lock);
+  void socketAction(curl_socket_t socket, int curl_events);
+  void scheduleRequests();
+  void requestCleanup(uint64_t handle_id);
+  static long maximumRunningRequests(RequestPriority priority);
 
   // Curl callbacks
  public:
   static size_t write_callback(char *data, size_t size, size_t nitems, void *str);
-  static size_t header_callback(char *data, size_t size, size_t nitems, void *str);
+  static size_t file_write_callback(char *data, size_t size, size_t nitems, void *file);
+  static size_t file_read_callback(char *data, size_t size, size_t nitems, void *file);
+  static int file_seek_callback(void *file, curl_off_t offset, int origin);
+  static size_t provider_read_callback(char *data, size_t size, size_t nitems, void *provider);
+  static size_t header_callback(char *data, size_t size, size_t nitems, void *handle_info);
+  static int socket_callback(
+      CURL *handle, curl_socket_t socket, int what, void *client, void *socket_data);
+  static int timer_callback(CURLM *multi, long timeout_ms, void *client);
 };
 
-extern std::shared_ptr<Client> createCurlClient();
+extern std::shared_ptr<Client> createCurlClient(
+    const std::shared_ptr<RequestObserver> &request_observer = nullptr,
+    WATCH_SOCKET_FUNCTION watch_socket_function = nullptr,
+    SET_TIMEOUT_FUNCTION set_timeout_function = nullptr,
+    long max_connections = ClientCurl::MAX_CONNECTIONS,
+    long max_streams_per_connection = ClientCurl::MAX_STREAMS_PER_CONNECTION);
 
 }  // namespace http
 }  // namespace nativeformat
@@ -20,80 +20,196 @@
  */
 #include "ClientModifierImplementation.h"
 
+#include "RequestObserverNotification.h"
 #include "RequestTokenImplementation.h"
+#include "Timing.h"
 
 namespace nativeformat {
 namespace http {
 
+namespace {
+static const std::string MODIFIER_TIME_KEY("modifier_time");
+}  // namespace
+
 ClientModifierImplementation::ClientModifierImplementation(
     REQUEST_MODIFIER_FUNCTION request_modifier_function,
     RESPONSE_MODIFIER_FUNCTION response_modifier_function,
-    std::shared_ptr<Client> &wrapped_client)
+    std::shared_ptr<Client> &wrapped_client,
+    const std::shared_ptr<RequestObserver> &request_observer)
     : _request_modifier_function(request_modifier_function),
       _response_modifier_function(response_modifier_function),
-      _wrapped_client(wrapped_client) {}
+      _wrapped_client(wrapped_client),
+      _metrics(std::make_shared<LayerMetrics>()),
+      _request_observer(request_observer) {}
 
 ClientModifierImplementation::~ClientModifierImplementation() {}
 
 std::shared_ptr<RequestToken> ClientModifierImplementation::performRequest(
     const std::shared_ptr<Request> &request,
     std::function<void(const std::shared_ptr<Response> &)> callback) {
+  return performRequests({request}, {callback}).front();
+}
+
+std::vector<std::shared_ptr<RequestToken>> ClientModifierImplementation::performRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks) {
   auto weak_this = std::weak_ptr<ClientModifierImplementation>(shared_from_this());
-  auto request_identifier = request->hash();
-  auto request_token = std::make_shared<RequestTokenImplementation>(weak_this, request_identifier);
-  _request_modifier_function(
-      [weak_this, callback, request_token, request_identifier](
-          const std::shared_ptr<Request> &request) {
-        if (request_token->cancelled()) {
-          return;
-        }
-        if (auto strong_this = weak_this.lock()) {
-          auto new_request_token = strong_this->_wrapped_client->performRequest(
-              request,
-              [callback, weak_this, request, request_identifier](
-                  const std::shared_ptr<Response> &response) {
-                if (auto strong_this = weak_this.lock()) {
-                  strong_this->_response_modifier_function(
-                      [callback, weak_this, request_identifier](
-                          const std::shared_ptr<Response> &response, bool retry) {
-                        if (retry) {
-                          if (auto strong_this = weak_this.lock()) {
-                            auto request_token =
-                                strong_this->performRequest(response->request(), callback);
-                            auto new_request_identifier = request_token->identifier();
-                            {
-                              std::lock_guard<std::mutex> request_map_lock(
-                                  strong_this->_request_map_mutex);
-                              strong_this->_request_identifier_map[request_identifier] =
-                                  new_request_identifier;
-                              strong_this->_request_token_map[new_request_identifier] =
-                                  request_token;
-                            }
-                            return;
-                          }
-                        }
-                        callback(response);
-                        if (auto strong_this = weak_this.lock()) {
-                          std::lock_guard<std::mutex> request_map_lock(
-                              strong_this->_request_map_mutex);
-                          strong_this->_request_token_map.erase(
-                              strong_this->_request_identifier_map[request_identifier]);
-                          strong_this->_request_identifier_map.erase(request_identifier);
-                        }
-                      },
-                      response);
-                }
-              });
-          auto new_request_identifier = new_request_token->identifier();
+  auto modified_requests = std::make_shared<ModifiedRequests>();
+  modified_requests->modified_requests.resize(requests.size());
+  modified_requests->batching = true;
+  std::vector<std::shared_ptr<RequestToken>> request_tokens;
+  for (size_t i = 0; i < requests.size(); ++i) {
+    auto request_token =
+        std::make_shared<RequestTokenImplementation>(weak_this, requests[i]->hash());
+    modified_requests->modified_requests[i] = {
+        requests[i], LayerMetrics::trackRequest(_metrics, callbacks[i]), request_token, 0.0};
+    request_tokens.push_back(request_token);
+  }
+
+  // Requests the modifier hands back straight away are sent on as one batch, while any it takes
+  // longer over are sent on their own as soon as they are ready, so none of them wait on another
+  for (size_t i = 0; i < requests.size(); ++i) {
+    const TIMING_POINT modifier_start_time = timingNow();
+    _request_modifier_function(
+        [weak_this, modified_requests, i, modifier_start_time](
+            const std::shared_ptr<Request> &request) {
+          ModifiedRequest modified_request;
           {
-            std::lock_guard<std::mutex> request_map_lock(strong_this->_request_map_mutex);
-            strong_this->_request_identifier_map[request_identifier] = new_request_identifier;
-            strong_this->_request_token_map[new_request_identifier] = new_request_token;
+            std::lock_guard<std::mutex> lock(modified_requests->mutex);
+            modified_request = modified_requests->modified_requests[i];
+            modified_request.request = request;
+            modified_request.request_modifier_time = secondsSince(modifier_start_time);
+            if (modified_requests->batching) {
+              modified_requests->ready_requests.push_back(modified_request);
+              return;
+            }
           }
-        }
-      },
-      request);
-  return request_token;
+          if (auto strong_this = weak_this.lock()) {
+            strong_this->submitRequests({modified_request});
+          }
+        },
+        requests[i]);
+  }
+  std::vector<ModifiedRequest> ready_requests;
+  {
+    std::lock_guard<std::mutex> lock(modified_requests->mutex);
+    modified_requests->batching = false;
+    ready_requests.swap(modified_requests->ready_requests);
+  }
+  submitRequests(ready_requests);
+  return request_tokens;
+}
+
+void ClientModifierImplementation::submitRequests(
+    const std::vector<ModifiedRequest> &modified_requests) {
+  std::vector<std::shared_ptr<Request>> requests;
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
+  std::vector<std::string> request_identifiers;
+  std::vector<std::shared_ptr<RequestToken>> submitted_request_tokens;
+  for (const auto &modified_request : modified_requests) {
+    if (modified_request.request_token->cancelled()) {
+      // Cancelled while being modified, so it never reaches the layers below
+      _metrics->requestCancelled();
+      continue;
+    }
+    const auto request_identifier = modified_request.request_token->identifier();
+    requests.push_back(modified_request.request);
+    callbacks.push_back(responseCallback(modified_request.callback,
+                                         modified_request.request_token,
+                                         modified_request.request_modifier_time));
+    request_identifiers.push_back(request_identifier);
+    submitted_request_tokens.push_back(modified_request.request_token);
+  }
+  if (requests.empty()) {
+    return;
+  }
+
+  // Responses and cancellations can arrive before the wrapped client returns
+  for (size_t i = 0; i < request_identifiers.size(); ++i) {
+    auto request_tokens = _request_tokens.lock(request_identifiers[i]);
+    request_tokens->emplace(
+        request_identifiers[i],
+        RequestTokens{submitted_request_tokens[i], std::weak_ptr<RequestToken>()});
+  }
+  auto new_request_tokens = _wrapped_client->performRequests(requests, callbacks);
+  for (size_t i = 0; i < new_request_tokens.size(); ++i) {
+    {
+      auto request_tokens = _request_tokens.lock(request_identifiers[i]);
+      auto request_token_it =
+          findRequestTokens(*request_tokens, request_identifiers[i], submitted_request_tokens[i]);
+      if (request_token_it != request_tokens->end()) {
+        request_token_it->second.wrapped_request_token = new_request_tokens[i];
+        continue;
+      }
+    }
+    if (submitted_request_tokens[i]->cancelled()) {
+      new_request_tokens[i]->cancel();
+    }
+  }
+}
+
+std::function<void(const std::shared_ptr<Response> &)>
+ClientModifierImplementation::responseCallback(
+    std::function<void(const std::shared_ptr<Response> &)> callback,
+    const std::shared_ptr<RequestToken> &request_token,
+    double request_modifier_time) {
+  auto weak_this = std::weak_ptr<ClientModifierImplementation>(shared_from_this());
+  const std::string request_identifier = request_token->identifier();
+  const std::weak_ptr<RequestToken> weak_request_token = request_token;
+  return [callback, weak_this, request_identifier, weak_request_token, request_modifier_time](
+             const std::shared_ptr<Response> &response) {
+    if (auto strong_this = weak_this.lock()) {
+      const TIMING_POINT modifier_start_time = timingNow();
+      strong_this->_response_modifier_function(
+          [callback,
+           weak_this,
+           request_identifier,
+           weak_request_token,
+           request_modifier_time,
+           modifier_start_time](const std::shared_ptr<Response> &response, bool retry) {
+            if (retry) {
+              if (auto strong_this = weak_this.lock()) {
+                notifyRequestObserver(
+                    strong_this->_request_observer, RequestEventRetried, response->request());
+                // The retry finishes this request, so it removes our entry when it completes
+                auto retry_request_token = strong_this->performRequest(
+                    response->request(),
+                    [callback, weak_this, request_identifier, weak_request_token](
+                        const std::shared_ptr<Response> &response) {
+                      if (auto strong_this = weak_this.lock()) {
+                        strong_this->removeRequestTokens(request_identifier,
+                                                         weak_request_token.lock());
+                      }
+                      callback(response);
+                    });
+                auto request_tokens = strong_this->_request_tokens.lock(request_identifier);
+                auto request_token_it = findRequestTokens(
+                    *request_tokens, request_identifier, weak_request_token.lock());
+                if (request_token_it != request_tokens->end()) {
+                  request_token_it->second.wrapped_request_token = retry_request_token;
+                }
+                return;
+              }
+            }
+            // Whichever of the response and a cancel removes the request accounts for it
+            if (auto strong_this = weak_this.lock()) {
+              if (!strong_this->removeRequestTokens(request_identifier,
+                                                    weak_request_token.lock())) {
+                return;
+              }
+            }
+            response->setMetadata(
+                MODIFIER_TIME_KEY,
+                timingString(request_modifier_time + secondsSince(modifier_start_time)));
+            if (auto strong_this = weak_this.lock()) {
+              notifyRequestObserver(
+                  strong_this->_request_observer, RequestEventCompleted, response->request());
+            }
+            callback(response);
+          },
+          response);
+    }
+  };
 }
 
 void ClientModifierImplementation::pinResponse(const std::shared_ptr<Response> &response,
@@ -106,6 +222,20 @@ void ClientModifierImplementation::unpinResponse(const std::shared_ptr<Response>
   return _wrapped_client->unpinResponse(response, pin_identifier);
 }
 
+void ClientModifierImplementation::pinRequestHashes(
+    const std::vector<std::string> &request_hashes,
+    const std::string &pin_identifier,
+    std::function<void(size_t pinned_bytes)> callback) {
+  _wrapped_client->pinRequestHashes(request_hashes, pin_identifier, callback);
+}
+
+void ClientModifierImplementation::unpinRequestHashes(
+    const std::vector<std::string> &request_hashes,
+    const std::string &pin_identifier,
+    std::function<void(size_t unpinned_bytes)> callback) {
+  _wrapped_client->unpinRequestHashes(request_hashes, pin_identifier, callback);
+}
+
 void ClientModifierImplementation::removePinnedResponseForIdentifier(
     const std::string &pin_identifier) {
   _wrapped_client->removePinnedResponseForIdentifier(pin_identifier);
@@ -122,17 +252,161 @@ void ClientModifierImplementation::pinningIdentifiers(
   _wrapped_client->pinningIdentifiers(callback);
 }
 
+void ClientModifierImplementation::prefetchRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::string &pin_identifier,
+    std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback) {
+  // Prefetched requests still go through the request modifier, so they get cached under the
+  // same hash as the requests that will later be served from the cache. As with performRequests,
+  // the ones modified straight away go on as one batch and any stragglers follow on their own
+  struct ModifiedPrefetch {
+    std::vector<std::shared_ptr<Request>> ready_requests;
+    bool batching;
+    size_t completed;
+    size_t bytes;
+    std::mutex mutex;
+  };
+  if (requests.empty()) {
+    _wrapped_client->prefetchRequests(requests, pin_identifier, progress_callback);
+    return;
+  }
+  auto weak_this = std::weak_ptr<ClientModifierImplementation>(shared_from_this());
+  auto modified_prefetch = std::make_shared<ModifiedPrefetch>();
+  modified_prefetch->batching = true;
+  modified_prefetch->completed = 0;
+  modified_prefetch->bytes = 0;
+  const size_t total = requests.size();
+  // Each prefetch sent on reports its own progress, which is added up into one for the caller
+  auto prefetch = [weak_this, modified_prefetch, total, pin_identifier, progress_callback](
+                      const std::vector<std::shared_ptr<Request>> &prefetch_requests) {
+    auto strong_this = weak_this.lock();
+    if (!strong_this || prefetch_requests.empty()) {
+      return;
+    }
+    auto reported = std::make_shared<std::pair<size_t, size_t>>(0, 0);
+    strong_this->_wrapped_client->prefetchRequests(
+        prefetch_requests,
+        pin_identifier,
+        [modified_prefetch, total, progress_callback, reported](
+            size_t completed, size_t prefetch_total, size_t bytes) {
+          size_t total_completed = 0;
+          size_t total_bytes = 0;
+          {
+            std::lock_guard<std::mutex> lock(modified_prefetch->mutex);
+            modified_prefetch->completed += completed - reported->first;
+            modified_prefetch->bytes += bytes - reported->second;
+            *reported = std::make_pair(completed, bytes);
+            total_completed = modified_prefetch->completed;
+            total_bytes = modified_prefetch->bytes;
+          }
+          if (progress_callback) {
+            progress_callback(total_completed, total, total_bytes);
+          }
+        });
+  };
+  for (const auto &request : requests) {
+    _request_modifier_function(
+        [modified_prefetch, prefetch](const std::shared_ptr<Request> &request) {
+          {
+            std::lock_guard<std::mutex> lock(modified_prefetch->mutex);
+            if (modified_prefetch->batching) {
+              modified_prefetch->ready_requests.push_back(request);
+              return;
+            }
+          }
+          prefetch({request});
+        },
+        request);
+  }
+  std::vector<std::shared_ptr<Request>> ready_requests;
+  {
+    std::lock_guard<std::mutex> lock(modified_prefetch->mutex);
+    modified_prefetch->batching = false;
+    ready_requests.swap(modified_prefetch->ready_requests);
+  }
+  prefetch(ready_requests);
+}
+
+Statistics ClientModifierImplementation::stats() const {
+  Statistics statistics = _wrapped_client->stats();
+  statistics.modifier = _metrics->statistics();
+  return statistics;
+}
+
+void ClientModifierImplementation::setCoalescingWindow(std::chrono::milliseconds window,
+                                                       size_t max_bytes) {
+  _wrapped_client->setCoalescingWindow(window, max_bytes);
+}
+
+void ClientModifierImplementation::setNegativeCacheTime(std::chrono::seconds time) {
+  _wrapped_client->setNegativeCacheTime(time);
+}
+
+bool ClientModifierImplementation::exportCache(const std::string &archive_path) {
+  return _wrapped_client->exportCache(archive_path);
+}
+
+bool ClientModifierImplementation::importCache(const std::string &archive_path) {
+  return _wrapped_client->importCache(archive_path);
+}
+
+void ClientModifierImplementation::process(EVENT_LOOP_SOCKET socket, int events) {
+  _wrapped_client->process(socket, events);
+}
+
+void ClientModifierImplementation::onTimeout() {
+  _wrapped_client->onTimeout();
+}
+
+ClientModifierImplementation::REQUEST_TOKENS_MAP::iterator
+ClientModifierImplementation::findRequestTokens(
+    REQUEST_TOKENS_MAP &request_tokens,
+    const std::string &identifier,
+    const std::shared_ptr<RequestToken> &request_token) {
+  // A token the caller has let go of matches any entry whose token has also gone
+  auto range = request_tokens.equal_range(identifier);
+  for (auto request_token_it = range.first; request_token_it != range.second; ++request_token_it) {
+    if (request_token_it->second.request_token.lock() == request_token) {
+      return request_token_it;
+    }
+  }
+  return request_tokens.end();
+}
+
+bool ClientModifierImplementation::removeRequestTokens(
+    const std::string &identifier, const std::shared_ptr<RequestToken> &request_token) {
+  auto request_tokens = _request_tokens.lock(identifier);
+  auto request_token_it = findRequestTokens(*request_tokens, identifier, request_token);
+  if (request_token_it == request_tokens->end()) {
+    return false;
+  }
+  request_tokens->erase(request_token_it);
+  return true;
+}
+
 void ClientModifierImplementation::requestTokenDidCancel(
     const std::shared_ptr<RequestToken> &request_token) {
-  std::lock_guard<std::mutex> request_map_lock(_request_map_mutex);
   auto identifier = request_token->identifier();
-  auto new_identifier = _request_identifier_map[identifier];
-  auto new_request_token = _request_token_map[new_identifier];
-  if (auto new_request_token_strong = new_request_token.lock()) {
-    new_request_token_strong->cancel();
+  std::shared_ptr<RequestToken> new_request_token;
+  bool found = false;
+  {
+    auto request_tokens = _request_tokens.lock(identifier);
+    auto request_token_it = findRequestTokens(*request_tokens, identifier, request_token);
+    if (request_token_it != request_tokens->end()) {
+      found = true;
+      new_request_token = request_token_it->second.wrapped_request_token.lock();
+      request_tokens->erase(request_token_it);
+    }
+  }
+  // Cancelling may call straight back into this layer, so no lock is held here
+  if (new_request_token) {
+    new_request_token->cancel();
+  }
+  // Requests that already have their response, or are still being modified, are counted when
+  // they finish or are skipped
+  if (found) {
+    _metrics->requestCancelled();
   }
-  _request_identifier_map.erase(identifier);
-  _request_token_map.erase(new_identifier);
 }
 
 }  // namespace http
@@ -25,7 +25,9 @@
 #include <memory>
 #include <unordered_map>
 
+#include "Metrics.h"
 #include "RequestTokenDelegate.h"
+#include "ShardedTable.h"
 
 namespace nativeformat {
 namespace http {
@@ -37,35 +39,90 @@ class ClientModifierImplementation
  public:
   ClientModifierImplementation(REQUEST_MODIFIER_FUNCTION request_modifier_function,
                                RESPONSE_MODIFIER_FUNCTION response_modifier_function,
-                               std::shared_ptr<Client> &wrapped_client);
+                               std::shared_ptr<Client> &wrapped_client,
+                               const std::shared_ptr<RequestObserver> &request_observer = nullptr);
   virtual ~ClientModifierImplementation();
 
   // Client
+  using Client::performRequests;
   virtual std::shared_ptr<RequestToken> performRequest(
       const std::shared_ptr<Request> &request,
       std::function<void(const std::shared_ptr<Response> &)> callback);
+  virtual std::vector<std::shared_ptr<RequestToken>> performRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks);
   virtual void pinResponse(const std::shared_ptr<Response> &response,
                            const std::string &pin_identifier);
   virtual void unpinResponse(const std::shared_ptr<Response> &response,
                              const std::string &pin_identifier);
+  virtual void pinRequestHashes(const std::vector<std::string> &request_hashes,
+                                const std::string &pin_identifier,
+                                std::function<void(size_t pinned_bytes)> callback);
+  virtual void unpinRequestHashes(const std::vector<std::string> &request_hashes,
+                                  const std::string &pin_identifier,
+                                  std::function<void(size_t unpinned_bytes)> callback);
   virtual void removePinnedResponseForIdentifier(const std::string &pin_identifier);
   virtual void pinnedResponsesForIdentifier(
       const std::string &pin_identifier,
       std::function<void(const std::vector<std::shared_ptr<Response>> &)> callback);
   virtual void pinningIdentifiers(
       std::function<void(const std::vector<std::string> &identifiers)> callback);
+  virtual void prefetchRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::string &pin_identifier,
+      std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback);
+  virtual Statistics stats() const;
+  virtual void setCoalescingWindow(std::chrono::milliseconds window, size_t max_bytes);
+  virtual void setNegativeCacheTime(std::chrono::seconds time);
+  virtual bool exportCache(const std::string &archive_path);
+  virtual bool importCache(const std::string &archive_path);
+  virtual void process(EVENT_LOOP_SOCKET socket, int events);
+  virtual void onTimeout();
 
   // RequestTokenDelegate
   virtual void requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token);
 
  private:
+  struct ModifiedRequest {
+    std::shared_ptr<Request> request;
+    std::function<void(const std::shared_ptr<Response> &)> callback;
+    std::shared_ptr<RequestToken> request_token;
+    double request_modifier_time;
+  };
+  struct ModifiedRequests {
+    std::vector<ModifiedRequest> modified_requests;
+    // Requests modified while the batch is still being handed to the modifier go on together
+    std::vector<ModifiedRequest> ready_requests;
+    bool batching;
+    std::mutex mutex;
+  };
+  struct RequestTokens {
+    std::weak_ptr<RequestToken> request_token;
+    std::weak_ptr<RequestToken> wrapped_request_token;
+  };
+  typedef std::unordered_multimap<std::string, RequestTokens> REQUEST_TOKENS_MAP;
+
+  void submitRequests(const std::vector<ModifiedRequest> &modified_requests);
+  std::function<void(const std::shared_ptr<Response> &)> responseCallback(
+      std::function<void(const std::shared_ptr<Response> &)> callback,
+      const std::shared_ptr<RequestToken> &request_token,
+      double request_modifier_time);
+  static REQUEST_TOKENS_MAP::iterator findRequestTokens(
+      REQUEST_TOKENS_MAP &request_tokens,
+      const std::string &identifier,
+      const std::shared_ptr<RequestToken> &request_token);
+  bool removeRequestTokens(const std::string &identifier,
+                           const std::shared_ptr<RequestToken> &request_token);
+
   const REQUEST_MODIFIER_FUNCTION _request_modifier_function;
   const RESPONSE_MODIFIER_FUNCTION _response_modifier_function;
   const std::shared_ptr<Client> _wrapped_client;
+  const std::shared_ptr<LayerMetrics> _metrics;
+  const std::shared_ptr<RequestObserver> _request_observer;
 
-  std::unordered_map<std::string, std::string> _request_identifier_map;
-  std::unordered_map<std::string, std::weak_ptr<RequestToken>> _request_token_map;
-  std::mutex _request_map_mutex;
+  // The tokens from the wrapped client, keyed by the identifiers of the tokens we handed out.
+  // Identical requests share an identifier, so each entry also holds the token it belongs to
+  ShardedTable<REQUEST_TOKENS_MAP> _request_tokens;
 };
 
 }  // namespace http
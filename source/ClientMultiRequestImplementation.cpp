@@ -20,6 +20,7 @@
  */
 #include "ClientMultiRequestImplementation.h"
 
+#include "RequestObserverNotification.h"
 #include "RequestTokenImplementation.h"
 
 #include <algorithm>
@@ -31,47 +32,193 @@ namespace {
 static const std::string MULTICAST_KEY("multicasted");
 }  // namespace
 
+ClientMultiRequestImplementation::Shard::Shard() : recent_responses_size(0) {}
+
 ClientMultiRequestImplementation::ClientMultiRequestImplementation(
-    std::shared_ptr<Client> &wrapped_client)
-    : _wrapped_client(wrapped_client) {}
+    std::shared_ptr<Client> &wrapped_client,
+    const std::shared_ptr<RequestObserver> &request_observer)
+    : _wrapped_client(wrapped_client),
+      _metrics(std::make_shared<LayerMetrics>()),
+      _coalesced_requests(0),
+      _request_observer(request_observer),
+      _coalescing_window(0),
+      _coalescing_max_bytes(0),
+      _recent_responses_size(0) {}
 
 ClientMultiRequestImplementation::~ClientMultiRequestImplementation() {}
 
 std::shared_ptr<RequestToken> ClientMultiRequestImplementation::performRequest(
     const std::shared_ptr<Request> &request,
     std::function<void(const std::shared_ptr<Response> &)> callback) {
-  std::lock_guard<std::mutex> lock(_requests_in_flight_mutex);
-  auto hash = request->hash();
-  auto request_it = _requests_in_flight.find(hash);
-  if (request_it == _requests_in_flight.end()) {
-    MultiRequests multi_requests;
-    std::weak_ptr<ClientMultiRequestImplementation> weak_this = shared_from_this();
-    multi_requests.request_token = _wrapped_client->performRequest(
-        request, [weak_this](const std::shared_ptr<Response> &response) {
-          if (auto strong_this = weak_this.lock()) {
-            std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
-            {
-              std::lock_guard<std::mutex> lock(strong_this->_requests_in_flight_mutex);
-              auto hash = response->request()->hash();
-              auto &multi_requests = strong_this->_requests_in_flight[hash];
-              response->setMetadata(MULTICAST_KEY,
-                                    std::to_string(multi_requests.multi_requests.size() > 1));
-              for (const auto &multi_request : multi_requests.multi_requests) {
-                callbacks.push_back(multi_request.callback);
-              }
-              strong_this->_requests_in_flight.erase(hash);
-            }
-            for (const auto &callback : callbacks) {
-              callback(response);
-            }
-          }
-        });
-    _requests_in_flight[hash] = multi_requests;
+  return performRequests({request}, {callback}).front();
+}
+
+std::vector<std::shared_ptr<RequestToken>> ClientMultiRequestImplementation::performRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks) {
+  std::vector<std::shared_ptr<RequestToken>> request_tokens;
+  std::vector<std::shared_ptr<Request>> wrapped_requests;
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> wrapped_callbacks;
+  std::vector<std::string> wrapped_hashes;
+  std::vector<std::shared_ptr<MultiRequests>> wrapped_multi_requests;
+  std::vector<
+      std::pair<std::function<void(const std::shared_ptr<Response> &)>, std::shared_ptr<Response>>>
+      recent_responses;
+  const bool share_responses = _coalescing_window.load() > 0;
+  for (size_t i = 0; i < requests.size(); ++i) {
+    const auto &request = requests[i];
+    // Downloads to different paths each need their own transfer
+    const auto request_hash = request->hash();
+    auto hash = request_hash + request->downloadPath();
+    notifyRequestObserver(_request_observer, RequestEventEnqueued, request_hash);
+    auto token = std::make_shared<RequestTokenImplementation>(shared_from_this(), hash);
+    MultiRequest multi_request = {LayerMetrics::trackRequest(_metrics, callbacks[i]), token};
+    request_tokens.push_back(token);
+
+    // Only the shard this request hashes to is locked
+    auto shard = _shards.lock(hash);
+
+    // A response that completed within the coalescing window is handed straight back
+    if (share_responses) {
+      pruneRecentResponses(*shard, timingNow());
+      auto recent_it = shard->recent_responses.find(hash);
+      if (recent_it != shard->recent_responses.end() && shouldShareResponses(request)) {
+        incrementCounter(_coalesced_requests);
+        notifyRequestObserver(_request_observer, RequestEventCoalesced, request_hash);
+        recent_responses.push_back(
+            std::make_pair(multi_request.callback, recent_it->second.response));
+        continue;
+      }
+    }
+
+    auto request_it = shard->requests_in_flight.find(hash);
+    if (request_it == shard->requests_in_flight.end()) {
+      auto multi_requests = std::make_shared<MultiRequests>();
+      multi_requests->request_hash = request_hash;
+      multi_requests->cancelled = false;
+      multi_requests->multi_requests.push_back(multi_request);
+      shard->requests_in_flight[hash] = multi_requests;
+      wrapped_requests.push_back(request);
+      wrapped_callbacks.push_back(responseCallback(hash, multi_requests));
+      wrapped_hashes.push_back(hash);
+      wrapped_multi_requests.push_back(multi_requests);
+    } else {
+      request_it->second->multi_requests.push_back(multi_request);
+      incrementCounter(_coalesced_requests);
+      notifyRequestObserver(_request_observer, RequestEventCoalesced, request_hash);
+    }
+  }
+
+  // Only the requests that are not already in flight get sent on, as a single batch, and without
+  // holding any lock, so their responses or cancellations may already have happened on return
+  if (!wrapped_requests.empty()) {
+    auto wrapped_tokens = _wrapped_client->performRequests(wrapped_requests, wrapped_callbacks);
+    for (size_t i = 0; i < wrapped_multi_requests.size(); ++i) {
+      const auto &multi_requests = wrapped_multi_requests[i];
+      bool cancelled = false;
+      {
+        auto shard = _shards.lock(wrapped_hashes[i]);
+        multi_requests->request_token = wrapped_tokens[i];
+        cancelled = multi_requests->cancelled;
+      }
+      if (cancelled) {
+        wrapped_tokens[i]->cancel();
+      }
+    }
+  }
+
+  for (const auto &recent_response : recent_responses) {
+    recent_response.first(recent_response.second);
+  }
+  return request_tokens;
+}
+
+std::function<void(const std::shared_ptr<Response> &)>
+ClientMultiRequestImplementation::responseCallback(
+    const std::string &hash, const std::shared_ptr<MultiRequests> &multi_requests) {
+  std::weak_ptr<ClientMultiRequestImplementation> weak_this = shared_from_this();
+  return [weak_this, hash, multi_requests](const std::shared_ptr<Response> &response) {
+    if (auto strong_this = weak_this.lock()) {
+      std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
+      {
+        auto shard = strong_this->_shards.lock(hash);
+        response->setMetadata(MULTICAST_KEY,
+                              std::to_string(multi_requests->multi_requests.size() > 1));
+        for (const auto &multi_request : multi_requests->multi_requests) {
+          callbacks.push_back(multi_request.callback);
+        }
+        if (strong_this->shouldShareResponses(response->request())) {
+          strong_this->storeRecentResponse(*shard, hash, response);
+        }
+        // An identical request may have started since this one was cancelled
+        auto request_it = shard->requests_in_flight.find(hash);
+        if (request_it != shard->requests_in_flight.end() && request_it->second == multi_requests) {
+          shard->requests_in_flight.erase(request_it);
+        }
+      }
+      for (const auto &callback : callbacks) {
+        callback(response);
+      }
+    }
+  };
+}
+
+bool ClientMultiRequestImplementation::shouldShareResponses(
+    const std::shared_ptr<Request> &request) const {
+  if (_coalescing_window.load() == 0) {
+    return false;
+  }
+  // Only idempotent requests are shared, and never when the caller asked for a fresh response
+  const auto method = request->method();
+  if (method != GetMethod && method != HeadMethod) {
+    return false;
+  }
+  Request::CacheControl cache_control = request->cacheControl();
+  return !cache_control.no_cache && !cache_control.no_store;
+}
+
+void ClientMultiRequestImplementation::storeRecentResponse(
+    Shard &shard, const std::string &hash, const std::shared_ptr<Response> &response) {
+  if (response->cancelled() || response->statusCode() == StatusCodeInvalid) {
+    return;
+  }
+  const size_t size = response->dataLength();
+  if (size > _coalescing_max_bytes.load()) {
+    return;
+  }
+  auto recent_it = shard.recent_responses.find(hash);
+  if (recent_it != shard.recent_responses.end()) {
+    shard.recent_responses_size -= recent_it->second.size;
+    _recent_responses_size -= recent_it->second.size;
+    shard.recent_responses.erase(recent_it);
+  }
+  const TIMING_POINT now = timingNow();
+  const TIMING_POINT expiry_time = now + std::chrono::milliseconds(_coalescing_window.load());
+  shard.recent_responses[hash] = {response, expiry_time, size};
+  shard.recent_response_expiries.push_back(std::make_pair(hash, expiry_time));
+  shard.recent_responses_size += size;
+  _recent_responses_size += size;
+  pruneRecentResponses(shard, now);
+}
+
+void ClientMultiRequestImplementation::pruneRecentResponses(Shard &shard, TIMING_POINT now) {
+  // Every response lives for the same window, so the oldest is always the first to expire.
+  // Only this shard is locked, so it gives up its own responses to bring the total under budget
+  const size_t max_bytes = _coalescing_max_bytes.load();
+  while (!shard.recent_response_expiries.empty()) {
+    const auto &expiry = shard.recent_response_expiries.front();
+    auto recent_it = shard.recent_responses.find(expiry.first);
+    if (recent_it != shard.recent_responses.end() &&
+        recent_it->second.expiry_time == expiry.second) {
+      if (expiry.second > now && _recent_responses_size.load() <= max_bytes) {
+        break;
+      }
+      shard.recent_responses_size -= recent_it->second.size;
+      _recent_responses_size -= recent_it->second.size;
+      shard.recent_responses.erase(recent_it);
+    }
+    shard.recent_response_expiries.pop_front();
   }
-  auto token = std::make_shared<RequestTokenImplementation>(shared_from_this(), hash);
-  MultiRequest multi_request = {callback, token};
-  _requests_in_flight[hash].multi_requests.push_back(multi_request);
-  return token;
 }
 
 void ClientMultiRequestImplementation::pinResponse(const std::shared_ptr<Response> &response,
@@ -84,6 +231,20 @@ void ClientMultiRequestImplementation::unpinResponse(const std::shared_ptr<Respo
   _wrapped_client->unpinResponse(response, pin_identifier);
 }
 
+void ClientMultiRequestImplementation::pinRequestHashes(
+    const std::vector<std::string> &request_hashes,
+    const std::string &pin_identifier,
+    std::function<void(size_t pinned_bytes)> callback) {
+  _wrapped_client->pinRequestHashes(request_hashes, pin_identifier, callback);
+}
+
+void ClientMultiRequestImplementation::unpinRequestHashes(
+    const std::vector<std::string> &request_hashes,
+    const std::string &pin_identifier,
+    std::function<void(size_t unpinned_bytes)> callback) {
+  _wrapped_client->unpinRequestHashes(request_hashes, pin_identifier, callback);
+}
+
 void ClientMultiRequestImplementation::removePinnedResponseForIdentifier(
     const std::string &pin_identifier) {
   _wrapped_client->removePinnedResponseForIdentifier(pin_identifier);
@@ -100,22 +261,94 @@ void ClientMultiRequestImplementation::pinningIdentifiers(
   _wrapped_client->pinningIdentifiers(callback);
 }
 
+void ClientMultiRequestImplementation::prefetchRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::string &pin_identifier,
+    std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback) {
+  _wrapped_client->prefetchRequests(requests, pin_identifier, progress_callback);
+}
+
+Statistics ClientMultiRequestImplementation::stats() const {
+  Statistics statistics = _wrapped_client->stats();
+  statistics.multi_request = _metrics->statistics();
+  statistics.coalesced_requests = counterValue(_coalesced_requests);
+  return statistics;
+}
+
+void ClientMultiRequestImplementation::setCoalescingWindow(std::chrono::milliseconds window,
+                                                           size_t max_bytes) {
+  _coalescing_window = window.count();
+  _coalescing_max_bytes = max_bytes;
+  const TIMING_POINT now = timingNow();
+  for (size_t i = 0; i < SHARDS::shardCount(); ++i) {
+    auto shard = _shards.lockShard(i);
+    if (window.count() == 0) {
+      shard->recent_responses.clear();
+      shard->recent_response_expiries.clear();
+      _recent_responses_size -= shard->recent_responses_size;
+      shard->recent_responses_size = 0;
+    } else {
+      pruneRecentResponses(*shard, now);
+    }
+  }
+}
+
+void ClientMultiRequestImplementation::setNegativeCacheTime(std::chrono::seconds time) {
+  _wrapped_client->setNegativeCacheTime(time);
+}
+
+bool ClientMultiRequestImplementation::exportCache(const std::string &archive_path) {
+  return _wrapped_client->exportCache(archive_path);
+}
+
+bool ClientMultiRequestImplementation::importCache(const std::string &archive_path) {
+  return _wrapped_client->importCache(archive_path);
+}
+
+void ClientMultiRequestImplementation::process(EVENT_LOOP_SOCKET socket, int events) {
+  _wrapped_client->process(socket, events);
+}
+
+void ClientMultiRequestImplementation::onTimeout() {
+  _wrapped_client->onTimeout();
+}
+
 void ClientMultiRequestImplementation::requestTokenDidCancel(
     const std::shared_ptr<RequestToken> &request_token) {
-  std::lock_guard<std::mutex> lock(_requests_in_flight_mutex);
   auto identifier = request_token->identifier();
-  auto &multi_requests = _requests_in_flight[identifier];
-  auto &multi_requests_vector = multi_requests.multi_requests;
-  multi_requests_vector.erase(std::remove_if(multi_requests_vector.begin(),
-                                             multi_requests_vector.end(),
-                                             [&](MultiRequest &multi_request) {
-                                               return multi_request.request_token.lock().get() ==
-                                                      request_token.get();
-                                             }),
-                              multi_requests_vector.end());
-  if (multi_requests_vector.empty()) {
-    multi_requests.request_token->cancel();
-    _requests_in_flight.erase(identifier);
+  std::shared_ptr<RequestToken> wrapped_request_token;
+  {
+    auto shard = _shards.lock(identifier);
+    // Requests answered from the coalescing window have nothing left to cancel
+    auto request_it = shard->requests_in_flight.find(identifier);
+    if (request_it == shard->requests_in_flight.end()) {
+      return;
+    }
+    auto multi_requests = request_it->second;
+    auto &multi_requests_vector = multi_requests->multi_requests;
+    const size_t multi_requests_count = multi_requests_vector.size();
+    multi_requests_vector.erase(std::remove_if(multi_requests_vector.begin(),
+                                               multi_requests_vector.end(),
+                                               [&](MultiRequest &multi_request) {
+                                                 return multi_request.request_token.lock().get() ==
+                                                        request_token.get();
+                                               }),
+                                multi_requests_vector.end());
+    for (size_t i = multi_requests_vector.size(); i < multi_requests_count; ++i) {
+      _metrics->requestCancelled();
+      notifyRequestObserver(_request_observer, RequestEventCancelled, multi_requests->request_hash);
+    }
+    if (!multi_requests_vector.empty()) {
+      return;
+    }
+    // If the wrapped client has not returned its token yet, it is cancelled once it does
+    multi_requests->cancelled = true;
+    wrapped_request_token = multi_requests->request_token;
+    shard->requests_in_flight.erase(request_it);
+  }
+  // The wrapped client may deliver its cancelled response straight away, so no lock is held here
+  if (wrapped_request_token) {
+    wrapped_request_token->cancel();
   }
 }
 
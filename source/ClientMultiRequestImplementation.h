@@ -22,10 +22,15 @@
 
 #include <NFHTTP/Client.h>
 
+#include <atomic>
+#include <deque>
 #include <memory>
 #include <unordered_map>
 
+#include "Metrics.h"
 #include "RequestTokenDelegate.h"
+#include "ShardedTable.h"
+#include "Timing.h"
 
 namespace nativeformat {
 namespace http {
@@ -35,23 +40,47 @@ class ClientMultiRequestImplementation
       public std::enable_shared_from_this<ClientMultiRequestImplementation>,
       public RequestTokenDelegate {
  public:
-  ClientMultiRequestImplementation(std::shared_ptr<Client> &wrapped_client);
+  ClientMultiRequestImplementation(
+      std::shared_ptr<Client> &wrapped_client,
+      const std::shared_ptr<RequestObserver> &request_observer = nullptr);
   virtual ~ClientMultiRequestImplementation();
 
   // Client
+  using Client::performRequests;
   std::shared_ptr<RequestToken> performRequest(
       const std::shared_ptr<Request> &request,
       std::function<void(const std::shared_ptr<Response> &)> callback) override;
+  std::vector<std::shared_ptr<RequestToken>> performRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks)
+      override;
   void pinResponse(const std::shared_ptr<Response> &response,
                    const std::string &pin_identifier) override;
   void unpinResponse(const std::shared_ptr<Response> &response,
                      const std::string &pin_identifier) override;
+  void pinRequestHashes(const std::vector<std::string> &request_hashes,
+                        const std::string &pin_identifier,
+                        std::function<void(size_t pinned_bytes)> callback) override;
+  void unpinRequestHashes(const std::vector<std::string> &request_hashes,
+                          const std::string &pin_identifier,
+                          std::function<void(size_t unpinned_bytes)> callback) override;
   void removePinnedResponseForIdentifier(const std::string &pin_identifier) override;
   void pinnedResponsesForIdentifier(
       const std::string &pin_identifier,
       std::function<void(const std::vector<std::shared_ptr<Response>> &)> callback) override;
   void pinningIdentifiers(
       std::function<void(const std::vector<std::string> &identifiers)> callback) override;
+  void prefetchRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::string &pin_identifier,
+      std::function<void(size_t completed, size_t total, size_t bytes)> progress_callback) override;
+  Statistics stats() const override;
+  void setCoalescingWindow(std::chrono::milliseconds window, size_t max_bytes) override;
+  void setNegativeCacheTime(std::chrono::seconds time) override;
+  bool exportCache(const std::string &archive_path) override;
+  bool importCache(const std::string &archive_path) override;
+  void process(EVENT_LOOP_SOCKET socket, int events) override;
+  void onTimeout() override;
 
   // RequestTokenDelegate
   void requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) override;
@@ -64,12 +93,42 @@ class ClientMultiRequestImplementation
   struct MultiRequests {
     std::vector<MultiRequest> multi_requests;
     std::shared_ptr<RequestToken> request_token;
+    std::string request_hash;
+    bool cancelled;
+  };
+  struct RecentResponse {
+    std::shared_ptr<Response> response;
+    TIMING_POINT expiry_time;
+    size_t size;
   };
+  struct Shard {
+    Shard();
+
+    std::unordered_map<std::string, std::shared_ptr<MultiRequests>> requests_in_flight;
+    std::unordered_map<std::string, RecentResponse> recent_responses;
+    std::deque<std::pair<std::string, TIMING_POINT>> recent_response_expiries;
+    size_t recent_responses_size;
+  };
+  typedef ShardedTable<Shard> SHARDS;
+
+  std::function<void(const std::shared_ptr<Response> &)> responseCallback(
+      const std::string &hash, const std::shared_ptr<MultiRequests> &multi_requests);
+  bool shouldShareResponses(const std::shared_ptr<Request> &request) const;
+  void storeRecentResponse(Shard &shard,
+                           const std::string &hash,
+                           const std::shared_ptr<Response> &response);
+  void pruneRecentResponses(Shard &shard, TIMING_POINT now);
 
   const std::shared_ptr<Client> _wrapped_client;
+  const std::shared_ptr<LayerMetrics> _metrics;
+  std::atomic<uint64_t> _coalesced_requests;
+  const std::shared_ptr<RequestObserver> _request_observer;
 
-  std::unordered_map<std::string, MultiRequests> _requests_in_flight;
-  std::mutex _requests_in_flight_mutex;
+  // Requests are spread across shards by hash, and the byte budget is shared by all of them
+  SHARDS _shards;
+  std::atomic<std::chrono::milliseconds::rep> _coalescing_window;
+  std::atomic<size_t> _coalescing_max_bytes;
+  std::atomic<size_t> _recent_responses_size;
 };
 
 }  // namespace http
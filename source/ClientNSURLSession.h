@@ -27,7 +27,8 @@
 namespace nativeformat {
 namespace http {
 
-extern std::shared_ptr<Client> createNSURLSessionClient();
+extern std::shared_ptr<Client> createNSURLSessionClient(
+    const std::shared_ptr<RequestObserver> &request_observer = nullptr);
 
 }  // namespace http
 }  // namespace nativeformat
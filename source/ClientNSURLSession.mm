@@ -24,8 +24,11 @@
 
 #include <NFHTTP/ResponseImplementation.h>
 
+#include <atomic>
 #include <unordered_map>
 
+#include "Metrics.h"
+#include "RequestObserverNotification.h"
 #include "RequestTokenDelegate.h"
 #include "RequestTokenImplementation.h"
 
@@ -41,13 +44,14 @@ class ClientNSURLSession : public Client,
                            public RequestTokenDelegate,
                            public std::enable_shared_from_this<ClientNSURLSession> {
    public:
-    ClientNSURLSession();
+    ClientNSURLSession(const std::shared_ptr<RequestObserver> &request_observer);
     virtual ~ClientNSURLSession();
 
     // Client
     std::shared_ptr<RequestToken> performRequest(
         const std::shared_ptr<Request> &request,
         std::function<void(const std::shared_ptr<Response> &)> callback) override;
+    Statistics stats() const override;
 
     // RequestTokenDelegate
     void requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) override;
@@ -57,14 +61,26 @@ class ClientNSURLSession : public Client,
     static const std::shared_ptr<Response> responseFromResponse(NSHTTPURLResponse *response,
                                                                 const std::shared_ptr<Request> request,
                                                                 NSData *data);
+    static const std::shared_ptr<Response> responseFromDownload(NSHTTPURLResponse *response,
+                                                                const std::shared_ptr<Request> request,
+                                                                NSURL *location);
 
     NSURLSession *_session;
     std::unordered_map<std::shared_ptr<RequestToken>, NSURLSessionTask *> _tokens;
     std::mutex _tokens_mutex;
+
+    const std::shared_ptr<LayerMetrics> _metrics;
+    std::atomic<uint64_t> _bytes_sent;
+    std::atomic<uint64_t> _bytes_received;
+    const std::shared_ptr<RequestObserver> _request_observer;
 };
 
-ClientNSURLSession::ClientNSURLSession()
-    : _session([NSURLSession sessionWithConfiguration:[NSURLSessionConfiguration defaultSessionConfiguration]])
+ClientNSURLSession::ClientNSURLSession(const std::shared_ptr<RequestObserver> &request_observer)
+    : _session([NSURLSession sessionWithConfiguration:[NSURLSessionConfiguration defaultSessionConfiguration]]),
+      _metrics(std::make_shared<LayerMetrics>()),
+      _bytes_sent(0),
+      _bytes_received(0),
+      _request_observer(request_observer)
 {
 }
 
@@ -85,28 +101,73 @@ std::shared_ptr<RequestToken> ClientNSURLSession::performRequest(
         const std::shared_ptr<Request> copied_request = request;
         std::shared_ptr<RequestToken> request_token =
             std::make_shared<RequestTokenImplementation>(shared_from_this(), request->hash());
-        NSURLSessionTask *task =
-            [_session dataTaskWithRequest:urlRequest
-                        completionHandler:^(NSData *data, NSURLResponse *response, NSError *error) {
-                            {
-                                std::lock_guard<std::mutex> lock(_tokens_mutex);
-                                _tokens.erase(request_token);
-                            }
-                            if ([response isKindOfClass:[NSHTTPURLResponse class]]) {
-                                callback(responseFromResponse((NSHTTPURLResponse *)response, copied_request, data));
-                            } else {
-                                callback(responseFromResponse(nil, copied_request, data));
-                            }
-                        }];
+        std::function<void(const std::shared_ptr<Response> &)> tracked_callback =
+            LayerMetrics::trackRequest(_metrics, callback);
+        __block NSURLSessionTask *task = nil;
+        if (!request->downloadPath().empty()) {
+            // Let the session stream the body to disk, then move it into place
+            task = [_session downloadTaskWithRequest:urlRequest
+                                   completionHandler:^(NSURL *location, NSURLResponse *response, NSError *error) {
+                                       {
+                                           std::lock_guard<std::mutex> lock(_tokens_mutex);
+                                           _tokens.erase(request_token);
+                                       }
+                                       incrementCounter(_bytes_sent, task.countOfBytesSent);
+                                       incrementCounter(_bytes_received, task.countOfBytesReceived);
+                                       if ([response isKindOfClass:[NSHTTPURLResponse class]]) {
+                                           tracked_callback(responseFromDownload(
+                                               (NSHTTPURLResponse *)response, copied_request, location));
+                                       } else {
+                                           tracked_callback(responseFromDownload(nil, copied_request, location));
+                                       }
+                                   }];
+        } else {
+            task = [_session
+                dataTaskWithRequest:urlRequest
+                  completionHandler:^(NSData *data, NSURLResponse *response, NSError *error) {
+                      {
+                          std::lock_guard<std::mutex> lock(_tokens_mutex);
+                          _tokens.erase(request_token);
+                      }
+                      incrementCounter(_bytes_sent, task.countOfBytesSent);
+                      incrementCounter(_bytes_received, task.countOfBytesReceived);
+                      if ([response isKindOfClass:[NSHTTPURLResponse class]]) {
+                          tracked_callback(responseFromResponse((NSHTTPURLResponse *)response, copied_request, data));
+                      } else {
+                          tracked_callback(responseFromResponse(nil, copied_request, data));
+                      }
+                  }];
+        }
+        switch (request->priority()) {
+            case RequestPriorityLow:
+                task.priority = NSURLSessionTaskPriorityLow;
+                break;
+            case RequestPriorityHigh:
+                task.priority = NSURLSessionTaskPriorityHigh;
+                break;
+            default:
+                task.priority = NSURLSessionTaskPriorityDefault;
+                break;
+        }
         {
             std::lock_guard<std::mutex> lock(_tokens_mutex);
             _tokens[request_token] = task;
         }
+        notifyRequestObserver(_request_observer, RequestEventNetworkStarted, request_token->identifier());
         [task resume];
         return request_token;
     }
 }
 
+Statistics ClientNSURLSession::stats() const
+{
+    Statistics statistics;
+    statistics.native = _metrics->statistics();
+    statistics.bytes_sent = counterValue(_bytes_sent);
+    statistics.bytes_received = counterValue(_bytes_received);
+    return statistics;
+}
+
 void ClientNSURLSession::requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token)
 {
     std::lock_guard<std::mutex> lock(_tokens_mutex);
@@ -131,6 +192,19 @@ NSURLRequest *ClientNSURLSession::requestFromRequest(const std::shared_ptr<Reque
     const unsigned char *data = request->data(data_length);
     if (data_length > 0) {
         mutableRequest.HTTPBody = [NSData dataWithBytes:data length:data_length];
+    } else if (!request->dataPath().empty()) {
+        mutableRequest.HTTPBodyStream =
+            [NSInputStream inputStreamWithFileAtPath:[NSString stringWithUTF8String:request->dataPath().c_str()]];
+    } else if (request->dataProvider()) {
+        // NSURLSession cannot pull from a provider directly, so drain it into the body up front
+        NSMutableData *body = [NSMutableData data];
+        REQUEST_DATA_PROVIDER_FUNCTION data_provider = request->dataProvider();
+        unsigned char buffer[65536];
+        size_t buffer_length = 0;
+        while ((buffer_length = data_provider(buffer, sizeof(buffer))) > 0) {
+            [body appendBytes:buffer length:buffer_length];
+        }
+        mutableRequest.HTTPBody = body;
     }
     if (!mutableRequest.allHTTPHeaderFields[AcceptLanguageHeader]) {
         [mutableRequest setValue:languageHeaderValue() forHTTPHeaderField:AcceptLanguageHeader];
@@ -150,6 +224,27 @@ const std::shared_ptr<Response> ClientNSURLSession::responseFromResponse(NSHTTPU
     return new_response;
 }
 
+const std::shared_ptr<Response> ClientNSURLSession::responseFromDownload(NSHTTPURLResponse *response,
+                                                                         const std::shared_ptr<Request> request,
+                                                                         NSURL *location)
+{
+    // Error bodies are small, so hand them back in memory rather than as the download
+    if (location == nil || response.statusCode < 200 || response.statusCode >= 300) {
+        return responseFromResponse(response, request, location ? [NSData dataWithContentsOfURL:location] : nil);
+    }
+    NSFileManager *fileManager = [NSFileManager defaultManager];
+    NSString *downloadPath = [NSString stringWithUTF8String:request->downloadPath().c_str()];
+    [fileManager removeItemAtPath:downloadPath error:nil];
+    if (![fileManager moveItemAtURL:location toURL:[NSURL fileURLWithPath:downloadPath] error:nil]) {
+        return responseFromResponse(response, request, [NSData dataWithContentsOfURL:location]);
+    }
+    NSDictionary *attributes = [fileManager attributesOfItemAtPath:downloadPath error:nil];
+    std::shared_ptr<ResponseImplementation> new_response =
+        std::static_pointer_cast<ResponseImplementation>(responseFromResponse(response, request, nil));
+    new_response->setDataPath(request->downloadPath(), (size_t)attributes.fileSize);
+    return new_response;
+}
+
 // Lifted from
 // https://raw.githubusercontent.com/spotify/SPTDataLoader/master/SPTDataLoader/SPTDataLoaderRequest.m
 
@@ -206,9 +301,9 @@ static NSString *languageHeaderValue()
     return languageHeaderValue;
 }
 
-std::shared_ptr<Client> createNSURLSessionClient()
+std::shared_ptr<Client> createNSURLSessionClient(const std::shared_ptr<RequestObserver> &request_observer)
 {
-    return std::make_shared<ClientNSURLSession>();
+    return std::make_shared<ClientNSURLSession>(request_observer);
 }
 
 }  // namespace http
@@ -0,0 +1,365 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include "ClientSegmentedImplementation.h"
+
+#include <NFHTTP/ResponseImplementation.h>
+
+#include <algorithm>
+#include <cctype>
+#include <cerrno>
+#include <cstdlib>
+#include <cstring>
+#include <limits>
+
+#include "DownloadFile.h"
+#include "RequestTokenImplementation.h"
+
+namespace nativeformat {
+namespace http {
+
+namespace {
+static const std::string SEGMENTS_KEY("segments");
+static const std::string CONTENT_LENGTH_HEADER("Content-Length");
+static const std::string ACCEPT_RANGES_HEADER("Accept-Ranges");
+static const std::string ETAG_HEADER("ETag");
+static const std::string RANGE_HEADER("Range");
+static const std::string IF_RANGE_HEADER("If-Range");
+static const std::string ACCEPT_ENCODING_HEADER("Accept-Encoding");
+
+static std::string headerValue(const std::unordered_map<std::string, std::string> &headers,
+                               const std::string &header_name) {
+  for (const auto &header : headers) {
+    if (header.first.size() == header_name.size() &&
+        std::equal(
+            header.first.begin(), header.first.end(), header_name.begin(), [](char a, char b) {
+              return tolower(a) == tolower(b);
+            })) {
+      return header.second;
+    }
+  }
+  return "";
+}
+
+static bool parseLength(const std::string &value, size_t &length) {
+  // strtoull would skip whitespace and wrap negative numbers around, so insist on digits
+  if (value.empty() || !isdigit(static_cast<unsigned char>(value[0]))) {
+    return false;
+  }
+  char *end = nullptr;
+  errno = 0;
+  const unsigned long long parsed = std::strtoull(value.c_str(), &end, 10);
+  if (errno == ERANGE || *end != '\0' || parsed > std::numeric_limits<size_t>::max()) {
+    return false;
+  }
+  length = static_cast<size_t>(parsed);
+  return true;
+}
+}  // namespace
+
+ClientSegmentedImplementation::ClientSegmentedImplementation(
+    std::shared_ptr<Client> &wrapped_client)
+    : _wrapped_client(wrapped_client), _next_download_id(0) {}
+
+ClientSegmentedImplementation::~ClientSegmentedImplementation() {}
+
+std::shared_ptr<RequestToken> ClientSegmentedImplementation::performRequest(
+    const std::shared_ptr<Request> &request,
+    std::function<void(const std::shared_ptr<Response> &)> callback) {
+  if (!shouldSegmentRequest(request)) {
+    return _wrapped_client->performRequest(request, callback);
+  }
+
+  auto download = std::make_shared<SegmentedDownload>();
+  download->request = request;
+  download->callback = callback;
+  // Identical requests share a hash, so every download gets an identifier of its own
+  download->identifier = std::to_string(_next_download_id++);
+  download->request_token =
+      std::make_shared<RequestTokenImplementation>(shared_from_this(), download->identifier);
+  download->download_file = nullptr;
+  download->remaining_segments = 0;
+  download->failed = false;
+  {
+    std::lock_guard<std::mutex> lock(_downloads_mutex);
+    _downloads[download->identifier] = download;
+  }
+
+  // Probe the resource first to find out how large it is and whether it supports ranges
+  auto probe_request = createRequest(request);
+  probe_request->setMethod(HeadMethod);
+  probe_request->setSegmentCount(0);
+  probe_request->setDownloadPath("");
+  // The probe must report the length of the identity encoding that the ranges refer to
+  (*probe_request)[ACCEPT_ENCODING_HEADER] = "identity";
+  std::weak_ptr<ClientSegmentedImplementation> weak_this = shared_from_this();
+  auto probe_token = _wrapped_client->performRequest(
+      probe_request, [weak_this, download](const std::shared_ptr<Response> &response) {
+        if (auto strong_this = weak_this.lock()) {
+          strong_this->probeFinished(download, response);
+        }
+      });
+  {
+    std::lock_guard<std::mutex> lock(download->mutex);
+    download->segment_tokens.push_back(probe_token);
+  }
+  return download->request_token;
+}
+
+std::vector<std::shared_ptr<RequestToken>> ClientSegmentedImplementation::performRequests(
+    const std::vector<std::shared_ptr<Request>> &requests,
+    const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks) {
+  std::vector<std::shared_ptr<RequestToken>> request_tokens(requests.size());
+  std::vector<std::shared_ptr<Request>> wrapped_requests;
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> wrapped_callbacks;
+  std::vector<size_t> wrapped_indices;
+  for (size_t i = 0; i < requests.size(); ++i) {
+    if (shouldSegmentRequest(requests[i])) {
+      request_tokens[i] = performRequest(requests[i], callbacks[i]);
+      continue;
+    }
+    wrapped_requests.push_back(requests[i]);
+    wrapped_callbacks.push_back(callbacks[i]);
+    wrapped_indices.push_back(i);
+  }
+  if (!wrapped_requests.empty()) {
+    auto wrapped_tokens = _wrapped_client->performRequests(wrapped_requests, wrapped_callbacks);
+    for (size_t i = 0; i < wrapped_indices.size(); ++i) {
+      request_tokens[wrapped_indices[i]] = wrapped_tokens[i];
+    }
+  }
+  return request_tokens;
+}
+
+Statistics ClientSegmentedImplementation::stats() const {
+  return _wrapped_client->stats();
+}
+
+void ClientSegmentedImplementation::process(EVENT_LOOP_SOCKET socket, int events) {
+  _wrapped_client->process(socket, events);
+}
+
+void ClientSegmentedImplementation::onTimeout() {
+  _wrapped_client->onTimeout();
+}
+
+void ClientSegmentedImplementation::requestTokenDidCancel(
+    const std::shared_ptr<RequestToken> &request_token) {
+  std::shared_ptr<SegmentedDownload> download;
+  {
+    std::lock_guard<std::mutex> lock(_downloads_mutex);
+    auto download_it = _downloads.find(request_token->identifier());
+    if (download_it == _downloads.end()) {
+      return;
+    }
+    download = download_it->second;
+  }
+  std::vector<std::shared_ptr<RequestToken>> segment_tokens;
+  {
+    std::lock_guard<std::mutex> lock(download->mutex);
+    segment_tokens = download->segment_tokens;
+  }
+  for (const auto &segment_token : segment_tokens) {
+    segment_token->cancel();
+  }
+  FILE *download_file = nullptr;
+  {
+    std::lock_guard<std::mutex> lock(download->mutex);
+    std::swap(download_file, download->download_file);
+  }
+  if (download_file != nullptr) {
+    discardDownloadFile(download_file, download->request->downloadPath());
+  }
+  finishDownload(download,
+                 std::make_shared<ResponseImplementation>(
+                     download->request, nullptr, 0, StatusCodeInvalid, true));
+}
+
+bool ClientSegmentedImplementation::shouldSegmentRequest(const std::shared_ptr<Request> &request) {
+  if (request->segmentCount() < 2 || request->method() != GetMethod) {
+    return false;
+  }
+  const auto &header_map = request->headerMap();
+  return header_map.find(RANGE_HEADER) == header_map.end() &&
+         headerValue(header_map, ACCEPT_ENCODING_HEADER).empty();
+}
+
+void ClientSegmentedImplementation::probeFinished(
+    const std::shared_ptr<SegmentedDownload> &download, const std::shared_ptr<Response> &response) {
+  if (download->request_token->cancelled()) {
+    return;
+  }
+  const auto &header_map = response->headerMap();
+  const std::string content_length = headerValue(header_map, CONTENT_LENGTH_HEADER);
+  const std::string accept_ranges = headerValue(header_map, ACCEPT_RANGES_HEADER);
+  // Without a length we cannot split the resource up, so it is fetched whole
+  size_t length = 0;
+  const bool has_length = parseLength(content_length, length);
+  const size_t maximum_segments = length / MINIMUM_SEGMENT_SIZE;
+  if (!has_length || response->statusCode() != StatusCodeOK ||
+      accept_ranges.find("bytes") == std::string::npos || maximum_segments < 2) {
+    performUnsegmentedRequest(download);
+    return;
+  }
+
+  // Downloads to a path have their segments written straight into place in the file
+  FILE *download_file = nullptr;
+  const std::string download_path = download->request->downloadPath();
+  if (!download_path.empty() && (download_file = openDownloadFile(download_path)) == nullptr) {
+    performUnsegmentedRequest(download);
+    return;
+  }
+
+  // Split the resource into evenly sized ranges and fetch them all at once
+  const size_t segments =
+      std::min(maximum_segments, static_cast<size_t>(download->request->segmentCount()));
+  const size_t segment_length = (length + segments - 1) / segments;
+  const std::string etag = headerValue(header_map, ETAG_HEADER);
+  std::vector<std::shared_ptr<Request>> segment_requests;
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> segment_callbacks;
+  std::weak_ptr<ClientSegmentedImplementation> weak_this = shared_from_this();
+  for (size_t offset = 0; offset < length; offset += segment_length) {
+    const size_t range_length = std::min(segment_length, length - offset);
+    auto segment_request = createRequest(download->request);
+    segment_request->setSegmentCount(0);
+    segment_request->setDownloadPath("");
+    (*segment_request)[ACCEPT_ENCODING_HEADER] = "identity";
+    (*segment_request)[RANGE_HEADER] =
+        "bytes=" + std::to_string(offset) + "-" + std::to_string(offset + range_length - 1);
+    if (!etag.empty()) {
+      // If the resource changes under us the server sends the whole thing, which we reject
+      (*segment_request)[IF_RANGE_HEADER] = etag;
+    }
+    segment_requests.push_back(segment_request);
+    segment_callbacks.push_back(
+        [weak_this, download, offset, range_length](const std::shared_ptr<Response> &response) {
+          if (auto strong_this = weak_this.lock()) {
+            strong_this->segmentFinished(download, offset, range_length, response);
+          }
+        });
+  }
+  {
+    std::lock_guard<std::mutex> lock(download->mutex);
+    download->probe_response = response;
+    download->download_file = download_file;
+    if (download_file == nullptr) {
+      download->data.resize(length);
+    }
+    download->remaining_segments = segment_requests.size();
+  }
+  auto segment_tokens = _wrapped_client->performRequests(segment_requests, segment_callbacks);
+  std::lock_guard<std::mutex> lock(download->mutex);
+  download->segment_tokens.insert(
+      download->segment_tokens.end(), segment_tokens.begin(), segment_tokens.end());
+}
+
+void ClientSegmentedImplementation::segmentFinished(
+    const std::shared_ptr<SegmentedDownload> &download,
+    size_t offset,
+    size_t length,
+    const std::shared_ptr<Response> &response) {
+  if (download->request_token->cancelled()) {
+    return;
+  }
+  bool complete = false;
+  bool failed = false;
+  {
+    std::lock_guard<std::mutex> lock(download->mutex);
+    size_t data_length = 0;
+    const unsigned char *data = response->data(data_length);
+    if (response->statusCode() != StatusCodePartialContent || data_length != length) {
+      download->failed = true;
+    } else if (download->download_file != nullptr) {
+      download->failed = download->failed ||
+                         fseek(download->download_file, offset, SEEK_SET) != 0 ||
+                         fwrite(data, length, 1, download->download_file) != 1;
+    } else if (!download->data.empty()) {
+      memcpy(download->data.data() + offset, data, length);
+    }
+    complete = --download->remaining_segments == 0;
+    failed = download->failed;
+  }
+  if (!complete) {
+    return;
+  }
+  FILE *download_file = nullptr;
+  {
+    std::lock_guard<std::mutex> lock(download->mutex);
+    std::swap(download_file, download->download_file);
+  }
+  const std::string download_path = download->request->downloadPath();
+  if (failed) {
+    if (download_file != nullptr) {
+      discardDownloadFile(download_file, download_path);
+    }
+    performUnsegmentedRequest(download);
+    return;
+  }
+
+  auto segmented_response = std::make_shared<ResponseImplementation>(
+      download->request, download->data.data(), download->data.size(), StatusCodeOK, false);
+  if (download_file != nullptr) {
+    fseek(download_file, 0, SEEK_END);
+    const size_t download_length = ftell(download_file);
+    if (!commitDownloadFile(download_file, download_path)) {
+      performUnsegmentedRequest(download);
+      return;
+    }
+    segmented_response->setDataPath(download_path, download_length);
+  }
+  segmented_response->headerMap() = download->probe_response->headerMap();
+  segmented_response->setMetadata(SEGMENTS_KEY,
+                                  std::to_string(download->segment_tokens.size() - 1));
+  finishDownload(download, segmented_response);
+}
+
+void ClientSegmentedImplementation::performUnsegmentedRequest(
+    const std::shared_ptr<SegmentedDownload> &download) {
+  // Fall back to a single plain request for the whole resource
+  auto request = createRequest(download->request);
+  request->setSegmentCount(0);
+  std::weak_ptr<ClientSegmentedImplementation> weak_this = shared_from_this();
+  auto request_token = _wrapped_client->performRequest(
+      request, [weak_this, download](const std::shared_ptr<Response> &response) {
+        if (auto strong_this = weak_this.lock()) {
+          strong_this->finishDownload(download, response);
+        }
+      });
+  std::lock_guard<std::mutex> lock(download->mutex);
+  download->segment_tokens.push_back(request_token);
+}
+
+void ClientSegmentedImplementation::finishDownload(
+    const std::shared_ptr<SegmentedDownload> &download, const std::shared_ptr<Response> &response) {
+  {
+    std::lock_guard<std::mutex> lock(_downloads_mutex);
+    auto download_it = _downloads.find(download->identifier);
+    if (download_it == _downloads.end() || download_it->second != download) {
+      return;
+    }
+    _downloads.erase(download_it);
+  }
+  download->data.clear();
+  download->data.shrink_to_fit();
+  download->callback(response);
+}
+
+}  // namespace http
+}  // namespace nativeformat
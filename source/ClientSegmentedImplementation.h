@@ -0,0 +1,95 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <NFHTTP/Client.h>
+
+#include <atomic>
+#include <memory>
+#include <mutex>
+#include <unordered_map>
+
+#include "RequestTokenDelegate.h"
+
+namespace nativeformat {
+namespace http {
+
+class ClientSegmentedImplementation
+    : public Client,
+      public std::enable_shared_from_this<ClientSegmentedImplementation>,
+      public RequestTokenDelegate {
+ public:
+  ClientSegmentedImplementation(std::shared_ptr<Client> &wrapped_client);
+  virtual ~ClientSegmentedImplementation();
+
+  static const size_t MINIMUM_SEGMENT_SIZE = 1048576;  // 1 MB
+
+  // Client
+  using Client::performRequests;
+  std::shared_ptr<RequestToken> performRequest(
+      const std::shared_ptr<Request> &request,
+      std::function<void(const std::shared_ptr<Response> &)> callback) override;
+  std::vector<std::shared_ptr<RequestToken>> performRequests(
+      const std::vector<std::shared_ptr<Request>> &requests,
+      const std::vector<std::function<void(const std::shared_ptr<Response> &)>> &callbacks)
+      override;
+  Statistics stats() const override;
+  void process(EVENT_LOOP_SOCKET socket, int events) override;
+  void onTimeout() override;
+
+  // RequestTokenDelegate
+  void requestTokenDidCancel(const std::shared_ptr<RequestToken> &request_token) override;
+
+ private:
+  struct SegmentedDownload {
+    std::shared_ptr<Request> request;
+    std::string identifier;
+    std::function<void(const std::shared_ptr<Response> &)> callback;
+    std::shared_ptr<RequestToken> request_token;
+    std::vector<std::shared_ptr<RequestToken>> segment_tokens;
+    std::shared_ptr<Response> probe_response;
+    std::vector<unsigned char> data;
+    FILE *download_file;
+    size_t remaining_segments;
+    bool failed;
+    std::mutex mutex;
+  };
+
+  static bool shouldSegmentRequest(const std::shared_ptr<Request> &request);
+  void probeFinished(const std::shared_ptr<SegmentedDownload> &download,
+                     const std::shared_ptr<Response> &response);
+  void segmentFinished(const std::shared_ptr<SegmentedDownload> &download,
+                       size_t offset,
+                       size_t length,
+                       const std::shared_ptr<Response> &response);
+  void performUnsegmentedRequest(const std::shared_ptr<SegmentedDownload> &download);
+  void finishDownload(const std::shared_ptr<SegmentedDownload> &download,
+                      const std::shared_ptr<Response> &response);
+
+  const std::shared_ptr<Client> _wrapped_client;
+
+  std::unordered_map<std::string, std::shared_ptr<SegmentedDownload>> _downloads;
+  std::mutex _downloads_mutex;
+  std::atomic<uint64_t> _next_download_id;
+};
+
+}  // namespace http
+}  // namespace nativeformat
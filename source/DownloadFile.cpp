@@ -0,0 +1,112 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include "DownloadFile.h"
+
+#if _WIN32
+#include <io.h>
+#else
+#include <unistd.h>
+#endif
+
+namespace nativeformat {
+namespace http {
+
+namespace {
+static const std::string PART_SUFFIX(".part");
+static const size_t COPY_BUFFER_SIZE = 65536;
+}  // namespace
+
+FILE *openDownloadFile(const std::string &download_path) {
+  return fopen((download_path + PART_SUFFIX).c_str(), "w+b");
+}
+
+bool commitDownloadFile(FILE *download_file, const std::string &download_path) {
+  const std::string part_path = download_path + PART_SUFFIX;
+#if _WIN32
+  bool synced = fflush(download_file) == 0 && _commit(_fileno(download_file)) == 0;
+#else
+  bool synced = fflush(download_file) == 0 && fsync(fileno(download_file)) == 0;
+#endif
+  synced = fclose(download_file) == 0 && synced;
+  if (!synced) {
+    remove(part_path.c_str());
+    return false;
+  }
+#if _WIN32
+  // Windows refuses to rename over an existing file
+  remove(download_path.c_str());
+#endif
+  if (rename(part_path.c_str(), download_path.c_str()) != 0) {
+    remove(part_path.c_str());
+    return false;
+  }
+  return true;
+}
+
+void discardDownloadFile(FILE *download_file, const std::string &download_path) {
+  fclose(download_file);
+  remove((download_path + PART_SUFFIX).c_str());
+}
+
+bool writeDownloadFile(const std::string &download_path,
+                       const unsigned char *data,
+                       size_t data_length) {
+  FILE *download_file = openDownloadFile(download_path);
+  if (download_file == nullptr) {
+    return false;
+  }
+  if (data_length > 0 && fwrite(data, data_length, 1, download_file) != 1) {
+    discardDownloadFile(download_file, download_path);
+    return false;
+  }
+  return commitDownloadFile(download_file, download_path);
+}
+
+bool copyFileContents(const std::string &source_path, FILE *destination_file) {
+  FILE *source_file = fopen(source_path.c_str(), "rb");
+  if (source_file == nullptr) {
+    return false;
+  }
+  unsigned char buffer[COPY_BUFFER_SIZE];
+  size_t read_length = 0;
+  bool copied = true;
+  while (copied && (read_length = fread(buffer, 1, COPY_BUFFER_SIZE, source_file)) > 0) {
+    copied = fwrite(buffer, read_length, 1, destination_file) == 1;
+  }
+  copied = copied && !ferror(source_file);
+  fclose(source_file);
+  return copied;
+}
+
+bool copyDownloadFile(const std::string &source_path, const std::string &download_path) {
+  FILE *download_file = openDownloadFile(download_path);
+  if (download_file == nullptr) {
+    return false;
+  }
+  if (!copyFileContents(source_path, download_file)) {
+    discardDownloadFile(download_file, download_path);
+    return false;
+  }
+  return commitDownloadFile(download_file, download_path);
+}
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,41 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <cstdio>
+#include <string>
+
+namespace nativeformat {
+namespace http {
+
+// Downloads are written to "<download_path>.part" and only renamed into place once they are
+// complete and flushed to disk, so a download path never holds a truncated body
+extern FILE *openDownloadFile(const std::string &download_path);
+extern bool commitDownloadFile(FILE *download_file, const std::string &download_path);
+extern void discardDownloadFile(FILE *download_file, const std::string &download_path);
+extern bool writeDownloadFile(const std::string &download_path,
+                              const unsigned char *data,
+                              size_t data_length);
+extern bool copyFileContents(const std::string &source_path, FILE *destination_file);
+extern bool copyDownloadFile(const std::string &source_path, const std::string &download_path);
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,107 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include "Metrics.h"
+
+namespace nativeformat {
+namespace http {
+
+namespace {
+static size_t latencyBucket(double seconds) {
+  const double milliseconds = seconds * 1000.0;
+  size_t bucket = 0;
+  while (bucket < LatencyHistogram::BUCKET_COUNT - 1 &&
+         milliseconds >= LatencyHistogram::bucketUpperBound(bucket)) {
+    ++bucket;
+  }
+  return bucket;
+}
+}  // namespace
+
+void incrementCounter(std::atomic<uint64_t> &counter, uint64_t amount) {
+  counter.fetch_add(amount, std::memory_order_relaxed);
+}
+
+uint64_t counterValue(const std::atomic<uint64_t> &counter) {
+  return counter.load(std::memory_order_relaxed);
+}
+
+LayerMetrics::LayerMetrics()
+    : _started(0), _completed(0), _cancelled(0), _latency_total_microseconds(0) {
+  for (auto &status_class : _status_classes) {
+    status_class = 0;
+  }
+  for (auto &latency_bucket : _latency_buckets) {
+    latency_bucket = 0;
+  }
+}
+
+std::function<void(const std::shared_ptr<Response> &)> LayerMetrics::trackRequest(
+    const std::shared_ptr<LayerMetrics> &metrics,
+    std::function<void(const std::shared_ptr<Response> &)> callback) {
+  metrics->requestStarted();
+  const TIMING_POINT start_time = timingNow();
+  return [metrics, callback, start_time](const std::shared_ptr<Response> &response) {
+    metrics->requestFinished(response, secondsSince(start_time));
+    callback(response);
+  };
+}
+
+void LayerMetrics::requestStarted() {
+  incrementCounter(_started);
+}
+
+void LayerMetrics::requestFinished(const std::shared_ptr<Response> &response, double seconds) {
+  if (response->cancelled()) {
+    incrementCounter(_cancelled);
+  } else {
+    const size_t status_class = static_cast<size_t>(response->statusCode()) / 100;
+    incrementCounter(
+        _status_classes[status_class < LayerStatistics::STATUS_CLASS_COUNT ? status_class : 0]);
+    incrementCounter(_latency_buckets[latencyBucket(seconds)]);
+    incrementCounter(_latency_total_microseconds, static_cast<uint64_t>(seconds * 1000000.0));
+  }
+  incrementCounter(_completed);
+}
+
+void LayerMetrics::requestCancelled() {
+  incrementCounter(_cancelled);
+  incrementCounter(_completed);
+}
+
+LayerStatistics LayerMetrics::statistics() const {
+  LayerStatistics statistics;
+  statistics.completed = counterValue(_completed);
+  statistics.started = counterValue(_started);
+  statistics.in_flight = statistics.started - statistics.completed;
+  statistics.cancelled = counterValue(_cancelled);
+  for (size_t i = 0; i < LayerStatistics::STATUS_CLASS_COUNT; ++i) {
+    statistics.status_classes[i] = counterValue(_status_classes[i]);
+  }
+  for (size_t i = 0; i < LatencyHistogram::BUCKET_COUNT; ++i) {
+    statistics.latency.buckets[i] = counterValue(_latency_buckets[i]);
+    statistics.latency.count += statistics.latency.buckets[i];
+  }
+  statistics.latency.total_milliseconds = counterValue(_latency_total_microseconds) / 1000.0;
+  return statistics;
+}
+
+}  // namespace http
+}  // namespace nativeformat
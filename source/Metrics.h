@@ -0,0 +1,66 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <NFHTTP/Response.h>
+#include <NFHTTP/Statistics.h>
+
+#include <array>
+#include <atomic>
+#include <functional>
+#include <memory>
+
+#include "Timing.h"
+
+namespace nativeformat {
+namespace http {
+
+// Counts the requests passing through a single layer of the client using only relaxed atomics,
+// so recording a request never takes a lock
+class LayerMetrics {
+ public:
+  LayerMetrics();
+
+  // Counts the request as started and returns a callback that records it as finished
+  static std::function<void(const std::shared_ptr<Response> &)> trackRequest(
+      const std::shared_ptr<LayerMetrics> &metrics,
+      std::function<void(const std::shared_ptr<Response> &)> callback);
+
+  void requestStarted();
+  void requestFinished(const std::shared_ptr<Response> &response, double seconds);
+  // For requests that are dropped on cancellation without their callback being called
+  void requestCancelled();
+  LayerStatistics statistics() const;
+
+ private:
+  std::atomic<uint64_t> _started;
+  std::atomic<uint64_t> _completed;
+  std::atomic<uint64_t> _cancelled;
+  std::array<std::atomic<uint64_t>, LayerStatistics::STATUS_CLASS_COUNT> _status_classes;
+  std::array<std::atomic<uint64_t>, LatencyHistogram::BUCKET_COUNT> _latency_buckets;
+  std::atomic<uint64_t> _latency_total_microseconds;
+};
+
+extern void incrementCounter(std::atomic<uint64_t> &counter, uint64_t amount = 1);
+extern uint64_t counterValue(const std::atomic<uint64_t> &counter);
+
+}  // namespace http
+}  // namespace nativeformat
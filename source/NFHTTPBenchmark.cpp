@@ -0,0 +1,423 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include <NFHTTP/NFHTTP.h>
+#include <NFHTTP/ResponseImplementation.h>
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <cstdlib>
+#include <ctime>
+#include <fstream>
+#include <iomanip>
+#include <iostream>
+#include <mutex>
+#include <new>
+#include <thread>
+
+#include <nlohmann/json.hpp>
+
+#if _WIN32
+#include <direct.h>
+#else
+#include <sys/resource.h>
+#include <sys/stat.h>
+#endif
+
+#include "CachingClient.h"
+#include "ClientCpprestsdk.h"
+#include "ClientCurl.h"
+#include "ClientModifierImplementation.h"
+#include "ClientMultiRequestImplementation.h"
+#include "ClientNSURLSession.h"
+#include "RequestTokenImplementation.h"
+#include "Timing.h"
+
+// Every allocation in the process is counted, so the per request figure includes a small and
+// constant amount of bookkeeping done by the benchmark itself
+static std::atomic<uint64_t> allocation_count(0);
+
+void *operator new(size_t size) {
+  allocation_count.fetch_add(1, std::memory_order_relaxed);
+  if (void *pointer = malloc(size == 0 ? 1 : size)) {
+    return pointer;
+  }
+  throw std::bad_alloc();
+}
+
+void operator delete(void *pointer) noexcept {
+  free(pointer);
+}
+
+namespace {
+
+using namespace nativeformat::http;
+
+struct BenchmarkConfiguration {
+  std::string base_url;
+  std::string cache_location;
+  size_t request_count;
+  size_t concurrency;
+  size_t body_size;
+  size_t latency;
+};
+
+static double cpuSeconds() {
+#if _WIN32
+  return static_cast<double>(std::clock()) / CLOCKS_PER_SEC;
+#else
+  struct rusage usage;
+  getrusage(RUSAGE_SELF, &usage);
+  return usage.ru_utime.tv_sec + usage.ru_stime.tv_sec +
+         (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec) / 1000000.0;
+#endif
+}
+
+static void makeDirectory(const std::string &path) {
+#if _WIN32
+  _mkdir(path.c_str());
+#else
+  mkdir(path.c_str(), 0755);
+#endif
+}
+
+static std::vector<std::shared_ptr<Request>> createRequests(
+    const BenchmarkConfiguration &configuration,
+    const std::string &name,
+    const std::string &query) {
+  std::vector<std::shared_ptr<Request>> requests;
+  for (size_t i = 0; i < configuration.request_count; ++i) {
+    const std::string url = configuration.base_url + "/" + name + "?id=" + std::to_string(i) +
+                            "&size=" + std::to_string(configuration.body_size) +
+                            "&latency=" + std::to_string(configuration.latency) + query;
+    requests.push_back(createRequest(url, std::unordered_map<std::string, std::string>()));
+  }
+  return requests;
+}
+
+static double percentile(const std::vector<double> &sorted_latencies, double fraction) {
+  if (sorted_latencies.empty()) {
+    return 0.0;
+  }
+  const size_t index = static_cast<size_t>(fraction * (sorted_latencies.size() - 1) + 0.5);
+  return sorted_latencies[index];
+}
+
+// Keeps the given number of requests in flight until every request has had a response
+static nlohmann::json runBenchmark(const std::string &name,
+                                   const std::shared_ptr<Client> &client,
+                                   const std::vector<std::shared_ptr<Request>> &requests,
+                                   size_t concurrency) {
+  // The last response is still unwinding on the client's thread when this call returns, so the
+  // responses hold on to the run state rather than referring to our stack
+  struct BenchmarkRun {
+    std::vector<std::shared_ptr<Request>> requests;
+    std::function<void(size_t)> perform_request;
+    std::mutex mutex;
+    std::condition_variable condition;
+    size_t next_request;
+    size_t completed_requests;
+    size_t failed_requests;
+    std::vector<double> latencies;
+  };
+  auto run = std::make_shared<BenchmarkRun>();
+  run->requests = requests;
+  run->next_request = 0;
+  run->completed_requests = 0;
+  run->failed_requests = 0;
+  run->latencies.resize(requests.size());
+
+  std::weak_ptr<BenchmarkRun> weak_run = run;
+  run->perform_request = [weak_run, client](size_t index) {
+    auto run = weak_run.lock();
+    if (!run) {
+      return;
+    }
+    const TIMING_POINT start_time = timingNow();
+    client->performRequest(run->requests[index],
+                           [run, index, start_time](const std::shared_ptr<Response> &response) {
+                             const double latency = secondsSince(start_time);
+                             size_t next_request = run->requests.size();
+                             {
+                               std::lock_guard<std::mutex> lock(run->mutex);
+                               run->latencies[index] = latency * 1000.0;
+                               if (response->statusCode() < 200 || response->statusCode() >= 400) {
+                                 run->failed_requests++;
+                               }
+                               if (run->next_request < run->requests.size()) {
+                                 next_request = run->next_request++;
+                               }
+                               if (++run->completed_requests == run->requests.size()) {
+                                 run->condition.notify_all();
+                               }
+                             }
+                             if (next_request < run->requests.size()) {
+                               run->perform_request(next_request);
+                             }
+                           });
+  };
+
+  const uint64_t start_allocations = allocation_count.load();
+  const double start_cpu = cpuSeconds();
+  const TIMING_POINT start_time = timingNow();
+  std::vector<size_t> initial_requests;
+  {
+    std::lock_guard<std::mutex> lock(run->mutex);
+    while (run->next_request < std::min(concurrency, requests.size())) {
+      initial_requests.push_back(run->next_request++);
+    }
+  }
+  for (size_t index : initial_requests) {
+    run->perform_request(index);
+  }
+  {
+    std::unique_lock<std::mutex> lock(run->mutex);
+    run->condition.wait(lock, [&] { return run->completed_requests == requests.size(); });
+  }
+  const double duration = secondsSince(start_time);
+  const double cpu = cpuSeconds() - start_cpu;
+  const uint64_t allocations = allocation_count.load() - start_allocations;
+
+  std::vector<double> sorted_latencies = run->latencies;
+  std::sort(sorted_latencies.begin(), sorted_latencies.end());
+  double total_latency = 0.0;
+  for (double latency : sorted_latencies) {
+    total_latency += latency;
+  }
+  const double request_count = std::max<double>(requests.size(), 1.0);
+  const Statistics statistics = client->stats();
+
+  std::cerr << name << ": " << requests.size() / duration << " requests/s" << std::endl;
+  return {{"name", name},
+          {"requests", requests.size()},
+          {"concurrency", concurrency},
+          {"failures", run->failed_requests},
+          {"duration_seconds", duration},
+          {"throughput", requests.size() / duration},
+          {"latency_ms",
+           {{"mean", total_latency / request_count},
+            {"p50", percentile(sorted_latencies, 0.5)},
+            {"p90", percentile(sorted_latencies, 0.9)},
+            {"p99", percentile(sorted_latencies, 0.99)},
+            {"max", sorted_latencies.empty() ? 0.0 : sorted_latencies.back()}}},
+          {"allocations_per_request", allocations / request_count},
+          {"cpu_ms_per_request", cpu * 1000.0 / request_count},
+          {"cache_hits", statistics.cache_hits},
+          {"cache_revalidations", statistics.cache_revalidations},
+          {"coalesced_requests", statistics.coalesced_requests}};
+}
+
+static std::shared_ptr<Client> createNativeBenchmarkClient() {
+#if USE_CURL
+  return createCurlClient();
+#elif USE_CPPRESTSDK
+  return createCpprestsdkClient();
+#elif __APPLE__
+  return createNSURLSessionClient();
+#else
+  return createCurlClient();
+#endif
+}
+
+static std::shared_ptr<Client> createCachingBenchmarkClient(const std::string &cache_location) {
+  makeDirectory(cache_location);
+  auto caching_client =
+      std::make_shared<CachingClient>(createNativeBenchmarkClient(), cache_location);
+  caching_client->initialise();
+  return caching_client;
+}
+
+// Holds each response until the thread that made the request completes it, so the contention
+// benchmark measures only the layers above it and never calls back into them while they are
+// still inside performRequests
+class DeferredClient : public Client {
+ public:
+  std::shared_ptr<RequestToken> performRequest(
+      const std::shared_ptr<Request> &request,
+      std::function<void(const std::shared_ptr<Response> &)> callback) override {
+    pendingResponses().push_back(std::make_pair(
+        callback,
+        std::make_shared<ResponseImplementation>(request, nullptr, 0, StatusCodeOK, false)));
+    return std::make_shared<RequestTokenImplementation>(std::weak_ptr<RequestTokenDelegate>(),
+                                                        request->hash());
+  }
+
+  static void completePendingResponses() {
+    auto pending_responses = std::move(pendingResponses());
+    pendingResponses().clear();
+    for (const auto &pending_response : pending_responses) {
+      pending_response.first(pending_response.second);
+    }
+  }
+
+ private:
+  typedef std::vector<
+      std::pair<std::function<void(const std::shared_ptr<Response> &)>, std::shared_ptr<Response>>>
+      PENDING_RESPONSES;
+
+  static PENDING_RESPONSES &pendingResponses() {
+    static thread_local PENDING_RESPONSES pending_responses;
+    return pending_responses;
+  }
+};
+
+// Every thread makes and completes its own requests as fast as it can, so the throughput is
+// bounded by how much the threads contend inside the client
+static nlohmann::json runContentionBenchmark(const std::string &name,
+                                             const std::shared_ptr<Client> &client,
+                                             const BenchmarkConfiguration &configuration,
+                                             size_t thread_count) {
+  // A small pool of URLs means threads keep landing on the same requests in flight
+  const size_t url_count = 64;
+  std::vector<std::shared_ptr<Request>> requests;
+  for (size_t i = 0; i < url_count; ++i) {
+    requests.push_back(createRequest(configuration.base_url + "/contention?id=" + std::to_string(i),
+                                     std::unordered_map<std::string, std::string>()));
+  }
+
+  const TIMING_POINT start_time = timingNow();
+  std::vector<std::thread> threads;
+  for (size_t thread_index = 0; thread_index < thread_count; ++thread_index) {
+    threads.push_back(std::thread([&, thread_index] {
+      for (size_t i = 0; i < configuration.request_count; ++i) {
+        client->performRequest(requests[(thread_index + i) % url_count],
+                               [](const std::shared_ptr<Response> &response) {});
+        DeferredClient::completePendingResponses();
+      }
+    }));
+  }
+  for (auto &thread : threads) {
+    thread.join();
+  }
+  const double duration = secondsSince(start_time);
+  const size_t request_count = thread_count * configuration.request_count;
+
+  std::cerr << name << ": " << request_count / duration << " requests/s" << std::endl;
+  return {{"name", name},
+          {"requests", request_count},
+          {"threads", thread_count},
+          {"duration_seconds", duration},
+          {"throughput", request_count / duration},
+          {"coalesced_requests", client->stats().coalesced_requests}};
+}
+
+}  // namespace
+
+int main(int argc, char *argv[]) {
+  // Parse our arguments
+  BenchmarkConfiguration configuration = {
+      "http://127.0.0.1:6583", "nfhttp-benchmark-cache", 1000, 16, 16384, 0};
+  std::string output_file = "";
+  for (int i = 1; i < argc - 1; ++i) {
+    std::string arg_string = argv[i];
+    if (arg_string == "-u") {
+      configuration.base_url = argv[++i];
+    } else if (arg_string == "-d") {
+      configuration.cache_location = argv[++i];
+    } else if (arg_string == "-n") {
+      configuration.request_count = std::strtoul(argv[++i], nullptr, 10);
+    } else if (arg_string == "-c") {
+      configuration.concurrency = std::max<size_t>(std::strtoul(argv[++i], nullptr, 10), 1);
+    } else if (arg_string == "-s") {
+      configuration.body_size = std::strtoul(argv[++i], nullptr, 10);
+    } else if (arg_string == "-l") {
+      configuration.latency = std::strtoul(argv[++i], nullptr, 10);
+    } else if (arg_string == "-o") {
+      output_file = argv[++i];
+    }
+  }
+  makeDirectory(configuration.cache_location);
+
+  // Each run uses its own URLs so that earlier runs never warm the cache for it
+  const std::string run_identifier = std::to_string(std::time(nullptr));
+  nlohmann::json benchmarks_json = nlohmann::json::array();
+
+  auto native_client = createNativeBenchmarkClient();
+  benchmarks_json.push_back(
+      runBenchmark("native",
+                   native_client,
+                   createRequests(configuration, "native-" + run_identifier, ""),
+                   configuration.concurrency));
+  benchmarks_json.push_back(
+      runBenchmark("native_chunked",
+                   native_client,
+                   createRequests(configuration, "chunked-" + run_identifier, "&chunked=1"),
+                   configuration.concurrency));
+
+  auto caching_client =
+      createCachingBenchmarkClient(configuration.cache_location + "/caching-" + run_identifier);
+  auto cached_requests = createRequests(configuration, "cached-" + run_identifier, "");
+  benchmarks_json.push_back(
+      runBenchmark("caching_cold", caching_client, cached_requests, configuration.concurrency));
+  benchmarks_json.push_back(
+      runBenchmark("caching_warm", caching_client, cached_requests, configuration.concurrency));
+
+  // Prime the cache with responses that expire immediately, so every request is revalidated
+  auto revalidate_client =
+      createCachingBenchmarkClient(configuration.cache_location + "/revalidate-" + run_identifier);
+  auto revalidate_requests =
+      createRequests(configuration, "revalidate-" + run_identifier, "&etag=1&max_age=0");
+  runBenchmark("prime", revalidate_client, revalidate_requests, configuration.concurrency);
+  benchmarks_json.push_back(runBenchmark(
+      "caching_revalidate", revalidate_client, revalidate_requests, configuration.concurrency));
+
+  auto full_client = createClient(configuration.cache_location + "/full-" + run_identifier,
+                                  "NFHTTPBenchmark-" + version());
+  benchmarks_json.push_back(
+      runBenchmark("full_stack",
+                   full_client,
+                   createRequests(configuration, "full-" + run_identifier, ""),
+                   configuration.concurrency));
+
+  // Contention in the coalescing layers, without any network
+  std::shared_ptr<Client> deferred_client = std::make_shared<DeferredClient>();
+  std::shared_ptr<Client> multi_request_client =
+      std::make_shared<ClientMultiRequestImplementation>(deferred_client);
+  benchmarks_json.push_back(runContentionBenchmark(
+      "contention_multi_request", multi_request_client, configuration, configuration.concurrency));
+  std::shared_ptr<Client> contention_multi_request_client =
+      std::make_shared<ClientMultiRequestImplementation>(deferred_client);
+  auto modifier_client =
+      std::make_shared<ClientModifierImplementation>(DO_NOT_MODIFY_REQUESTS_FUNCTION,
+                                                     DO_NOT_MODIFY_RESPONSES_FUNCTION,
+                                                     contention_multi_request_client);
+  benchmarks_json.push_back(runContentionBenchmark(
+      "contention_modifier", modifier_client, configuration, configuration.concurrency));
+
+  // Write out the results as JSON
+  nlohmann::json output_json = {{"version", version()},
+                                {"configuration",
+                                 {{"base_url", configuration.base_url},
+                                  {"requests", configuration.request_count},
+                                  {"concurrency", configuration.concurrency},
+                                  {"body_size", configuration.body_size},
+                                  {"latency_ms", configuration.latency}}},
+                                {"benchmarks", benchmarks_json}};
+  if (output_file.empty()) {
+    std::cout << std::setw(4) << output_json << std::endl;
+  } else {
+    std::ofstream output_stream(output_file);
+    output_stream << std::setw(4) << output_json << std::endl;
+  }
+
+  return 0;
+}
@@ -21,21 +21,348 @@
 
 #include <NFHTTP/NFHTTP.h>
 
+#include <algorithm>
+#include <chrono>
+#include <condition_variable>
+#include <cstdlib>
 #include <fstream>
+#include <functional>
+#include <iomanip>
 #include <iostream>
+#include <mutex>
+#include <thread>
+#include <vector>
 
 #include <nlohmann/json.hpp>
 
+#include "CachingClient.h"
+#include "ClientCpprestsdk.h"
+#include "ClientCurl.h"
+#include "ClientMultiRequestImplementation.h"
+#include "ClientNSURLSession.h"
+#include "Timing.h"
+
+static std::string randomFileName(const std::string &output_directory) {
+  // Generate a random file to dump the payload to
+  const size_t random_file_length = 20;
+  auto randchar = []() {
+    const char charset[] =
+        "0123456789"
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        "abcdefghijklmnopqrstuvwxyz";
+    const size_t max_index = (sizeof(charset) - 1);
+    return charset[rand() % max_index];
+  };
+  std::string random_file_name(random_file_length, 0);
+  std::generate_n(random_file_name.begin(), random_file_length, randchar);
+  random_file_name.insert(0, "/");
+  random_file_name.insert(0, output_directory);
+  return random_file_name;
+}
+
+namespace {
+
+using namespace nativeformat::http;
+
+struct BenchConfiguration {
+  std::vector<std::string> urls;
+  std::string url_template;
+  std::string layer;
+  std::string cache_location;
+  size_t concurrency;
+  double rate;
+  double duration;
+  std::string output_file;
+};
+
+static std::shared_ptr<Client> createBenchNativeClient() {
+#if USE_CURL
+  return createCurlClient();
+#elif USE_CPPRESTSDK
+  return createCpprestsdkClient();
+#elif __APPLE__
+  return createNSURLSessionClient();
+#else
+  return createCurlClient();
+#endif
+}
+
+static std::shared_ptr<Client> createBenchClient(const BenchConfiguration &configuration) {
+  if (configuration.layer == "native") {
+    return createBenchNativeClient();
+  } else if (configuration.layer == "caching") {
+    auto caching_client =
+        std::make_shared<CachingClient>(createBenchNativeClient(), configuration.cache_location);
+    caching_client->initialise();
+    return caching_client;
+  } else if (configuration.layer == "multi") {
+    auto native_client = createBenchNativeClient();
+    return std::make_shared<ClientMultiRequestImplementation>(native_client);
+  } else if (configuration.layer == "full") {
+    return createClient(configuration.cache_location, "NFHTTPCLI-" + version());
+  }
+  return nullptr;
+}
+
+static std::string benchURL(const BenchConfiguration &configuration, size_t index) {
+  if (configuration.url_template.empty()) {
+    return configuration.urls[index % configuration.urls.size()];
+  }
+  // Every {n} in the template is replaced by the index of the request
+  std::string url = configuration.url_template;
+  const std::string placeholder = "{n}";
+  const std::string index_string = std::to_string(index);
+  for (size_t position = url.find(placeholder); position != std::string::npos;
+       position = url.find(placeholder, position + index_string.size())) {
+    url.replace(position, placeholder.size(), index_string);
+  }
+  return url;
+}
+
+static double percentile(const std::vector<double> &sorted_latencies, double fraction) {
+  if (sorted_latencies.empty()) {
+    return 0.0;
+  }
+  const size_t index = static_cast<size_t>(fraction * (sorted_latencies.size() - 1) + 0.5);
+  return sorted_latencies[index];
+}
+
+// Either keeps a fixed number of requests in flight (a closed loop) or starts requests at a fixed
+// rate regardless of how many are outstanding (an open loop). In the open loop latency is measured
+// from when a request was due rather than when it was sent, so a stalled client is not flattered
+static nlohmann::json runBench(const BenchConfiguration &configuration,
+                               const std::shared_ptr<Client> &client) {
+  struct BenchRun {
+    std::mutex mutex;
+    std::condition_variable condition;
+    size_t started_requests;
+    size_t completed_requests;
+    size_t failed_requests;
+    bool stopped;
+    std::vector<double> latencies;
+  };
+  BenchRun run;
+  run.started_requests = 0;
+  run.completed_requests = 0;
+  run.failed_requests = 0;
+  run.stopped = false;
+
+  const TIMING_POINT start_time = timingNow();
+  const TIMING_POINT end_time =
+      start_time + std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+                       std::chrono::duration<double>(configuration.duration));
+  const bool closed_loop = configuration.rate <= 0.0;
+
+  std::function<void(size_t, TIMING_POINT)> perform_request;
+  perform_request = [&](size_t index, TIMING_POINT due_time) {
+    auto request = createRequest(benchURL(configuration, index),
+                                 std::unordered_map<std::string, std::string>());
+    client->performRequest(request, [&, due_time](const std::shared_ptr<Response> &response) {
+      const double latency = secondsSince(due_time);
+      size_t next_request = 0;
+      bool perform_next_request = false;
+      {
+        std::lock_guard<std::mutex> lock(run.mutex);
+        run.latencies.push_back(latency * 1000.0);
+        if (response->statusCode() < 200 || response->statusCode() >= 400) {
+          run.failed_requests++;
+        }
+        if (closed_loop && !run.stopped && timingNow() < end_time) {
+          next_request = run.started_requests++;
+          perform_next_request = true;
+        }
+        run.completed_requests++;
+        run.condition.notify_all();
+      }
+      if (perform_next_request) {
+        perform_request(next_request, timingNow());
+      }
+    });
+  };
+
+  if (closed_loop) {
+    {
+      std::lock_guard<std::mutex> lock(run.mutex);
+      run.started_requests = configuration.concurrency;
+    }
+    for (size_t i = 0; i < configuration.concurrency; ++i) {
+      perform_request(i, timingNow());
+    }
+    std::this_thread::sleep_until(end_time);
+  } else {
+    const std::chrono::duration<double> interval(1.0 / configuration.rate);
+    for (size_t i = 0;; ++i) {
+      const TIMING_POINT due_time =
+          start_time +
+          std::chrono::duration_cast<std::chrono::steady_clock::duration>(interval * double(i));
+      if (due_time >= end_time) {
+        break;
+      }
+      std::this_thread::sleep_until(due_time);
+      {
+        std::lock_guard<std::mutex> lock(run.mutex);
+        run.started_requests++;
+      }
+      perform_request(i, due_time);
+    }
+  }
+
+  // Stop starting requests and let the outstanding ones finish
+  std::unique_lock<std::mutex> lock(run.mutex);
+  run.stopped = true;
+  run.condition.wait(lock, [&] { return run.completed_requests == run.started_requests; });
+  const double duration = secondsSince(start_time);
+
+  std::vector<double> sorted_latencies = run.latencies;
+  std::sort(sorted_latencies.begin(), sorted_latencies.end());
+  double total_latency = 0.0;
+  for (double latency : sorted_latencies) {
+    total_latency += latency;
+  }
+  const double request_count = std::max<double>(run.completed_requests, 1.0);
+  const Statistics statistics = client->stats();
+  return {{"layer", configuration.layer},
+          {"concurrency", closed_loop ? configuration.concurrency : 0},
+          {"rate", configuration.rate},
+          {"duration_seconds", duration},
+          {"requests", run.completed_requests},
+          {"errors", run.failed_requests},
+          {"error_rate", run.failed_requests / request_count},
+          {"requests_per_second", run.completed_requests / duration},
+          {"latency_ms",
+           {{"mean", total_latency / request_count},
+            {"p50", percentile(sorted_latencies, 0.5)},
+            {"p90", percentile(sorted_latencies, 0.9)},
+            {"p99", percentile(sorted_latencies, 0.99)},
+            {"p999", percentile(sorted_latencies, 0.999)},
+            {"max", sorted_latencies.empty() ? 0.0 : sorted_latencies.back()}}},
+          {"cache_hit_ratio", statistics.cacheHitRatio()},
+          {"coalescing_ratio", statistics.coalescingRatio()}};
+}
+
+static int benchMain(int argc, char *argv[]) {
+  // Parse our arguments
+  BenchConfiguration configuration = {{}, "", "full", standardCacheLocation(), 16, 0.0, 10.0, ""};
+  std::string input_json_file = "";
+  for (int i = 1; i < argc - 1; ++i) {
+    std::string arg_string = argv[i];
+    if (arg_string == "-i") {
+      input_json_file = argv[++i];
+    } else if (arg_string == "-u") {
+      configuration.url_template = argv[++i];
+    } else if (arg_string == "-l") {
+      configuration.layer = argv[++i];
+    } else if (arg_string == "-d") {
+      configuration.cache_location = argv[++i];
+    } else if (arg_string == "-j") {
+      configuration.concurrency = std::max<size_t>(std::strtoul(argv[++i], nullptr, 10), 1);
+    } else if (arg_string == "-r") {
+      configuration.rate = std::strtod(argv[++i], nullptr);
+    } else if (arg_string == "-t") {
+      configuration.duration = std::strtod(argv[++i], nullptr);
+    } else if (arg_string == "-o") {
+      configuration.output_file = argv[++i];
+    }
+  }
+
+  // The URLs come either from a requests file or a template
+  if (!input_json_file.empty()) {
+    std::ifstream input_json_stream(input_json_file);
+    nlohmann::json input_json = nlohmann::json::parse(input_json_stream);
+    for (const auto &request_json : input_json["requests"]) {
+      configuration.urls.push_back(request_json["url"]);
+    }
+  }
+  if (configuration.urls.empty() && configuration.url_template.empty()) {
+    std::cerr << "usage: NFHTTPCLI bench (-i requests.json | -u url-template) "
+                 "[-l native|caching|multi|full] [-j concurrency | -r rate] [-t seconds] "
+                 "[-d cache-location] [-o output.json]"
+              << std::endl;
+    return 1;
+  }
+  auto client = createBenchClient(configuration);
+  if (!client) {
+    std::cerr << "Unknown client layer: " << configuration.layer << std::endl;
+    return 1;
+  }
+
+  // Report to stdout, and as JSON if asked
+  nlohmann::json result_json = runBench(configuration, client);
+  std::cout << std::fixed << std::setprecision(3) << "layer: " << configuration.layer << std::endl
+            << "requests: " << result_json["requests"].get<size_t>() << std::endl
+            << "requests/s: " << result_json["requests_per_second"].get<double>() << std::endl
+            << "error rate: " << result_json["error_rate"].get<double>() << std::endl;
+  for (const char *percentile_name : {"p50", "p90", "p99", "p999"}) {
+    std::cout << percentile_name
+              << " latency: " << result_json["latency_ms"][percentile_name].get<double>() << " ms"
+              << std::endl;
+  }
+  std::cout << "cache hit ratio: " << result_json["cache_hit_ratio"].get<double>() << std::endl
+            << "coalescing ratio: " << result_json["coalescing_ratio"].get<double>() << std::endl;
+  if (!configuration.output_file.empty()) {
+    std::ofstream output_stream(configuration.output_file);
+    output_stream << std::setw(4) << result_json << std::endl;
+  }
+
+  return 0;
+}
+
+// Copies a whole cache in or out of a single archive, so new hosts can start with a warm cache
+static int cacheArchiveMain(int argc, char *argv[]) {
+  const std::string command = argv[0];
+  std::string cache_location = standardCacheLocation();
+  std::string archive_path = "";
+  for (int i = 1; i < argc - 1; ++i) {
+    std::string arg_string = argv[i];
+    if (arg_string == "-d") {
+      cache_location = argv[++i];
+    } else if ((arg_string == "-o" && command == "export") ||
+               (arg_string == "-i" && command == "import")) {
+      archive_path = argv[++i];
+    }
+  }
+  if (archive_path.empty()) {
+    std::cerr << "usage: NFHTTPCLI export -o archive [-d cache-location]" << std::endl
+              << "       NFHTTPCLI import -i archive [-d cache-location]" << std::endl;
+    return 1;
+  }
+
+  auto caching_client = std::make_shared<CachingClient>(createBenchNativeClient(), cache_location);
+  caching_client->initialise();
+  const bool succeeded = command == "export" ? caching_client->exportCache(archive_path)
+                                             : caching_client->importCache(archive_path);
+  if (!succeeded) {
+    std::cerr << "Failed to " << command << " the cache at " << cache_location << std::endl;
+    return 1;
+  }
+  return 0;
+}
+
+}  // namespace
+
 int main(int argc, char *argv[]) {
+  if (argc > 1 && std::string(argv[1]) == "bench") {
+    return benchMain(argc - 1, argv + 1);
+  }
+  if (argc > 1 && (std::string(argv[1]) == "export" || std::string(argv[1]) == "import")) {
+    return cacheArchiveMain(argc - 1, argv + 1);
+  }
+
   // Parse our arguments
   std::string input_json_file = "";
   std::string output_directory = "";
+  size_t concurrency = 1;
+  bool ndjson = false;
   for (int i = 1; i < argc; ++i) {
     std::string arg_string = argv[i];
     if (arg_string == "-i") {
       input_json_file = argv[++i];
     } else if (arg_string == "-o") {
       output_directory = argv[++i];
+    } else if (arg_string == "-j") {
+      concurrency = std::max(std::strtoul(argv[++i], nullptr, 10), 1ul);
+    } else if (arg_string == "--ndjson") {
+      ndjson = true;
     }
   }
 
@@ -43,53 +370,101 @@ int main(int argc, char *argv[]) {
   auto client = nativeformat::http::createClient(nativeformat::http::standardCacheLocation(),
                                                  "NFHTTP-" + nativeformat::http::version());
 
-  // Setup our responses array
-  nlohmann::json output_json;
-  nlohmann::json responses_json;
-  std::ofstream output_file(output_directory + "/responses.json");
-
   // Parse the requests json
   std::ifstream input_json_stream(input_json_file);
   nlohmann::json input_json = nlohmann::json::parse(input_json_stream);
-  auto requests = input_json["requests"];
-  for (auto it = requests.begin(); it != requests.end(); ++it) {
-    const std::string url = (*it)["url"];
-    const std::string id = (*it)["id"];
+  const auto requests = input_json["requests"];
+
+  // Setup our responses, either streamed a line at a time or written as one document at the end
+  struct Batch {
+    std::mutex mutex;
+    std::condition_variable condition;
+    size_t next_request;
+    size_t completed_requests;
+    nlohmann::json responses_json;
+    std::ofstream output_file;
+  };
+  Batch batch;
+  batch.next_request = 0;
+  batch.completed_requests = 0;
+  batch.responses_json = nlohmann::json::object();
+  batch.output_file.open(output_directory + (ndjson ? "/responses.ndjson" : "/responses.json"));
 
-    // Send our request
+  // Keep up to the concurrency limit of requests in flight, starting the next as each completes
+  std::function<void(size_t)> perform_request;
+  perform_request = [&](size_t index) {
+    const std::string url = requests[index]["url"];
+    const std::string id = requests[index]["id"];
     auto request =
         nativeformat::http::createRequest(url, std::unordered_map<std::string, std::string>());
-    auto response = client->performRequestSynchronously(request);
-    size_t data_length = 0;
-    const unsigned char *data = response->data(data_length);
-
-    // Generate a random file to dump the payload to
-    const size_t random_file_length = 20;
-    auto randchar = []() {
-      const char charset[] =
-          "0123456789"
-          "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-          "abcdefghijklmnopqrstuvwxyz";
-      const size_t max_index = (sizeof(charset) - 1);
-      return charset[rand() % max_index];
-    };
-    std::string random_file_name(random_file_length, 0);
-    std::generate_n(random_file_name.begin(), random_file_length, randchar);
-    random_file_name.insert(0, "/");
-    random_file_name.insert(0, output_directory);
-    std::ofstream random_file;
-    random_file.open(random_file_name);
-    random_file.write((const char *)data, data_length);
-    random_file.close();
-
-    // Create our response JSON
-    nlohmann::json response_json = {{"payload", random_file_name}};
-    responses_json[id] = response_json;
+    const auto start_time = std::chrono::steady_clock::now();
+    client->performRequest(
+        request,
+        [&, id, start_time](const std::shared_ptr<nativeformat::http::Response> &response) {
+          const std::chrono::duration<double> duration =
+              std::chrono::steady_clock::now() - start_time;
+          std::string random_file_name;
+          {
+            std::lock_guard<std::mutex> lock(batch.mutex);
+            random_file_name = randomFileName(output_directory);
+          }
+
+          // Write the payload as soon as it arrives
+          size_t data_length = 0;
+          const unsigned char *data = response->data(data_length);
+          std::ofstream random_file;
+          random_file.open(random_file_name);
+          random_file.write((const char *)data, data_length);
+          random_file.close();
+
+          // Create our response JSON
+          nlohmann::json response_json = {{"payload", random_file_name},
+                                          {"status_code", response->statusCode()},
+                                          {"duration_seconds", duration.count()}};
+          size_t next_request = requests.size();
+          {
+            std::lock_guard<std::mutex> lock(batch.mutex);
+            if (ndjson) {
+              response_json["id"] = id;
+              batch.output_file << response_json << std::endl;
+            } else {
+              batch.responses_json[id] = response_json;
+            }
+            if (batch.next_request < requests.size()) {
+              next_request = batch.next_request++;
+            }
+            if (++batch.completed_requests == requests.size()) {
+              batch.condition.notify_all();
+            }
+          }
+          if (next_request < requests.size()) {
+            perform_request(next_request);
+          }
+        });
+  };
+
+  // Requests are started outside the lock, as a response may be delivered before they return
+  std::vector<size_t> initial_requests;
+  {
+    std::lock_guard<std::mutex> lock(batch.mutex);
+    while (batch.next_request < std::min(concurrency, requests.size())) {
+      initial_requests.push_back(batch.next_request++);
+    }
+  }
+  for (size_t index : initial_requests) {
+    perform_request(index);
+  }
+  {
+    std::unique_lock<std::mutex> lock(batch.mutex);
+    batch.condition.wait(lock, [&] { return batch.completed_requests == requests.size(); });
   }
 
   // Write out responses JSON to disk
-  output_json["responses"] = responses_json;
-  output_file << std::setw(4) << output_json << std::endl;
+  if (!ndjson) {
+    nlohmann::json output_json;
+    output_json["responses"] = batch.responses_json;
+    batch.output_file << std::setw(4) << output_json << std::endl;
+  }
 
   return 0;
 }
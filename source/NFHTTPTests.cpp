@@ -0,0 +1,472 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include <NFHTTP/NFHTTP.h>
+
+#include <algorithm>
+#include <chrono>
+#include <condition_variable>
+#include <cstdlib>
+#include <ctime>
+#include <fstream>
+#include <functional>
+#include <future>
+#include <iostream>
+#include <iterator>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <vector>
+
+#if _WIN32
+#include <direct.h>
+#else
+#include <sys/stat.h>
+#endif
+
+namespace {
+
+using namespace nativeformat::http;
+
+struct TestConfiguration {
+  std::string base_url;
+  std::string scratch_directory;
+};
+
+// Collects the expectations a test did not meet
+class TestResult {
+ public:
+  bool expect(bool condition, const std::string &description, int line) {
+    if (!condition) {
+      _failures.push_back("line " + std::to_string(line) + ": " + description);
+    }
+    return condition;
+  }
+
+  const std::vector<std::string> &failures() const { return _failures; }
+
+ private:
+  std::vector<std::string> _failures;
+};
+
+#define EXPECT(result, condition) (result).expect((condition), #condition, __LINE__)
+
+typedef std::function<void(const TestConfiguration &configuration, TestResult &result)>
+    TEST_FUNCTION;
+
+static void makeDirectory(const std::string &path) {
+#if _WIN32
+  _mkdir(path.c_str());
+#else
+  mkdir(path.c_str(), 0755);
+#endif
+}
+
+// Each run uses its own URLs and directories so that earlier runs never leave anything behind
+static const std::string &runIdentifier() {
+  static const std::string run_identifier = std::to_string(std::time(nullptr));
+  return run_identifier;
+}
+
+static std::string testURL(const TestConfiguration &configuration,
+                           const std::string &name,
+                           const std::string &query) {
+  return configuration.base_url + "/" + name + "-" + runIdentifier() + "?" + query;
+}
+
+static std::string cacheLocation(const TestConfiguration &configuration, const std::string &name) {
+  const std::string cache_location =
+      configuration.scratch_directory + "/" + name + "-" + runIdentifier();
+  makeDirectory(cache_location);
+  return cache_location;
+}
+
+static std::string readFile(const std::string &path) {
+  std::ifstream input(path, std::ios::binary);
+  return std::string(std::istreambuf_iterator<char>(input), std::istreambuf_iterator<char>());
+}
+
+static void writeFile(const std::string &path, const std::string &contents) {
+  std::ofstream output(path, std::ios::binary);
+  output << contents;
+}
+
+// The stand-in server fills its bodies with a repeating pattern, byte i of a body being i % 251
+static bool bodyMatches(const std::shared_ptr<Response> &response, size_t offset, size_t length) {
+  size_t data_length = 0;
+  const unsigned char *data = response->data(data_length);
+  if (data_length != length) {
+    return false;
+  }
+  for (size_t i = 0; i < data_length; ++i) {
+    if (data[i] != (offset + i) % 251) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Waits for every response to a batch of requests, and remembers the order they arrived in
+class ResponseCollector {
+ public:
+  std::function<void(const std::shared_ptr<Response> &)> callback(const std::string &name) {
+    {
+      std::lock_guard<std::mutex> lock(_mutex);
+      _expected_responses++;
+    }
+    return [this, name](const std::shared_ptr<Response> &response) {
+      std::lock_guard<std::mutex> lock(_mutex);
+      _order.push_back(name);
+      _responses[name] = response;
+      _condition.notify_all();
+    };
+  }
+
+  void wait() {
+    std::unique_lock<std::mutex> lock(_mutex);
+    _condition.wait(lock, [this] { return _order.size() == _expected_responses; });
+  }
+
+  size_t position(const std::string &name) const {
+    return std::find(_order.begin(), _order.end(), name) - _order.begin();
+  }
+
+  std::shared_ptr<Response> response(const std::string &name) const {
+    auto response_it = _responses.find(name);
+    return response_it == _responses.end() ? nullptr : response_it->second;
+  }
+
+ private:
+  std::mutex _mutex;
+  std::condition_variable _condition;
+  size_t _expected_responses = 0;
+  std::vector<std::string> _order;
+  std::unordered_map<std::string, std::shared_ptr<Response>> _responses;
+};
+
+static void testPriorityOrdering(const TestConfiguration &configuration, TestResult &result) {
+  auto client = createClient("", "NFHTTPTests");
+  // Low priority requests wait for the slow high priority ones, the normal one goes straight out
+  std::vector<std::shared_ptr<Request>> requests;
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
+  ResponseCollector collector;
+  const std::vector<std::pair<std::string, RequestPriority>> priorities = {
+      {"high-0", RequestPriorityHigh},
+      {"high-1", RequestPriorityHigh},
+      {"low-0", RequestPriorityLow},
+      {"low-1", RequestPriorityLow},
+      {"normal-0", RequestPriorityNormal}};
+  for (const auto &priority : priorities) {
+    const bool high = priority.second == RequestPriorityHigh;
+    auto request = createRequest(
+        testURL(configuration, "priority-" + priority.first, high ? "latency=500" : "latency=0"),
+        std::unordered_map<std::string, std::string>());
+    request->setPriority(priority.second);
+    requests.push_back(request);
+    callbacks.push_back(collector.callback(priority.first));
+  }
+  client->performRequests(requests, callbacks);
+  collector.wait();
+
+  EXPECT(result, collector.position("normal-0") < collector.position("high-0"));
+  EXPECT(result, collector.position("normal-0") < collector.position("high-1"));
+  for (const std::string low : {"low-0", "low-1"}) {
+    EXPECT(result, collector.position(low) > collector.position("high-0"));
+    EXPECT(result, collector.position(low) > collector.position("high-1"));
+    EXPECT(result, collector.response(low)->statusCode() == StatusCodeOK);
+  }
+}
+
+static void testSegmentedDownloads(const TestConfiguration &configuration, TestResult &result) {
+  auto client = createClient("", "NFHTTPTests");
+  // Servers that take ranges get asked for the resource in segments, others get a plain request
+  const size_t size = 4 * 1048576;
+  for (const std::string ranges : {"1", "0"}) {
+    auto request = createRequest(testURL(configuration,
+                                         "segmented-" + ranges,
+                                         "size=" + std::to_string(size) + "&ranges=" + ranges),
+                                 std::unordered_map<std::string, std::string>());
+    request->setSegmentCount(4);
+    auto response = client->performRequestSynchronously(request);
+    EXPECT(result, response->statusCode() == StatusCodeOK);
+    EXPECT(result, bodyMatches(response, 0, size));
+    EXPECT(result, response->metadata()["segments"] == (ranges == "1" ? "4" : ""));
+  }
+}
+
+static void testCacheSnapshots(const TestConfiguration &configuration, TestResult &result) {
+  std::vector<std::shared_ptr<Request>> requests;
+  for (size_t i = 0; i < 3; ++i) {
+    requests.push_back(
+        createRequest(testURL(configuration, "snapshot-" + std::to_string(i), "size=1000"),
+                      std::unordered_map<std::string, std::string>()));
+  }
+  const std::string archive_path = cacheLocation(configuration, "snapshot") + "/cache.archive";
+  {
+    auto client = createClient(cacheLocation(configuration, "snapshot-source"), "NFHTTPTests");
+    for (const auto &request : requests) {
+      client->performRequestSynchronously(request);
+    }
+    EXPECT(result, client->exportCache(archive_path));
+  }
+
+  // The imported cache answers every request without going to the network
+  auto client = createClient(cacheLocation(configuration, "snapshot-imported"), "NFHTTPTests");
+  EXPECT(result, client->importCache(archive_path));
+  for (const auto &request : requests) {
+    EXPECT(result, bodyMatches(client->performRequestSynchronously(request), 0, 1000));
+  }
+  EXPECT(result, client->stats().native.started == 0);
+
+  // Damaged archives are turned away whole, leaving the cache as it was
+  const std::string archive = readFile(archive_path);
+  const std::string truncated_archive_path = archive_path + "-truncated";
+  writeFile(truncated_archive_path, archive.substr(0, archive.size() - archive.size() / 3));
+  std::string tampered_archive = archive;
+  const std::string header_hash_key = "\"header_hash\":\"";
+  const size_t header_hash_position = tampered_archive.find(header_hash_key);
+  EXPECT(result, header_hash_position != std::string::npos);
+  if (header_hash_position != std::string::npos) {
+    tampered_archive.replace(header_hash_position + header_hash_key.size(), 3, "../");
+  }
+  const std::string tampered_archive_path = archive_path + "-tampered";
+  writeFile(tampered_archive_path, tampered_archive);
+  for (const std::string &damaged_archive_path : {truncated_archive_path, tampered_archive_path}) {
+    const std::string damaged_name = damaged_archive_path.substr(archive_path.size() + 1);
+    auto damaged_client =
+        createClient(cacheLocation(configuration, "snapshot-" + damaged_name), "NFHTTPTests");
+    EXPECT(result, !damaged_client->importCache(damaged_archive_path));
+    damaged_client->performRequestSynchronously(requests.front());
+    EXPECT(result, damaged_client->stats().native.started == 1);
+  }
+}
+
+static void testCoalescingWindow(const TestConfiguration &configuration, TestResult &result) {
+  auto client = createClient("", "NFHTTPTests");
+  client->setCoalescingWindow(std::chrono::milliseconds(300), 1048576);
+  const std::string url = testURL(configuration, "coalescing", "size=1000");
+  auto performRequest = [&client, &url] {
+    return client->performRequestSynchronously(
+        createRequest(url, std::unordered_map<std::string, std::string>()));
+  };
+
+  // A repeat within the window is answered with the response that just completed
+  performRequest();
+  EXPECT(result, bodyMatches(performRequest(), 0, 1000));
+  EXPECT(result, client->stats().coalesced_requests == 1);
+  EXPECT(result, client->stats().native.started == 1);
+
+  // Once the window has passed the request goes back to the network
+  std::this_thread::sleep_for(std::chrono::milliseconds(400));
+  EXPECT(result, bodyMatches(performRequest(), 0, 1000));
+  EXPECT(result, client->stats().coalesced_requests == 1);
+  EXPECT(result, client->stats().native.started == 2);
+}
+
+static void testPinning(const TestConfiguration &configuration, TestResult &result) {
+  auto client = createClient(cacheLocation(configuration, "pinning"), "NFHTTPTests");
+  const std::string pin_identifier = "pinning-" + runIdentifier();
+  std::vector<std::shared_ptr<Response>> responses;
+  std::vector<std::string> request_hashes;
+  size_t total_bytes = 0;
+  for (size_t i = 0; i < 3; ++i) {
+    const size_t size = 1000 * (i + 1);
+    auto response = client->performRequestSynchronously(createRequest(
+        testURL(configuration, "pinning-" + std::to_string(i), "size=" + std::to_string(size)),
+        std::unordered_map<std::string, std::string>()));
+    EXPECT(result, bodyMatches(response, 0, size));
+    responses.push_back(response);
+    request_hashes.push_back(response->request()->hash());
+    total_bytes += size;
+  }
+
+  // The client reports how much it pinned, and hands the responses back by identifier
+  std::promise<size_t> pinned_bytes;
+  client->pinResponses(
+      responses, pin_identifier, [&pinned_bytes](size_t bytes) { pinned_bytes.set_value(bytes); });
+  EXPECT(result, pinned_bytes.get_future().get() == total_bytes);
+  auto pinnedResponseCount = [&client, &pin_identifier] {
+    std::promise<size_t> count;
+    client->pinnedResponsesForIdentifier(
+        pin_identifier, [&count](const std::vector<std::shared_ptr<Response>> &responses) {
+          count.set_value(responses.size());
+        });
+    return count.get_future().get();
+  };
+  EXPECT(result, pinnedResponseCount() == responses.size());
+  std::promise<std::vector<std::string>> identifiers;
+  client->pinningIdentifiers([&identifiers](const std::vector<std::string> &pinning_identifiers) {
+    identifiers.set_value(pinning_identifiers);
+  });
+  const std::vector<std::string> pinning_identifiers = identifiers.get_future().get();
+  EXPECT(result,
+         std::find(pinning_identifiers.begin(), pinning_identifiers.end(), pin_identifier) !=
+             pinning_identifiers.end());
+
+  // Unpinning by request hash releases the same bytes
+  std::promise<size_t> unpinned_bytes;
+  client->unpinRequestHashes(request_hashes, pin_identifier, [&unpinned_bytes](size_t bytes) {
+    unpinned_bytes.set_value(bytes);
+  });
+  EXPECT(result, unpinned_bytes.get_future().get() == total_bytes);
+  EXPECT(result, pinnedResponseCount() == 0);
+}
+
+static void testCacheIndex(const TestConfiguration &configuration, TestResult &result) {
+  const std::string cache_location = cacheLocation(configuration, "index");
+  auto request = createRequest(testURL(configuration, "index", "size=1000"),
+                               std::unordered_map<std::string, std::string>());
+  {
+    // A request the cache has never seen is turned away by the index, then stored
+    auto client = createClient(cache_location, "NFHTTPTests");
+    EXPECT(result, bodyMatches(client->performRequestSynchronously(request), 0, 1000));
+    EXPECT(result, client->stats().cache_index_skipped_lookups == 1);
+    EXPECT(result, client->stats().native.started == 1);
+    EXPECT(result, bodyMatches(client->performRequestSynchronously(request), 0, 1000));
+    EXPECT(result, client->stats().cache_index_skipped_lookups == 1);
+    EXPECT(result, client->stats().cache_hits == 1);
+    EXPECT(result, client->stats().native.started == 1);
+  }
+
+  // The index is rebuilt from the database when the cache is opened again
+  auto client = createClient(cache_location, "NFHTTPTests");
+  EXPECT(result, bodyMatches(client->performRequestSynchronously(request), 0, 1000));
+  EXPECT(result, client->stats().cache_index_skipped_lookups == 0);
+  EXPECT(result, client->stats().cache_hits == 1);
+  EXPECT(result, client->stats().native.started == 0);
+}
+
+static void testConcurrentCacheReads(const TestConfiguration &configuration, TestResult &result) {
+  auto client = createClient(cacheLocation(configuration, "concurrent"), "NFHTTPTests");
+  std::vector<std::string> urls;
+  for (size_t i = 0; i < 16; ++i) {
+    urls.push_back(testURL(configuration, "concurrent-" + std::to_string(i), "size=10000"));
+    client->performRequestSynchronously(
+        createRequest(urls.back(), std::unordered_map<std::string, std::string>()));
+  }
+  const uint64_t native_started = client->stats().native.started;
+
+  // Many cached requests at once are looked up and read in parallel, away from the caller
+  std::vector<std::shared_ptr<Request>> requests;
+  std::vector<std::function<void(const std::shared_ptr<Response> &)>> callbacks;
+  ResponseCollector collector;
+  std::mutex thread_mutex;
+  bool called_back_on_calling_thread = false;
+  const std::thread::id calling_thread = std::this_thread::get_id();
+  for (size_t i = 0; i < 64; ++i) {
+    const std::string name = "concurrent-" + std::to_string(i);
+    requests.push_back(
+        createRequest(urls[i % urls.size()], std::unordered_map<std::string, std::string>()));
+    auto callback = collector.callback(name);
+    callbacks.push_back([&, callback](const std::shared_ptr<Response> &response) {
+      {
+        std::lock_guard<std::mutex> lock(thread_mutex);
+        called_back_on_calling_thread |= std::this_thread::get_id() == calling_thread;
+      }
+      callback(response);
+    });
+  }
+  client->performRequests(requests, callbacks);
+  collector.wait();
+
+  for (size_t i = 0; i < requests.size(); ++i) {
+    EXPECT(result, bodyMatches(collector.response("concurrent-" + std::to_string(i)), 0, 10000));
+  }
+  EXPECT(result, !called_back_on_calling_thread);
+  EXPECT(result, client->stats().native.started == native_started);
+}
+
+static void testRangeCache(const TestConfiguration &configuration, TestResult &result) {
+  auto client = createClient(cacheLocation(configuration, "ranges"), "NFHTTPTests");
+  const std::string url = testURL(configuration, "ranges", "size=1000");
+  auto performRangeRequest = [&client, &url](size_t start, size_t end) {
+    return client->performRequestSynchronously(createRequest(
+        url, {{"Range", "bytes=" + std::to_string(start) + "-" + std::to_string(end)}}));
+  };
+  for (const auto &range : {std::make_pair(0, 99), std::make_pair(200, 299)}) {
+    auto response = performRangeRequest(range.first, range.second);
+    EXPECT(result, response->statusCode() == StatusCodePartialContent);
+    EXPECT(result, bodyMatches(response, range.first, range.second - range.first + 1));
+  }
+  EXPECT(result, client->stats().native.started == 2);
+
+  // A range spanning both segments only asks the server for the gap between them
+  auto response = performRangeRequest(0, 299);
+  EXPECT(result, response->statusCode() == StatusCodePartialContent);
+  EXPECT(result, bodyMatches(response, 0, 300));
+  EXPECT(result, client->stats().native.started == 3);
+
+  // Now the whole range is cached
+  EXPECT(result, bodyMatches(performRangeRequest(50, 249), 50, 200));
+  EXPECT(result, client->stats().native.started == 3);
+}
+
+static const std::vector<std::pair<std::string, TEST_FUNCTION>> &tests() {
+  static const std::vector<std::pair<std::string, TEST_FUNCTION>> tests = {
+      {"priority_ordering", testPriorityOrdering},
+      {"segmented_downloads", testSegmentedDownloads},
+      {"cache_snapshots", testCacheSnapshots},
+      {"coalescing_window", testCoalescingWindow},
+      {"pinning", testPinning},
+      {"cache_index", testCacheIndex},
+      {"concurrent_cache_reads", testConcurrentCacheReads},
+      {"range_cache", testRangeCache}};
+  return tests;
+}
+
+}  // namespace
+
+int main(int argc, char *argv[]) {
+  // Parse our arguments
+  TestConfiguration configuration = {"http://127.0.0.1:6583", "nfhttp-tests"};
+  std::string test_filter = "";
+  for (int i = 1; i < argc - 1; ++i) {
+    std::string arg_string = argv[i];
+    if (arg_string == "-u") {
+      configuration.base_url = argv[++i];
+    } else if (arg_string == "-d") {
+      configuration.scratch_directory = argv[++i];
+    } else if (arg_string == "-t") {
+      test_filter = argv[++i];
+    }
+  }
+  makeDirectory(configuration.scratch_directory);
+
+  // Run every test, or just the one asked for, against the stand-in server
+  size_t failed_tests = 0;
+  for (const auto &test : tests()) {
+    if (!test_filter.empty() && test.first != test_filter) {
+      continue;
+    }
+    TestResult result;
+    test.second(configuration, result);
+    if (result.failures().empty()) {
+      std::cerr << test.first << ": passed" << std::endl;
+      continue;
+    }
+    failed_tests++;
+    std::cerr << test.first << ": FAILED" << std::endl;
+    for (const auto &failure : result.failures()) {
+      std::cerr << "  " << failure << std::endl;
+    }
+  }
+  return failed_tests == 0 ? 0 : 1;
+}
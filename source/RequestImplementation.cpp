@@ -20,6 +20,10 @@
  */
 #include "RequestImplementation.h"
 
+#include <sys/stat.h>
+
+#include <atomic>
+
 #include <nlohmann/json.hpp>
 
 #include "sha256.h"
@@ -31,10 +35,20 @@ static const std::string url_key("url");
 static const std::string headers_key("headers");
 static const std::string method_key("method");
 static const std::string content_length_key("Content-Length");
+static const std::string transfer_encoding_key("Transfer-Encoding");
 
 RequestImplementation::RequestImplementation(
     const std::string &url, const std::unordered_map<std::string, std::string> &header_map)
-    : _url(url), _headers(header_map), _method(GetMethod), _data(nullptr), _data_length(0) {
+    : _url(url),
+      _headers(header_map),
+      _method(GetMethod),
+      _data(nullptr),
+      _data_length(0),
+      _data_provider(nullptr),
+      _data_provider_length(-1),
+      _data_provider_identifier(0),
+      _priority(RequestPriorityNormal),
+      _segment_count(0) {
   _headers[content_length_key] = "0";
 }
 
@@ -43,7 +57,14 @@ RequestImplementation::RequestImplementation(const Request &request)
       _headers(request.headerMap()),
       _method(request.method()),
       _data(nullptr),
-      _data_length(0) {
+      _data_length(0),
+      _data_path(request.dataPath()),
+      _data_provider(request.dataProvider()),
+      _data_provider_length(request.dataProviderLength()),
+      _data_provider_identifier(0),
+      _priority(request.priority()),
+      _segment_count(request.segmentCount()),
+      _download_path(request.downloadPath()) {
   size_t data_length = 0;
   const unsigned char *data = request.data(data_length);
   if (data_length > 0) {
@@ -51,10 +72,20 @@ RequestImplementation::RequestImplementation(const Request &request)
     memcpy(_data, data, data_length);
     _data_length = data_length;
   }
+  if (auto request_implementation = dynamic_cast<const RequestImplementation *>(&request)) {
+    // Copies stream the same body, so they must still hash the same
+    _data_provider_identifier = request_implementation->_data_provider_identifier;
+  }
 }
 
 RequestImplementation::RequestImplementation(const std::string &serialised)
-    : _data(nullptr), _data_length(0) {
+    : _data(nullptr),
+      _data_length(0),
+      _data_provider(nullptr),
+      _data_provider_length(-1),
+      _data_provider_identifier(0),
+      _priority(RequestPriorityNormal),
+      _segment_count(0) {
   nlohmann::json j = nlohmann::json::parse(serialised);
   _url = j[url_key].get<std::string>();
   auto o = j[headers_key];
@@ -118,6 +149,11 @@ std::string RequestImplementation::hash() const {
   if (_data != nullptr) {
     amalgamation.append((const char *)_data, _data_length);
   }
+  amalgamation += _data_path;
+  if (_data_provider) {
+    // A provided body can only be read once, so such requests are never treated as the same
+    amalgamation += std::to_string(_data_provider_identifier);
+  }
   return sha256(amalgamation);
 }
 
@@ -151,9 +187,48 @@ void RequestImplementation::setData(const unsigned char *data, size_t data_lengt
     _data[data_length] = 0;
     _data_length = data_length;
   }
+  _data_path.clear();
+  _data_provider = nullptr;
+  _headers.erase(transfer_encoding_key);
   _headers[content_length_key] = std::to_string(data_length);
 }
 
+std::string RequestImplementation::dataPath() const {
+  return _data_path;
+}
+
+void RequestImplementation::setDataPath(const std::string &data_path) {
+  setData(nullptr, 0);
+  _data_path = data_path;
+  struct stat data_stat;
+  if (stat(data_path.c_str(), &data_stat) == 0) {
+    _headers[content_length_key] = std::to_string(data_stat.st_size);
+  }
+}
+
+REQUEST_DATA_PROVIDER_FUNCTION RequestImplementation::dataProvider() const {
+  return _data_provider;
+}
+
+long long RequestImplementation::dataProviderLength() const {
+  return _data_provider_length;
+}
+
+void RequestImplementation::setDataProvider(REQUEST_DATA_PROVIDER_FUNCTION data_provider,
+                                            long long data_length) {
+  static std::atomic<unsigned long> data_provider_identifier(0);
+  setData(nullptr, 0);
+  _data_provider = data_provider;
+  _data_provider_length = data_length;
+  _data_provider_identifier = ++data_provider_identifier;
+  if (data_length < 0) {
+    _headers.erase(content_length_key);
+    _headers[transfer_encoding_key] = "chunked";
+  } else {
+    _headers[content_length_key] = std::to_string(data_length);
+  }
+}
+
 Request::CacheControl RequestImplementation::cacheControl() const {
   const auto &cache_control_iterator = _headers.find("Cache-Control");
   if (cache_control_iterator == _headers.end()) {
@@ -182,5 +257,29 @@ Request::CacheControl RequestImplementation::cacheControl() const {
           control_directives.find("only-if-cached") != control_directives.end()};
 }
 
+RequestPriority RequestImplementation::priority() const {
+  return _priority;
+}
+
+void RequestImplementation::setPriority(RequestPriority priority) {
+  _priority = priority;
+}
+
+int RequestImplementation::segmentCount() const {
+  return _segment_count;
+}
+
+void RequestImplementation::setSegmentCount(int segment_count) {
+  _segment_count = segment_count;
+}
+
+std::string RequestImplementation::downloadPath() const {
+  return _download_path;
+}
+
+void RequestImplementation::setDownloadPath(const std::string &download_path) {
+  _download_path = download_path;
+}
+
 }  // namespace http
 }  // namespace nativeformat
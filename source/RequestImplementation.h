@@ -46,7 +46,19 @@ class RequestImplementation : public Request {
   void setMethod(const std::string &method) override;
   const unsigned char *data(size_t &data_length) const override;
   void setData(const unsigned char *data, size_t data_length) override;
+  std::string dataPath() const override;
+  void setDataPath(const std::string &data_path) override;
+  REQUEST_DATA_PROVIDER_FUNCTION dataProvider() const override;
+  long long dataProviderLength() const override;
+  void setDataProvider(REQUEST_DATA_PROVIDER_FUNCTION data_provider,
+                       long long data_length = -1) override;
   CacheControl cacheControl() const override;
+  RequestPriority priority() const override;
+  void setPriority(RequestPriority priority) override;
+  int segmentCount() const override;
+  void setSegmentCount(int segment_count) override;
+  std::string downloadPath() const override;
+  void setDownloadPath(const std::string &download_path) override;
 
  private:
   std::string _url;
@@ -54,6 +66,13 @@ class RequestImplementation : public Request {
   std::string _method;
   unsigned char *_data;
   size_t _data_length;
+  std::string _data_path;
+  REQUEST_DATA_PROVIDER_FUNCTION _data_provider;
+  long long _data_provider_length;
+  unsigned long _data_provider_identifier;
+  RequestPriority _priority;
+  int _segment_count;
+  std::string _download_path;
 };
 
 }  // namespace http
@@ -0,0 +1,48 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include <NFHTTP/RequestObserver.h>
+
+#include "RequestObserverNotification.h"
+
+namespace nativeformat {
+namespace http {
+
+RequestObserver::~RequestObserver() {}
+
+void notifyRequestObserver(const std::shared_ptr<RequestObserver> &request_observer,
+                           RequestEvent event,
+                           const std::string &request_hash) {
+  if (request_observer) {
+    request_observer->requestEvent(event, request_hash, std::chrono::system_clock::now());
+  }
+}
+
+void notifyRequestObserver(const std::shared_ptr<RequestObserver> &request_observer,
+                           RequestEvent event,
+                           const std::shared_ptr<Request> &request) {
+  // Hashing a request is not free, so only do it when someone is listening
+  if (request_observer) {
+    request_observer->requestEvent(event, request->hash(), std::chrono::system_clock::now());
+  }
+}
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,41 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <NFHTTP/Request.h>
+#include <NFHTTP/RequestObserver.h>
+
+#include <memory>
+#include <string>
+
+namespace nativeformat {
+namespace http {
+
+// Both do nothing when no observer is registered
+extern void notifyRequestObserver(const std::shared_ptr<RequestObserver> &request_observer,
+                                  RequestEvent event,
+                                  const std::string &request_hash);
+extern void notifyRequestObserver(const std::shared_ptr<RequestObserver> &request_observer,
+                                  RequestEvent event,
+                                  const std::shared_ptr<Request> &request);
+
+}  // namespace http
+}  // namespace nativeformat
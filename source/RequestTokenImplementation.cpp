@@ -30,7 +30,10 @@ RequestTokenImplementation::RequestTokenImplementation(
 RequestTokenImplementation::~RequestTokenImplementation() {}
 
 void RequestTokenImplementation::cancel() {
-  _cancelled = true;
+  // Only the first cancel is passed on to the delegate
+  if (_cancelled.exchange(true)) {
+    return;
+  }
   if (auto delegate = _delegate.lock()) {
     delegate->requestTokenDidCancel(shared_from_this());
   }
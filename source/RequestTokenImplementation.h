@@ -51,7 +51,7 @@ class RequestTokenImplementation : public RequestToken,
   const std::weak_ptr<RequestTokenDelegate> _delegate;
   const std::string _identifier;
 
-  bool _cancelled;
+  std::atomic<bool> _cancelled;
   std::atomic<int> _dependents;
 };
 
@@ -58,6 +58,9 @@ ResponseImplementation::ResponseImplementation(const std::string &serialised,
       _data_length(data_length),
       _status_code(StatusCodeInvalid),
       _cancelled(false) {
+  if (data_length > 0) {
+    memcpy(_data, data, data_length);
+  }
   nlohmann::json j = nlohmann::json::parse(serialised);
   _request = std::make_shared<RequestImplementation>(j[request_key].get<std::string>());
   _status_code = j[status_code_key];
@@ -83,10 +86,34 @@ const std::shared_ptr<Request> ResponseImplementation::request() const {
 }
 
 const unsigned char *ResponseImplementation::data(size_t &data_length) const {
+  std::lock_guard<std::mutex> lock(_data_mutex);
   data_length = _data_length;
+  if (_data == nullptr && !_data_path.empty() && _data_length > 0) {
+    FILE *data_file = fopen(_data_path.c_str(), "rb");
+    if (data_file != nullptr) {
+      _data = (unsigned char *)malloc(_data_length);
+      if (fread(_data, _data_length, 1, data_file) != 1) {
+        free(_data);
+        _data = nullptr;
+        data_length = 0;
+      }
+      fclose(data_file);
+    } else {
+      data_length = 0;
+    }
+  }
   return _data;
 }
 
+std::string ResponseImplementation::dataPath() const {
+  return _data_path;
+}
+
+size_t ResponseImplementation::dataLength() const {
+  std::lock_guard<std::mutex> lock(_data_mutex);
+  return _data_length;
+}
+
 StatusCode ResponseImplementation::statusCode() const {
   return _status_code;
 }
@@ -162,5 +189,15 @@ void ResponseImplementation::setMetadata(const std::string &key, const std::stri
   _metadata[key] = value;
 }
 
+void ResponseImplementation::setDataPath(const std::string &data_path, size_t data_length) {
+  std::lock_guard<std::mutex> lock(_data_mutex);
+  if (_data != nullptr) {
+    free(_data);
+    _data = nullptr;
+  }
+  _data_path = data_path;
+  _data_length = data_length;
+}
+
 }  // namespace http
 }  // namespace nativeformat
@@ -0,0 +1,68 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <array>
+#include <functional>
+#include <mutex>
+#include <string>
+
+namespace nativeformat {
+namespace http {
+
+// Splits state keyed by a string across independently locked shards, so threads working on
+// different keys rarely wait on each other
+template <typename Shard, size_t SHARD_COUNT = 16>
+class ShardedTable {
+ public:
+  class LockedShard {
+   public:
+    LockedShard(std::mutex &mutex, Shard &shard) : _lock(mutex), _shard(shard) {}
+
+    Shard *operator->() { return &_shard; }
+    Shard &operator*() { return _shard; }
+    void unlock() { _lock.unlock(); }
+
+   private:
+    std::unique_lock<std::mutex> _lock;
+    Shard &_shard;
+  };
+
+  static constexpr size_t shardCount() { return SHARD_COUNT; }
+  LockedShard lock(const std::string &key) {
+    return lockShard(std::hash<std::string>()(key) % SHARD_COUNT);
+  }
+  LockedShard lockShard(size_t shard_index) {
+    LockableShard &lockable_shard = _shards[shard_index];
+    return LockedShard(lockable_shard.mutex, lockable_shard.shard);
+  }
+
+ private:
+  struct LockableShard {
+    std::mutex mutex;
+    Shard shard;
+  };
+
+  std::array<LockableShard, SHARD_COUNT> _shards;
+};
+
+}  // namespace http
+}  // namespace nativeformat
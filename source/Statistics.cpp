@@ -0,0 +1,68 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include <NFHTTP/Statistics.h>
+
+#include <cmath>
+
+namespace nativeformat {
+namespace http {
+
+const size_t LatencyHistogram::BUCKET_COUNT;
+const size_t LayerStatistics::STATUS_CLASS_COUNT;
+
+double LatencyHistogram::bucketUpperBound(size_t bucket) {
+  return std::ldexp(1.0, static_cast<int>(bucket));
+}
+
+double LatencyHistogram::mean() const {
+  return count == 0 ? 0.0 : total_milliseconds / count;
+}
+
+double LatencyHistogram::percentile(double percentile) const {
+  // Reports the upper bound of the bucket the percentile falls into
+  const double threshold = percentile * count;
+  uint64_t cumulative = 0;
+  for (size_t i = 0; i < BUCKET_COUNT; ++i) {
+    cumulative += buckets[i];
+    if (cumulative > 0 && cumulative >= threshold) {
+      return bucketUpperBound(i);
+    }
+  }
+  return 0.0;
+}
+
+uint64_t LayerStatistics::errors() const {
+  return status_classes[0] + status_classes[4] + status_classes[5];
+}
+
+double Statistics::coalescingRatio() const {
+  return multi_request.started == 0
+             ? 0.0
+             : static_cast<double>(coalesced_requests) / multi_request.started;
+}
+
+double Statistics::cacheHitRatio() const {
+  const uint64_t lookups = cache_hits + cache_misses;
+  return lookups == 0 ? 0.0 : static_cast<double>(cache_hits) / lookups;
+}
+
+}  // namespace http
+}  // namespace nativeformat
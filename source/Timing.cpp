@@ -0,0 +1,43 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include "Timing.h"
+
+#include <cstdio>
+
+namespace nativeformat {
+namespace http {
+
+TIMING_POINT timingNow() {
+  return std::chrono::steady_clock::now();
+}
+
+double secondsSince(const TIMING_POINT &timing_point) {
+  return std::chrono::duration<double>(std::chrono::steady_clock::now() - timing_point).count();
+}
+
+std::string timingString(double seconds) {
+  char timing_string[32];
+  snprintf(timing_string, sizeof(timing_string), "%.3f", seconds * 1000.0);
+  return timing_string;
+}
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,74 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#include "WorkerPool.h"
+
+namespace nativeformat {
+namespace http {
+
+WorkerPool::WorkerPool(size_t thread_count) : _tasks(std::make_shared<Tasks>()) {
+  _tasks->shutdown = false;
+  for (size_t i = 0; i < thread_count; ++i) {
+    _threads.push_back(std::thread(workerThread, _tasks));
+  }
+}
+
+WorkerPool::~WorkerPool() {
+  {
+    std::lock_guard<std::mutex> lock(_tasks->mutex);
+    _tasks->shutdown = true;
+  }
+  _tasks->condition.notify_all();
+  for (auto &thread : _threads) {
+    // The pool can be destroyed by one of its own tasks, in which case that thread finishes alone
+    if (thread.get_id() == std::this_thread::get_id()) {
+      thread.detach();
+    } else {
+      thread.join();
+    }
+  }
+}
+
+void WorkerPool::enqueue(std::function<void()> task) {
+  {
+    std::lock_guard<std::mutex> lock(_tasks->mutex);
+    _tasks->tasks.push_back(task);
+  }
+  _tasks->condition.notify_one();
+}
+
+void WorkerPool::workerThread(const std::shared_ptr<Tasks> &tasks) {
+  while (true) {
+    std::function<void()> task;
+    {
+      std::unique_lock<std::mutex> lock(tasks->mutex);
+      tasks->condition.wait(lock, [&tasks] { return tasks->shutdown || !tasks->tasks.empty(); });
+      if (tasks->tasks.empty()) {
+        return;
+      }
+      task = std::move(tasks->tasks.front());
+      tasks->tasks.pop_front();
+    }
+    task();
+  }
+}
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,60 @@
+/*
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+#pragma once
+
+#include <condition_variable>
+#include <deque>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+namespace nativeformat {
+namespace http {
+
+// Runs tasks in the order they were enqueued on a fixed set of threads. Tasks still queued when
+// the pool is destroyed are run before it finishes
+class WorkerPool {
+ public:
+  WorkerPool(size_t thread_count);
+  virtual ~WorkerPool();
+
+  void enqueue(std::function<void()> task);
+
+ private:
+  struct Tasks {
+    std::deque<std::function<void()>> tasks;
+    std::mutex mutex;
+    std::condition_variable condition;
+    bool shutdown;
+  };
+
+  static void workerThread(const std::shared_ptr<Tasks> &tasks);
+
+  // The threads share ownership of the queue, so a thread left running after the pool is gone
+  // never touches freed memory
+  const std::shared_ptr<Tasks> _tasks;
+  std::vector<std::thread> _threads;
+};
+
+}  // namespace http
+}  // namespace nativeformat
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''
+ * Copyright (c) 2018 Spotify AB.
+ *
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+'''
+
+# A local stand-in server for the benchmarks. Every response is shaped by its query string:
+#   size     body size in bytes (default 1024)
+#   latency  milliseconds to wait before responding (default 0)
+#   chunked  send the body with chunked transfer encoding when 1
+#   etag     send an ETag and answer matching If-None-Match requests with a 304 when 1
+#   max_age  Cache-Control max-age in seconds (default 3600)
+#   ranges   answer single byte range requests with a 206 when 1 (default 1), ignore them when 0
+
+import re
+import sys
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+CHUNK_SIZE = 16384
+RANGE_PATTERN = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BenchmarkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so without this delayed ACKs stall each response
+    disable_nagle_algorithm = True
+    bodies = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def query_value(self, query, name, default):
+        try:
+            return int(query.get(name, [default])[0])
+        except ValueError:
+            return default
+
+    def body(self, size):
+        if size not in self.bodies:
+            self.bodies[size] = bytes(bytearray(i % 251 for i in range(size)))
+        return self.bodies[size]
+
+    def requested_range(self, size, etag):
+        match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+        if match is None:
+            return None
+        # A stale If-Range asks for the whole resource instead
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range != etag:
+            return None
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+        return (start, min(end, size - 1))
+
+    def respond(self, send_body):
+        query = parse_qs(urlparse(self.path).query)
+        size = self.query_value(query, 'size', 1024)
+        latency = self.query_value(query, 'latency', 0)
+        chunked = self.query_value(query, 'chunked', 0) == 1
+        etag = '"' + str(size) + '"' if self.query_value(query, 'etag', 0) == 1 else None
+        max_age = self.query_value(query, 'max_age', 3600)
+        ranges = self.query_value(query, 'ranges', 1) == 1
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'max-age=' + str(max_age))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.body(size)
+        byte_range = self.requested_range(size, etag) if ranges else None
+        if byte_range is not None and byte_range[0] >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */' + str(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if byte_range is not None:
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (byte_range[0], byte_range[1], size))
+            body = body[byte_range[0]:byte_range[1] + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Cache-Control', 'max-age=' + str(max_age))
+        if ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        if chunked:
+            for offset in range(0, len(body), CHUNK_SIZE):
+                chunk = body[offset:offset + CHUNK_SIZE]
+                self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6583
+    server = ThreadingHTTPServer(('127.0.0.1', port), BenchmarkHandler)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()